@@ -0,0 +1,384 @@
+import cPickle as pickle
+from collections import OrderedDict
+from hashlib import md5
+from random import getrandbits
+from threading import RLock, Thread
+from time import time
+
+import simplejson as json
+from django.conf import settings
+from django.core.cache import get_cache
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+from django.test.signals import setting_changed
+
+
+class LRUCache(object):
+    """
+    Thread safe, size bounded, local memory cache.
+
+    The least recently used keys are evicted first.
+    """
+    local = True
+
+    def __init__(self, max_size=1000):
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = RLock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                return default
+            self._data[key] = value
+            return value
+
+    def get_many(self, keys):
+        with self._lock:
+            found = {}
+            for key in keys:
+                value = self.get(key, self)
+                if value is not self:
+                    found[key] = value
+            return found
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def set_many(self, data):
+        with self._lock:
+            for key, value in data.iteritems():
+                self.set(key, value)
+
+    def add(self, key, value):
+        """Set key if missing, return whether it was."""
+        with self._lock:
+            if key in self._data:
+                return False
+            self.set(key, value)
+            return True
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class RefreshingCache(object):
+    """
+    Local cache of slow lookups (remote API calls), with expiry.
+
+    - Values are fresh for ttl seconds, then served stale for up to stale_ttl
+      more seconds while a background thread loads them again.
+    - Lookups failing with one of errors are cached as None for error_ttl
+      seconds, so an unavailable service is not called on every access. A
+      failed refresh keeps serving the stale value, and is retried error_ttl
+      seconds later.
+    """
+
+    def __init__(self, ttl=3600, stale_ttl=86400, error_ttl=300, max_size=10000, errors=(Exception,)):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.error_ttl = error_ttl
+        self.errors = errors
+        # key: (value, expires_at, stale_until)
+        self.cache = LRUCache(max_size)
+        # Keys being loaded in background threads, with their thread
+        self.refreshing = {}
+        self._lock = RLock()
+        self.hits = self.stale_hits = self.misses = self.errors_count = 0
+        self.loads = 0
+        self.load_time = 0.0
+
+    def stats(self):
+        """Return the counters, with the average load time in seconds."""
+        return {
+            'hits': self.hits,
+            'stale_hits': self.stale_hits,
+            'misses': self.misses,
+            'errors': self.errors_count,
+            'average_load_time': self.load_time / self.loads if self.loads else 0.0,
+        }
+
+    def _load(self, key, loader):
+        """Call loader and cache its result, or None on failure unless a stale value can still be served."""
+        start = time()
+        try:
+            value, error = loader(), False
+        except self.errors:
+            value, error = None, True
+        finally:
+            end = time()
+            with self._lock:
+                self.loads += 1
+                self.load_time += end - start
+                # Even on unexpected errors, so that the key is refreshed again
+                self.refreshing.pop(key, None)
+        if not error:
+            entry = (value, end + self.ttl, end + self.ttl + self.stale_ttl)
+        else:
+            self.errors_count += 1
+            entry = self.cache.get(key)
+            if entry is not None and entry[0] is not None and end < entry[2]:
+                entry = (entry[0], min(end + self.error_ttl, entry[2]), entry[2])
+            else:
+                entry = (None, end + self.error_ttl, end + self.error_ttl)
+            value = entry[0]
+        self.cache.set(key, entry)
+        return value
+
+    def _refresh(self, key, loader):
+        with self._lock:
+            if key in self.refreshing:
+                return
+            thread = self.refreshing[key] = Thread(target=self._load, args=(key, loader))
+        thread.daemon = True
+        thread.start()
+
+    def get(self, key, loader, now=None):
+        """Return the value cached for key, calling loader() to get it if needed."""
+        if now is None:
+            now = time()
+        entry = self.cache.get(key)
+        if entry is not None:
+            value, expires_at, stale_until = entry
+            if now < expires_at:
+                self.hits += 1
+                return value
+            if now < stale_until and value is not None:
+                self.stale_hits += 1
+                self._refresh(key, loader)
+                return value
+        self.misses += 1
+        return self._load(key, loader)
+
+    def join(self):
+        """Wait for the running background refreshes."""
+        with self._lock:
+            threads = self.refreshing.values()
+        for thread in threads:
+            thread.join()
+
+    def clear(self):
+        self.cache.clear()
+
+
+class DjangoCacheBackend(object):
+    """Same interface as LRUCache, over one of settings.CACHES."""
+    local = False
+
+    def __init__(self, alias='default', timeout=None):
+        self.cache = get_cache(alias)
+        self.timeout = timeout
+
+    def get(self, key, default=None):
+        return self.cache.get(key, default)
+
+    def get_many(self, keys):
+        return self.cache.get_many(keys)
+
+    def set(self, key, value):
+        self.cache.set(key, value, self.timeout)
+
+    def set_many(self, data):
+        self.cache.set_many(data, self.timeout)
+
+    def add(self, key, value):
+        """Set key if missing, return whether it was."""
+        return self.cache.add(key, value, self.timeout)
+
+    def delete(self, key):
+        self.cache.delete(key)
+
+    def clear(self):
+        self.cache.clear()
+
+
+def model_label(model):
+    """Return 'app_label.ObjectName' for the concrete class of model."""
+    opts = model._meta.concrete_model._meta
+    return '{0}.{1}'.format(opts.app_label, opts.object_name)
+
+
+class SerializationCache(object):
+    """
+    Versioned cache for Model.to_dict results.
+
+    Each row has a version, replaced whenever it is saved or deleted. An entry
+    records the versions of every object it was built from (including related
+    objects serialized through recursion), and is only served while all of
+    them are unchanged. Missing versions are never recreated equal, so evicted
+    versions can't revive stale entries.
+
+    Versions hold the time they were made at, and an entry is only stored if
+    its versions are older than the rows it was built from: a dict built from
+    rows read before a save is never cached under the version of that save.
+    """
+    prefix = 'to_dict'
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+    def version_key(self, model, pk):
+        return '{0}:v:{1}:{2}'.format(self.prefix, model_label(model), pk)
+
+    def key(self, obj, plan, spec):
+        """Return the cache key of obj serialized with plan and spec."""
+        digest = md5(json.dumps([sorted(plan.fields), spec], sort_keys=True)).hexdigest()
+        return '{0}:{1}:{2}:{3}'.format(self.prefix, model_label(obj.__class__), obj.pk, digest)
+
+    @staticmethod
+    def new_version():
+        return ('%08x' % getrandbits(32), time())
+
+    def get(self, key):
+        """Return the cached dict for key, None if missing, stale or expired."""
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys):
+        """
+        Return {key: dict} for the keys cached, fresh and not expired, with
+        one backend lookup for the entries and one for their versions.
+        """
+        entries = self.backend.get_many(keys)
+        version_keys = set(version_key for versions, value, expires_at in entries.itervalues() for version_key in versions)
+        current = self.backend.get_many(list(version_keys)) if version_keys else {}
+        now = time()
+        found = {}
+        for key, (versions, value, expires_at) in entries.iteritems():
+            if expires_at is not None and now >= expires_at:
+                continue
+            if all(current.get(version_key) == version for version_key, version in versions.iteritems()):
+                found[key] = pickle.loads(value) if self.backend.local else value
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    def set(self, key, value, dependencies, read_at, expires_at=None):
+        """
+        Cache value for key, until expires_at (a timestamp) if given.
+
+        dependencies are the (model, pk) of every object value was built from,
+        read_at the time their rows were read at. Return the version keys
+        missing, see set_many.
+        """
+        return self.set_many([(key, value, dependencies, read_at, expires_at)])
+
+    def set_many(self, items):
+        """
+        Cache (key, value, dependencies, read_at, expires_at) items as set does,
+        in two backend calls at most.
+
+        Items depending on versions made after read_at, or missing, are not
+        cached. The missing version keys are returned, to be made by
+        add_versions: the next dicts built from rows read after that are cached.
+        """
+        dependency_keys = dict(
+            (key, [self.version_key(model, pk) for model, pk in dependencies if model is not None])
+            for key, value, dependencies, read_at, expires_at in items)
+        keys = set(version_key for keys_ in dependency_keys.itervalues() for version_key in keys_)
+        versions = self.backend.get_many(list(keys)) if keys else {}
+        data = {}
+        for key, value, dependencies, read_at, expires_at in items:
+            if not all(key_ in versions and versions[key_][1] <= read_at for key_ in dependency_keys[key]):
+                continue
+            if self.backend.local:
+                value = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+            data[key] = (dict((key_, versions[key_]) for key_ in dependency_keys[key]), value, expires_at)
+        if data:
+            self.backend.set_many(data)
+        return keys.difference(versions)
+
+    def add_versions(self, version_keys):
+        """Make the missing version keys returned by set_many."""
+        if version_keys:
+            self.backend.set_many(dict((key, self.new_version()) for key in version_keys))
+
+    def bump(self, model, pk):
+        """Invalidate every entry built from the object model/pk."""
+        self.backend.set(self.version_key(model, pk), self.new_version())
+
+
+_cache = []
+
+
+def get_serialization_cache():
+    """
+    Return the SerializationCache configured by settings.SERIALIZATION_CACHE, if any.
+
+    SERIALIZATION_CACHE = {'BACKEND': 'local', 'MAX_SIZE': 1000}
+    SERIALIZATION_CACHE = {'BACKEND': 'django', 'CACHE': 'default', 'TIMEOUT': 3600}
+    """
+    if not _cache:
+        config = getattr(settings, 'SERIALIZATION_CACHE', None)
+        if not config:
+            cache = None
+        elif config.get('BACKEND', 'local') == 'local':
+            cache = SerializationCache(LRUCache(config.get('MAX_SIZE', 1000)))
+        else:
+            cache = SerializationCache(DjangoCacheBackend(config.get('CACHE', 'default'), config.get('TIMEOUT')))
+        _cache.append(cache)
+    return _cache[0]
+
+
+@receiver(setting_changed)
+def reset_serialization_cache(sender, setting, **kwargs):
+    if setting == 'SERIALIZATION_CACHE':
+        del _cache[:]
+
+
+def mark_read(instance):
+    """Record that instance holds its row as of now, see SerializationCache.set_many."""
+    instance._read_at = time()
+
+
+def _bump(cache, model, pk):
+    # Multi-table inheritance parents share the row's primary key
+    for model_ in [model] + list(model._meta.get_parent_list()):
+        cache.bump(model_, pk)
+
+
+@receiver(post_save)
+@receiver(post_delete)
+def invalidate_serialized(sender, instance, **kwargs):
+    """
+    Bump the version of a saved or deleted commons.models.Model, and of the
+    objects its foreign keys point to, whose related managers changed.
+    """
+    cache = get_serialization_cache()
+    if cache is None or not hasattr(instance, 'get_serialization_plan'):
+        return
+    _bump(cache, sender, instance.pk)
+    for field in sender._meta.fields:
+        if field.rel and getattr(instance, field.attname) is not None:
+            _bump(cache, field.rel.to, getattr(instance, field.attname))
+    # The instance holds what was just written
+    mark_read(instance)
+
+
+@receiver(m2m_changed)
+def invalidate_serialized_m2m(sender, instance, action, model, pk_set, **kwargs):
+    """Bump the versions of both sides of a changed many to many relation."""
+    cache = get_serialization_cache()
+    if cache is None or not hasattr(instance, 'get_serialization_plan') or not action.startswith('post_'):
+        return
+    _bump(cache, instance.__class__, instance.pk)
+    for pk in pk_set or ():
+        _bump(cache, model, pk)
@@ -0,0 +1,388 @@
+from codecs import utf_8_encode as _utf8_encode
+from struct import Struct
+
+import simplejson as json
+
+# Bytes accumulated before being handed to the response or file
+BUFFER_SIZE = 64 * 1024
+
+
+def _buffered(chunks, buffer_size=BUFFER_SIZE):
+    """Join small chunks so each yielded string is about buffer_size long."""
+    buffer_, size = [], 0
+    for chunk in chunks:
+        buffer_.append(chunk)
+        size += len(chunk)
+        if size >= buffer_size:
+            yield ''.join(buffer_)
+            buffer_, size = [], 0
+    if buffer_:
+        yield ''.join(buffer_)
+
+
+def iter_json(dicts, buffer_size=BUFFER_SIZE):
+    """Encode an iterable of dicts as a JSON array, one piece at a time."""
+    def chunks():
+        yield '['
+        separator = ''
+        for _dict in dicts:
+            yield separator
+            yield json.dumps(_dict)
+            separator = ', '
+        yield ']'
+    return _buffered(chunks(), buffer_size)
+
+
+def iter_jsonl(dicts, buffer_size=BUFFER_SIZE):
+    """Encode an iterable of dicts as JSON lines, one piece at a time."""
+    return _buffered((json.dumps(_dict) + '\n' for _dict in dicts), buffer_size)
+
+
+class Encoder(object):
+    """
+    Base class of output encoders.
+
+    encode/decode handle a single value, iter_encode a stream of dicts.
+    """
+    name = None
+    content_type = None
+    extension = None
+
+    def encode(self, obj):
+        raise NotImplementedError
+
+    def decode(self, data):
+        raise NotImplementedError
+
+    def iter_encode(self, dicts, buffer_size=BUFFER_SIZE):
+        return _buffered((self.encode(_dict) for _dict in dicts), buffer_size)
+
+
+class JSONEncoder(Encoder):
+    name = 'json'
+    content_type = 'application/json'
+    extension = 'json'
+
+    def encode(self, obj):
+        return json.dumps(obj)
+
+    def decode(self, data):
+        return json.loads(data)
+
+    def iter_encode(self, dicts, buffer_size=BUFFER_SIZE):
+        return iter_json(dicts, buffer_size)
+
+
+class JSONLinesEncoder(JSONEncoder):
+    """Encode lists as one JSON document per line, other values as a single line."""
+    name = 'jsonl'
+    content_type = 'application/x-ndjson'
+    extension = 'jsonl'
+
+    def encode(self, obj):
+        if isinstance(obj, dict) or not hasattr(obj, '__iter__'):
+            return json.dumps(obj) + '\n'
+        return ''.join(iter_jsonl(obj))
+
+    def decode(self, data):
+        return [json.loads(line) for line in data.splitlines()]
+
+    def iter_encode(self, dicts, buffer_size=BUFFER_SIZE):
+        return iter_jsonl(dicts, buffer_size)
+
+
+_pack_uint32 = Struct('>I').pack
+_pack_int64 = Struct('>q').pack
+_pack_double = Struct('>d').pack
+_unpack_uint32 = Struct('>I').unpack_from
+_unpack_int8 = Struct('>b').unpack_from
+_unpack_int64 = Struct('>q').unpack_from
+_unpack_double = Struct('>d').unpack_from
+
+# Encoded small integers, tag included
+_INT8 = dict((i, 'b' + chr(i & 0xff)) for i in xrange(-128, 128))
+
+# Encoded string keys of dicts by key, and decoded ones by encoding,
+# each reset when it grows over _MAX_KEYS
+_KEYS = {}
+_DECODED_KEYS = {}
+_MAX_KEYS = 10000
+
+
+def _header(short_tag, long_tag, length):
+    if length < 256:
+        return short_tag + chr(length)
+    return long_tag + _pack_uint32(length)
+
+
+# Encoding functions, append(obj's encoding) each, dispatched on the type of
+# values by _PACKERS: one dict lookup and one call per value
+
+def _pack_none(obj, append):
+    append('N')
+
+
+def _pack_bool(obj, append):
+    append('T' if obj else 'F')
+
+
+def _pack_int(obj, append):
+    if -128 <= obj < 128:
+        append(_INT8[obj])
+    elif -2 ** 63 <= obj < 2 ** 63:
+        append('q' + _pack_int64(obj))
+    else:
+        obj = str(obj)
+        append(_header('g', 'G', len(obj)) + obj)
+
+
+def _pack_float(obj, append):
+    append('d' + _pack_double(obj))
+
+
+def _pack_bytes(obj, append):
+    append(_header('s', 'S', len(obj)) + obj)
+
+
+def _pack_unicode(obj, append):
+    obj = _utf8_encode(obj)[0]
+    append(_header('s', 'S', len(obj)) + obj)
+
+
+def _pack_dict(obj, append):
+    append(_header('m', 'M', len(obj)))
+    packers, keys = _PACKERS, _KEYS
+    for key, value in obj.iteritems():
+        # String keys repeat from dict to dict
+        if key.__class__ is unicode or key.__class__ is str:
+            try:
+                append(keys[key])
+            except KeyError:
+                chunks = []
+                packers[key.__class__](key, chunks.append)
+                if len(keys) >= _MAX_KEYS:
+                    keys.clear()
+                append(keys.setdefault(key, ''.join(chunks)))
+        else:
+            packers[key.__class__](key, append)
+        # The most common values inline
+        cls = value.__class__
+        if cls is unicode:
+            value, cls = _utf8_encode(value)[0], str
+        if cls is str:
+            if len(value) < 256:
+                append('s' + chr(len(value)) + value)
+            else:
+                append('S' + _pack_uint32(len(value)) + value)
+        elif value is None:
+            append('N')
+        elif value is True:
+            append('T')
+        elif value is False:
+            append('F')
+        else:
+            packers[cls](value, append)
+
+
+def _pack_list(obj, append):
+    append(_header('l', 'L', len(obj)))
+    packers = _PACKERS
+    for value in obj:
+        packers[value.__class__](value, append)
+
+
+class _Packers(dict):
+    """Encoding function by type, resolved once for subclasses of the supported types."""
+    bases = ((bool, _pack_bool), ((int, long), _pack_int), (float, _pack_float), (unicode, _pack_unicode),
+             (str, _pack_bytes), (dict, _pack_dict), ((list, tuple), _pack_list))
+
+    def __missing__(self, type_):
+        for bases, packer in self.bases:
+            if issubclass(type_, bases):
+                self[type_] = packer
+                return packer
+        raise TypeError('%r is not encodable.' % type_)
+
+
+_PACKERS = _Packers({type(None): _pack_none, bool: _pack_bool, int: _pack_int, long: _pack_int, float: _pack_float,
+                     str: _pack_bytes, unicode: _pack_unicode, dict: _pack_dict, list: _pack_list, tuple: _pack_list})
+
+
+# Decoding functions, return (value, offset after it) for the value whose tag
+# is right before offset, dispatched on tags by _UNPACKERS
+
+def _unpack_string(data, offset):
+    end = offset + 1 + ord(data[offset])
+    return unicode(data[offset + 1:end], 'utf-8'), end
+
+
+def _unpack_long_string(data, offset):
+    end = offset + 4 + _unpack_uint32(data, offset)[0]
+    return unicode(data[offset + 4:end], 'utf-8'), end
+
+
+def _unpack_items(data, offset, length):
+    obj = {}
+    unpackers, keys = _UNPACKERS, _DECODED_KEYS
+    for _ in xrange(length):
+        # Short strings inline, the most common keys and values
+        if data[offset] == 's':
+            end = offset + 2 + ord(data[offset + 1])
+            raw = data[offset + 2:end]
+            try:
+                key = keys[raw]
+            except KeyError:
+                if len(keys) >= _MAX_KEYS:
+                    keys.clear()
+                key = keys.setdefault(raw, unicode(raw, 'utf-8'))
+            offset = end
+        else:
+            key, offset = unpackers[data[offset]](data, offset + 1)
+        tag = data[offset]
+        if tag == 's':
+            end = offset + 2 + ord(data[offset + 1])
+            obj[key], offset = unicode(data[offset + 2:end], 'utf-8'), end
+        elif tag in _CONSTANTS:
+            obj[key], offset = _CONSTANTS[tag], offset + 1
+        else:
+            obj[key], offset = unpackers[tag](data, offset + 1)
+    return obj, offset
+
+
+def _unpack_map(data, offset):
+    return _unpack_items(data, offset + 1, ord(data[offset]))
+
+
+def _unpack_long_map(data, offset):
+    return _unpack_items(data, offset + 4, _unpack_uint32(data, offset)[0])
+
+
+def _unpack_values(data, offset, length):
+    obj = []
+    append = obj.append
+    unpackers = _UNPACKERS
+    for _ in xrange(length):
+        value, offset = unpackers[data[offset]](data, offset + 1)
+        append(value)
+    return obj, offset
+
+
+def _unpack_list(data, offset):
+    return _unpack_values(data, offset + 1, ord(data[offset]))
+
+
+def _unpack_long_list(data, offset):
+    return _unpack_values(data, offset + 4, _unpack_uint32(data, offset)[0])
+
+
+def _unpack_big_int(data, offset):
+    end = offset + 1 + ord(data[offset])
+    return int(data[offset + 1:end]), end
+
+
+def _unpack_long_big_int(data, offset):
+    end = offset + 4 + _unpack_uint32(data, offset)[0]
+    return int(data[offset + 4:end]), end
+
+
+_CONSTANTS = {'N': None, 'T': True, 'F': False}
+
+_UNPACKERS = {
+    's': _unpack_string, 'S': _unpack_long_string,
+    'm': _unpack_map, 'M': _unpack_long_map,
+    'l': _unpack_list, 'L': _unpack_long_list,
+    'b': lambda data, offset: (_unpack_int8(data, offset)[0], offset + 1),
+    'q': lambda data, offset: (_unpack_int64(data, offset)[0], offset + 8),
+    'd': lambda data, offset: (_unpack_double(data, offset)[0], offset + 8),
+    'g': _unpack_big_int, 'G': _unpack_long_big_int,
+    'N': lambda data, offset: (None, offset),
+    'T': lambda data, offset: (True, offset),
+    'F': lambda data, offset: (False, offset),
+}
+
+
+class PackedEncoder(Encoder):
+    """
+    Compact, length-prefixed binary encoding in the spirit of msgpack.
+
+    Every value starts with a one byte tag, strings and containers with their
+    length (one byte when short, four otherwise), numbers are packed big endian.
+    Strings are encoded as utf-8 and decoded as unicode, like with JSON.
+    A stream is made of encoded values one after the other.
+    """
+    name = 'packed'
+    content_type = 'application/x-packed'
+    extension = 'bin'
+
+    def encode(self, obj):
+        chunks = []
+        _PACKERS[obj.__class__](obj, chunks.append)
+        return ''.join(chunks)
+
+    def decode(self, data):
+        obj, offset = self._decode(data, 0)
+        return obj
+
+    def decode_stream(self, data):
+        """Return the list of values encoded one after the other in data."""
+        values, offset = [], 0
+        while offset < len(data):
+            obj, offset = self._decode(data, offset)
+            values.append(obj)
+        return values
+
+    def _decode(self, data, offset):
+        try:
+            return _UNPACKERS[data[offset]](data, offset + 1)
+        except KeyError, e:
+            raise ValueError('Invalid tag %r.' % e.args[0])
+
+
+# Registered encoders, by name
+ENCODERS = {}
+
+
+def register_encoder(encoder):
+    """Make encoder (an Encoder instance) available by its name and content type."""
+    ENCODERS[encoder.name] = encoder
+    return encoder
+
+
+def get_encoder(name):
+    """Return the registered encoder named name, raise KeyError if there is none."""
+    return ENCODERS[name]
+
+
+def negotiate_encoder(request, default='json'):
+    """
+    Return the encoder to use for request.
+
+    An explicit ?format=name wins, unknown names raise KeyError. Otherwise
+    the Accept header is matched against registered content types, by
+    decreasing quality, falling back to the default encoder.
+    """
+    if 'format' in request.GET:
+        return get_encoder(request.GET['format'])
+
+    by_content_type = dict((encoder.content_type, encoder) for encoder in ENCODERS.itervalues())
+    accepted = []
+    for position, media_range in enumerate(request.META.get('HTTP_ACCEPT', '').split(',')):
+        params = media_range.strip().split(';')
+        quality = 1.0
+        for param in params[1:]:
+            name, _, value = param.strip().partition('=')
+            if name == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted.append((-quality, position, params[0].strip()))
+    for quality, position, content_type in sorted(accepted):
+        if quality < 0 and content_type in by_content_type:
+            return by_content_type[content_type]
+    return get_encoder(default)
+
+
+register_encoder(JSONEncoder())
+register_encoder(JSONLinesEncoder())
+register_encoder(PackedEncoder())
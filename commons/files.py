@@ -0,0 +1,172 @@
+from contextlib import contextmanager
+from threading import Lock, local
+from time import time
+
+from django.conf import settings
+from django.dispatch import receiver
+from django.test.signals import setting_changed
+from django.utils.encoding import filepath_to_uri
+from django.utils.functional import LazyObject
+
+from commons.cache import LRUCache
+
+
+class FileURLResolver(object):
+    """
+    Resolve the urls of stored files without paying for signing on every call.
+
+    - Storages whose bucket is listed in public_urls get urls built from that
+      base url (public bucket or CDN), without any signing.
+    - Urls of storages signing them (S3BotoStorage's querystring_auth) are
+      cached until `margin` seconds before they expire.
+    - Other storages are asked for the url directly.
+    """
+
+    def __init__(self, public_urls=None, max_size=10000, margin=300):
+        self.public_urls = public_urls or {}
+        self.margin = margin
+        self.cache = LRUCache(max_size)
+        self._local = local()
+
+    @contextmanager
+    def tracking(self):
+        """
+        Collect, in the list yielded, the times at which the signed urls
+        resolved by this thread within the block are refreshed, i.e. `margin`
+        seconds before they expire. Values holding these urls should not be
+        kept past the earliest one.
+        """
+        if not hasattr(self._local, 'tracked'):
+            self._local.tracked = []
+        refresh_times = []
+        self._local.tracked.append(refresh_times)
+        try:
+            yield refresh_times
+        finally:
+            self._local.tracked.pop()
+
+    def _track(self, refresh_at):
+        for refresh_times in getattr(self._local, 'tracked', ()):
+            refresh_times.append(refresh_at)
+
+    @staticmethod
+    def _key_name(storage, name):
+        """Return the name of the stored object, with the storage location."""
+        if hasattr(storage, '_normalize_name'):
+            return storage._normalize_name(storage._clean_name(name))
+        return name
+
+    def resolve(self, storage, name, now=None):
+        """Return the url of the file stored in storage as name."""
+        bucket = getattr(storage, 'bucket_name', None)
+        if bucket in self.public_urls:
+            return self.public_urls[bucket].rstrip('/') + '/' + filepath_to_uri(self._key_name(storage, name))
+        if not getattr(storage, 'querystring_auth', False):
+            return storage.url(name)
+
+        if now is None:
+            now = time()
+        key = (bucket, self._key_name(storage, name))
+        cached = self.cache.get(key)
+        if cached is None or cached[1] <= now:
+            cached = (storage.url(name), now + storage.querystring_expire - self.margin)
+            self.cache.set(key, cached)
+        self._track(cached[1])
+        return cached[0]
+
+    def url(self, file_):
+        """Return the url of a FieldFile, None if it is empty."""
+        return self.resolve(file_.storage, file_.name) if file_ else None
+
+    def urls(self, files):
+        """Return the urls of a list of FieldFiles, with None for empty ones."""
+        now = time()
+        urls = {}
+        for file_ in files:
+            if file_ and (id(file_.storage), file_.name) not in urls:
+                urls[id(file_.storage), file_.name] = self.resolve(file_.storage, file_.name, now)
+        return [urls[id(file_.storage), file_.name] if file_ else None for file_ in files]
+
+
+_resolver = []
+
+
+def get_file_url_resolver():
+    """Return the FileURLResolver configured by settings."""
+    if not _resolver:
+        _resolver.append(FileURLResolver(
+            public_urls=getattr(settings, 'AWS_PUBLIC_URLS', None),
+            max_size=getattr(settings, 'FILE_URL_CACHE_SIZE', 10000),
+            margin=getattr(settings, 'FILE_URL_EXPIRY_MARGIN', 300)))
+    return _resolver[0]
+
+
+@receiver(setting_changed)
+def reset_file_url_resolver(sender, setting, **kwargs):
+    if setting in ('AWS_PUBLIC_URLS', 'FILE_URL_CACHE_SIZE', 'FILE_URL_EXPIRY_MARGIN'):
+        del _resolver[:]
+
+
+def file_url(file_):
+    """Return the url of a FieldFile through the configured resolver, None if it is empty."""
+    return get_file_url_resolver().url(file_)
+
+
+def file_urls(files):
+    """Return the urls of a list of FieldFiles through the configured resolver."""
+    return get_file_url_resolver().urls(files)
+
+
+# S3BotoStorages by (bucket name, options)
+_s3_storages = {}
+_s3_lock = Lock()
+
+
+def _freeze(value):
+    if isinstance(value, dict):
+        return tuple(sorted((key, _freeze(item)) for key, item in value.iteritems()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+
+def get_s3_storage(bucket_name, **options):
+    """
+    Return the S3BotoStorage of bucket_name, with options overriding its
+    attributes (headers, location...). There is one storage per configuration
+    in a process, safe to share between threads, and storages with the same
+    credentials share one boto connection, i.e. its pool of HTTP connections.
+    boto is imported on the first call, and connects on the first request.
+    """
+    key = (bucket_name, _freeze(options))
+    with _s3_lock:
+        if key not in _s3_storages:
+            from commons.s3 import SharedConnectionS3BotoStorage
+            _s3_storages[key] = SharedConnectionS3BotoStorage(bucket_name=bucket_name, **options)
+        return _s3_storages[key]
+
+
+@receiver(setting_changed)
+def reset_s3_storages(sender, setting, **kwargs):
+    if setting.startswith('AWS_'):
+        with _s3_lock:
+            _s3_storages.clear()
+
+
+class LazyS3Storage(LazyObject):
+    """
+    Storage of model fields, standing for get_s3_storage(bucket_name, **options)
+    until it is first used, so that importing models does not import boto.
+    """
+
+    def __init__(self, bucket_name, **options):
+        super(LazyS3Storage, self).__init__()
+        self.__dict__['bucket_name_'] = bucket_name
+        self.__dict__['options'] = options
+
+    def _setup(self):
+        self._wrapped = get_s3_storage(self.bucket_name_, **self.options)
+
+    def __deepcopy__(self, memo):
+        # Copies share the storage, without creating it
+        return self
@@ -0,0 +1,54 @@
+from optparse import make_option
+from timeit import default_timer
+
+from django.core.management.base import BaseCommand
+
+from commons.encoders import ENCODERS
+
+
+def sample_dicts(count):
+    """Return dicts shaped like serialized users, with a nested foreign key."""
+    return [{
+        'id': i,
+        'email': u'user%d@example.com' % i,
+        'name': u'User %d' % i,
+        'slug': u'user-%d' % i,
+        'is_active': True,
+        'is_staff': False,
+        'is_superuser': False,
+        'created_at': '2013-12-03 10:%02d:%02d.123456+00:00' % (i / 60 % 60, i % 60),
+        'last_login': '2014-01-15 18:%02d:%02d.654321+00:00' % (i / 60 % 60, i % 60),
+        'avatar': u'https://cdn.example.com/uploads/%030d.jpeg' % i,
+        'small_avatar': None,
+        'fb_id': 100000000000 + i,
+        'company': {'id': i % 10, 'name': u'Company %d' % (i % 10), 'created_at': '2012-06-01 00:00:00+00:00'},
+    } for i in xrange(count)]
+
+
+def best_of(rounds, func, *args):
+    best = None
+    for _ in xrange(rounds):
+        start = default_timer()
+        func(*args)
+        elapsed = default_timer() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+class Command(BaseCommand):
+    help = 'Compare size and encode/decode time of registered encoders on serialized users.'
+    option_list = BaseCommand.option_list + (
+        make_option('--count', type='int', default=1000, help='Number of dicts encoded per round.'),
+        make_option('--rounds', type='int', default=5, help='Number of rounds, the best one is kept.'),
+    )
+
+    def handle(self, *args, **options):
+        dicts = sample_dicts(options['count'])
+        self.stdout.write('{0:>8} {1:>10} {2:>12} {3:>12}'.format('encoder', 'bytes', 'encode ms', 'decode ms'))
+        for name, encoder in sorted(ENCODERS.iteritems()):
+            data = encoder.encode(dicts)
+            assert encoder.decode(data) == dicts
+            self.stdout.write('{0:>8} {1:>10} {2:>12.2f} {3:>12.2f}'.format(
+                name, len(data),
+                best_of(options['rounds'], encoder.encode, dicts) * 1000,
+                best_of(options['rounds'], encoder.decode, data) * 1000))
@@ -1,8 +1,31 @@
 from datetime import datetime, date, time, timedelta
+from itertools import islice
+from time import time as timestamp
 
+from django.core.exceptions import ObjectDoesNotExist
 from django.db import models
+from django.db.models.constants import LOOKUP_SEP
+from django.db.models.loading import app_cache_ready
 from django.db.models.manager import Manager
+from django.db.models.query import QuerySet, prefetch_related_objects
 from django.db.models.fields.files import FieldFile
+from django.db.models.signals import class_prepared
+from django.dispatch import receiver
+
+from commons.cache import get_serialization_cache, mark_read
+from commons.files import file_url, get_file_url_resolver
+
+DATE_TYPES = (datetime, date, time, timedelta)
+
+# Serialization steps kinds
+PLAIN, DATE, FILE, RELATED, DYNAMIC = range(5)
+
+# Objects fetched at once to prefetch their related managers
+PREFETCH_CHUNK_SIZE = 100
+
+# Compiled plans, keyed by (model class, fields, exclude)
+_plans = {}
+
 
 def get_attr(obj, _attribute):
     """
@@ -17,61 +40,361 @@ def get_attr(obj, _attribute):
     return (_attribute, getattr(obj, _attribute))
 
 
+class SerializationPlan(object):
+    """
+    Field by field instructions to turn instances of a model into dicts.
+
+    All the introspection Model.to_dict used to do on every call is done once
+    here: resolving field names, underscore aliasing (`_avatar` -> `avatar`),
+    include/exclude sets and the converter to apply on each value.
+    """
+
+    def __init__(self, model, fields=None, exclude=None):
+        opts = model._meta
+        all_fields = set(opts.get_all_field_names())
+        # Private non-editable columns (e.g. `_subclass`) are bookkeeping, only serialized when asked for
+        bookkeeping = set(f.name for f in opts.fields if f.name.startswith('_') and not f.editable)
+        fields = set(fields) & all_fields if fields else all_fields - bookkeeping
+        exclude = set(exclude) & all_fields if exclude else set()
+        self.model = model
+        self.fields = frozenset(fields - exclude)
+        self.exclude = frozenset(exclude)
+        # Attributes set on instances by Model.__init__
+        attnames = set(f.attname for f in opts.fields)
+
+        self.steps = []
+        # Relations followed by to_dict, as (name, related model)
+        self.joins = []
+        # Related managers, only serialized on demand, as {name: (accessor, related model)}
+        self.many = {}
+        for name in sorted(self.fields):
+            field, _, direct, m2m = opts.get_field_by_name(name)
+            if not direct and not m2m and field.field.rel.parent_link:
+                # Subclasses sharing the row (multi-table inheritance), not related objects
+                continue
+            if m2m or not (direct or isinstance(field.field, models.OneToOneField)):
+                related_model = field.rel.to if direct else field.model
+                if hasattr(related_model, 'get_serialization_plan'):
+                    self.many[name] = (field.name if direct else field.get_accessor_name(), related_model)
+                continue
+            if not (name in attnames or hasattr(model, name)):
+                # Reverse relations only reachable through their accessor
+                continue
+            attribute = name[1:] if name.startswith('_') else None
+            if attribute and (attribute in attnames or hasattr(model, attribute)):
+                kind = DYNAMIC
+            else:
+                attribute, kind = name, self._kind(field, direct)
+                if kind == RELATED:
+                    self.joins.append((name, field.rel.to if direct else field.model))
+            self.steps.append((attribute, kind))
+
+    @staticmethod
+    def _kind(field, direct):
+        if not direct or isinstance(field, models.ForeignKey):
+            return RELATED
+        if isinstance(field, models.FileField):
+            return FILE
+        if isinstance(field, (models.DateField, models.TimeField)):
+            return DATE
+        return PLAIN
+
+    def select_related_paths(self, seen=frozenset()):
+        """
+        Return the select_related lookups fetching every object to_dict recurses into.
+
+        Joins stop on models already seen along a path, deeper objects are lazily loaded.
+        """
+        seen = seen | set([self.model])
+        paths = []
+        for name, model in self.joins:
+            paths.append(name)
+            if model not in seen and hasattr(model, 'get_serialization_plan'):
+                paths.extend(name + LOOKUP_SEP + path for path in model.get_serialization_plan().select_related_paths(seen))
+        return paths
+
+    def _relations(self):
+        relations = dict((name, (name, model)) for name, model in self.joins)
+        relations.update(self.many)
+        return relations
+
+    def related_spec(self, related=None, depth=None):
+        """
+        Return related managers to serialize as a nested {name: spec} dict.
+
+        related is a list of lookups such as 'other__model' (or an already
+        built spec), depth the maximum number of relations followed from this
+        model. Without related, every related manager is followed up to depth.
+        """
+        if isinstance(related, dict):
+            spec = related
+        elif related:
+            spec = {}
+            for lookup in related:
+                plan, sub_spec = self, spec
+                for name in lookup.split(LOOKUP_SEP):
+                    relations = plan.model.get_serialization_plan()._relations()
+                    if name not in relations:
+                        raise ValueError(
+                            "%s has no serializable relation named %r, %r is an invalid related lookup."
+                            % (plan.model.__name__, name, lookup))
+                    plan, sub_spec = relations[name][1].get_serialization_plan(), sub_spec.setdefault(name, {})
+        elif depth:
+            spec = {}
+            for name, (accessor, model) in self._relations().iteritems():
+                sub_spec = model.get_serialization_plan().related_spec(depth=depth - 1)
+                if sub_spec or name in self.many:
+                    spec[name] = sub_spec
+            return spec
+        else:
+            return {}
+        return _truncate_spec(spec, depth) if depth is not None else spec
+
+    def prefetch_lookups(self, spec):
+        """Return the prefetch_related lookups loading every related manager of spec."""
+        lookups = []
+        relations = self._relations()
+        for name, sub_spec in spec.iteritems():
+            if name not in relations:
+                continue
+            accessor, model = relations[name]
+            sub_lookups = model.get_serialization_plan().prefetch_lookups(sub_spec) if sub_spec else []
+            lookups.extend(accessor + LOOKUP_SEP + lookup for lookup in sub_lookups)
+            if name in self.many and not sub_lookups:
+                lookups.append(accessor)
+        return lookups
+
+    def serialize(self, obj, stop, chain, spec=None):
+        """Return obj as a json-encodable dict, in a single pass over the steps."""
+        _dict = {}
+        spec = spec or {}
+        for attribute, kind in self.steps:
+            try:
+                value = getattr(obj, attribute)
+            except (AttributeError, ObjectDoesNotExist):
+                continue
+            if kind == DYNAMIC:
+                # Properties may return anything, inspect the value itself
+                if isinstance(value, Manager):
+                    continue
+                elif isinstance(value, models.Model):
+                    kind = RELATED
+                elif isinstance(value, FieldFile):
+                    kind = FILE
+                elif isinstance(value, DATE_TYPES):
+                    kind = DATE
+            if kind == RELATED and isinstance(value, models.Model):
+                if stop:
+                    # Stop recursion
+                    continue
+                value = value.to_dict(chain=chain, related=spec.get(attribute))
+            elif kind == FILE:
+                value = file_url(value)
+            elif kind == DATE and isinstance(value, DATE_TYPES):
+                value = str(value)
+            _dict[attribute] = value
+
+        if stop or obj.pk is None:
+            return _dict
+        for name, sub_spec in spec.iteritems():
+            if name not in self.many:
+                continue
+            # Served from the prefetched objects cache when available
+            objects = list(getattr(obj, self.many[name][0]).all())
+            values = [o.to_dict(chain=chain, related=sub_spec) for o in objects if o.serialization_key() not in chain]
+            # Partial lists would be misleading, drop them
+            if len(values) == len(objects):
+                _dict[name] = values
+        return _dict
+
+
+def _truncate_spec(spec, depth):
+    """Return spec without relations deeper than depth."""
+    if depth <= 0:
+        return {}
+    return dict((name, _truncate_spec(sub_spec, depth - 1)) for name, sub_spec in spec.iteritems())
+
+
+def _flatten_select_related(field_dict, prefix=''):
+    """Return the lookups stored in a query's select_related dict."""
+    paths = []
+    for name, sub_dict in field_dict.iteritems():
+        paths.append(prefix + name)
+        paths.extend(_flatten_select_related(sub_dict, prefix + name + LOOKUP_SEP))
+    return paths
+
+
+def _chunks(queryset, chunk_size=None):
+    """
+    Yield the objects of queryset as lists.
+
+    With chunk_size, rows are fetched by batches ordered by primary key
+    (unless the queryset is sliced), otherwise from a single query.
+    """
+    if not chunk_size or not queryset.query.can_filter():
+        iterator = queryset.iterator()
+        chunk = list(islice(iterator, chunk_size or PREFETCH_CHUNK_SIZE))
+        while chunk:
+            yield chunk
+            chunk = list(islice(iterator, chunk_size or PREFETCH_CHUNK_SIZE))
+        return
+
+    queryset = queryset.order_by('pk')
+    chunk = list(queryset[:chunk_size].iterator())
+    while chunk:
+        yield chunk
+        if len(chunk) < chunk_size:
+            break
+        chunk = list(queryset.filter(pk__gt=chunk[-1].pk)[:chunk_size].iterator())
+
+
+def _serialize(plan, obj, spec, track=False):
+    """
+    Return (dict, dependencies, expires_at) for obj serialized by plan.
+    With track, expires_at is the time the first signed url the dict holds
+    is refreshed by the resolver, when it should leave caches.
+    """
+    chain = set([obj.serialization_key()])
+    if not track:
+        return plan.serialize(obj, False, chain, spec), chain, None
+    with get_file_url_resolver().tracking() as refresh_times:
+        _dict = plan.serialize(obj, False, chain, spec)
+    return _dict, chain, min(refresh_times) if refresh_times else None
+
+
+def to_dicts(queryset, fields=None, exclude=None, chunk_size=None, related=None, depth=None):
+    """
+    Yield Model.to_dict(fields, exclude, related=related, depth=depth) for each object of queryset.
+
+    Everything to_dict recurses into is joined with select_related, so each
+    chunk costs a single query, plus one query per related manager to serialize.
+    With chunk_size, rows are fetched by batches ordered by primary key, which
+    keeps memory flat on big tables.
+    """
+    plan = queryset.model.get_serialization_plan(fields, exclude)
+    paths = plan.select_related_paths()
+    if paths and queryset.query.select_related is not True:
+        if isinstance(queryset.query.select_related, dict):
+            paths += _flatten_select_related(queryset.query.select_related)
+        queryset = queryset.select_related(*paths)
+    spec = plan.related_spec(related, depth)
+    lookups = plan.prefetch_lookups(spec)
+
+    # Querysets selecting subclasses may return other models
+    plans = {queryset.model: plan}
+    cache = get_serialization_cache()
+    # With chunk_size, each chunk is read by its own query, otherwise all by the first one
+    per_chunk = chunk_size and queryset.query.can_filter()
+    read_at = timestamp()
+    for chunk in _chunks(queryset, chunk_size):
+        for obj in chunk:
+            if obj.__class__ not in plans:
+                plans[obj.__class__] = obj.get_serialization_plan(fields, exclude)
+        dicts = [None] * len(chunk)
+        if cache is not None:
+            keys = [cache.key(obj, plans[obj.__class__], spec) for obj in chunk]
+            cached = cache.get_many(keys)
+            dicts = [cached.get(key) for key in keys]
+        # Only prefetch for the objects missing from the cache
+        missing = [obj for obj, _dict in zip(chunk, dicts) if _dict is None]
+        if lookups and missing:
+            prefetch_related_objects(missing, lookups)
+        serialized = []
+        for i, obj in enumerate(chunk):
+            if dicts[i] is None:
+                dicts[i], chain, expires_at = _serialize(plans[obj.__class__], obj, spec, cache is not None)
+                serialized.append((keys[i] if cache is not None else None, dicts[i], chain, read_at, expires_at))
+        if cache is not None and serialized:
+            cache.add_versions(cache.set_many(serialized))
+        for _dict in dicts:
+            yield _dict
+        if per_chunk:
+            read_at = timestamp()
+
+
+class SerializableQuerySet(QuerySet):
+    def to_dicts(self, fields=None, exclude=None, chunk_size=None, related=None, depth=None):
+        return to_dicts(self, fields, exclude, chunk_size, related, depth)
+
+
+class SerializableManagerMixin(object):
+    """Add to_dicts to a manager, whatever the class of its querysets."""
+
+    def to_dicts(self, fields=None, exclude=None, chunk_size=None, related=None, depth=None):
+        return to_dicts(self.get_query_set(), fields, exclude, chunk_size, related, depth)
+
+
+class SerializableManager(SerializableManagerMixin, Manager):
+    def get_query_set(self):
+        return SerializableQuerySet(self.model, using=self._db)
+
+
+@receiver(class_prepared)
+def clear_serialization_plans(sender, **kwargs):
+    """
+    Drop all compiled plans.
+
+    Preparing any model class may add reverse relations to already planned models.
+    """
+    _plans.clear()
+
+
 class Model(models.Model):
+    objects = SerializableManager()
+
     class Meta:
         abstract = True
 
-    def to_dict(self, fields=None, exclude=None, chain=None):
+    def __init__(self, *args, **kwargs):
+        # Dicts are only cached if no save happened since the row was read
+        mark_read(self)
+        super(Model, self).__init__(*args, **kwargs)
+
+    @classmethod
+    def get_serialization_plan(cls, fields=None, exclude=None):
+        """Return the compiled SerializationPlan for these fields and exclude."""
+        key = (cls, frozenset(fields) if fields else None, frozenset(exclude) if exclude else None)
+        try:
+            return _plans[key]
+        except KeyError:
+            plan = SerializationPlan(cls, fields, exclude)
+            # Field names are not reliable until all models are loaded
+            if app_cache_ready():
+                _plans[key] = plan
+            return plan
+
+    def serialization_key(self):
+        """Identify this object among the ones already serialized."""
+        pk = self._get_pk_val()
+        return (self._meta.concrete_model, pk) if pk is not None else (None, id(self))
+
+    def to_dict(self, fields=None, exclude=None, chain=None, related=None, depth=None):
         """
         Recursively inspect fields to produce a json-encodable dict
         representing this model.
-        """
-        # Remember all inspected models to avoid infinite recursion
-        if not chain:
-            chain = []
-        stop = self in chain
-        chain.append(self)
-
-        # Get all field names or a specified subset of it
-        all_fields = set(self._meta.get_all_field_names())
-        fields = set(fields) & all_fields if fields else all_fields
-        exclude = set(exclude) & all_fields if exclude else set()
-        fields -= exclude
-
-        # Basic dict of field_names: field_values
-        _dict = dict(get_attr(self, field) for field in fields if hasattr(self, field))
-
-        #  ==================
-        #  = Post treatment =
-        #  ==================
-        # Convert related_managers to a list of dicts of models
-        related_managers = dict((name, field) for name, field in _dict.iteritems() if isinstance(field, Manager))
-        while related_managers:
-            name, manager = related_managers.popitem()
-            # TODO : either find a faster way to get related models, or don't recurse on managers.
-            # _dict[name] = [obj.to_dict(chain=chain) for obj in manager.all() if not obj in chain]
-            # if not manager.count() == len(_dict[name]):
-            #     del _dict[name]
-            del _dict[name]
-
-        # Convert models to their dict versions
-        models_ = dict((name, field) for name, field in _dict.iteritems() if isinstance(field, models.Model))
-        while models_:
-            name, model = models_.popitem()
-            if not stop:
-                _dict[name] = model.to_dict(chain=chain)
-            else:
-                # Stop recursion
-                del _dict[name]
 
-        # Replace files by their urls
-        files = dict((name, file_.url if file_ else None) for name, file_ in _dict.iteritems() if isinstance(file_, FieldFile))
-        # files = dict((name, file_.url if file_ else None) for name, file_ in files.iteritems())
-        _dict.update(files)
-
-        # Convert dates to strings
-        dates = dict((name, str(date_)) for name, date_ in _dict.iteritems() if isinstance(date_, (datetime, date, time, timedelta)))
-        # dates = dict((name, str(date)) for name, date in dates.iteritems())
-        _dict.update(dates)
+        Related managers are only serialized when asked for, see
+        SerializationPlan.related_spec for related and depth.
+        Results are cached when settings.SERIALIZATION_CACHE is set.
+        """
+        plan = self.get_serialization_plan(fields, exclude)
+        spec = plan.related_spec(related, depth)
+        if chain is not None:
+            # Recursion, avoid infinite loops on already inspected models
+            key = self.serialization_key()
+            stop = key in chain
+            chain.add(key)
+            return plan.serialize(self, stop, chain, spec)
 
+        cache = get_serialization_cache() if self.pk is not None else None
+        if cache is not None:
+            cache_key = cache.key(self, plan, spec)
+            _dict = cache.get(cache_key)
+            if _dict is not None:
+                return _dict
+        if spec and self.pk is not None:
+            prefetch_related_objects([self], plan.prefetch_lookups(spec))
+        _dict, chain, expires_at = _serialize(plan, self, spec, cache is not None)
+        if cache is not None:
+            cache.add_versions(cache.set(cache_key, _dict, chain, self._read_at, expires_at))
         return _dict
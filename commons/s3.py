@@ -0,0 +1,34 @@
+from threading import Lock
+
+from django.dispatch import receiver
+from django.test.signals import setting_changed
+from storages.backends.s3boto import S3BotoStorage
+
+# boto connections by credentials
+_connections = {}
+_lock = Lock()
+
+
+class SharedConnectionS3BotoStorage(S3BotoStorage):
+    """
+    S3BotoStorage sharing its boto connection, and so its pool of HTTP
+    connections, with the other storages of the same credentials.
+    Use commons.files.get_s3_storage rather than this class directly.
+    """
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            key = (self.access_key, self.secret_key, self.connection_class, type(self.calling_format))
+            with _lock:
+                if key not in _connections:
+                    _connections[key] = super(SharedConnectionS3BotoStorage, self).connection
+                self._connection = _connections[key]
+        return self._connection
+
+
+@receiver(setting_changed)
+def reset_s3_connections(sender, setting, **kwargs):
+    if setting.startswith('AWS_'):
+        with _lock:
+            _connections.clear()
@@ -0,0 +1,219 @@
+from time import time
+from unittest import TestCase
+
+from django.test.utils import override_settings
+from mock import patch
+
+from commons.cache import LRUCache, RefreshingCache, DjangoCacheBackend, get_serialization_cache
+from commons.tests.TestFiles import SigningStorage
+from commons.tests.models import OtherModel1, OtherModel2, Model
+from commons.tests.test_case import AbstractModelTest
+
+
+class LRUCacheTest(TestCase):
+    def test_get_set(self):
+        cache = LRUCache()
+        cache.set('key', 'value')
+
+        self.assertEqual(cache.get('key'), 'value')
+        self.assertIsNone(cache.get('missing'))
+        self.assertEqual(cache.get_many(['key', 'missing']), {'key': 'value'})
+
+    def test_size_is_bounded(self):
+        cache = LRUCache(max_size=2)
+        cache.set_many({'a': 1, 'b': 2})
+        # 'a' becomes the most recently used key
+        cache.get('a')
+        cache.set('c', 3)
+
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get_many(['a', 'c']), {'a': 1, 'c': 3})
+
+
+class RefreshingCacheTest(TestCase):
+    def setUp(self):
+        self.cache = RefreshingCache(ttl=10, stale_ttl=100, error_ttl=5, errors=(IOError,))
+        self.calls = []
+
+    def loader(self, value):
+        def load():
+            self.calls.append(value)
+            if isinstance(value, Exception):
+                raise value
+            return value
+        return load
+
+    def test_get__fresh(self):
+        self.assertEqual(self.cache.get('key', self.loader(1), now=0), 1)
+        self.assertEqual(self.cache.get('key', self.loader(2), now=0), 1)
+
+        self.assertEqual(self.calls, [1])
+        self.assertEqual(self.cache.stats()['hits'], 1)
+        self.assertEqual(self.cache.stats()['misses'], 1)
+
+    def test_get__stale_while_refreshing(self):
+        self.cache.get('key', self.loader(1), now=0)
+        stale_at = self.cache.cache.get('key')[1] + 1
+
+        self.assertEqual(self.cache.get('key', self.loader(2), now=stale_at), 1)
+        self.cache.join()
+        self.assertEqual(self.cache.get('key', self.loader(3)), 2)
+        self.assertEqual(self.calls, [1, 2])
+        self.assertEqual(self.cache.stats()['stale_hits'], 1)
+
+        # Too old to be served
+        self.assertEqual(self.cache.get('key', self.loader(4), now=stale_at + 1000), 4)
+
+    def test_get__errors_are_cached(self):
+        self.assertIsNone(self.cache.get('key', self.loader(IOError())))
+        self.assertIsNone(self.cache.get('key', self.loader(1)))
+
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(self.cache.stats()['errors'], 1)
+        with self.assertRaises(ValueError):
+            self.cache.get('other', self.loader(ValueError()))
+
+    def test_get__unexpected_errors_dont_stop_refreshes(self):
+        self.cache.get('key', self.loader(1), now=0)
+        stale_at = self.cache.cache.get('key')[1] + 1
+
+        # A background refresh failing with an error the cache does not handle
+        self.cache.refreshing['key'] = None
+        with self.assertRaises(ValueError):
+            self.cache._load('key', self.loader(ValueError()))
+        self.assertEqual(self.cache.refreshing, {})
+        self.assertEqual(self.cache.get('key', self.loader(2), now=stale_at), 1)
+        self.cache.join()
+        self.assertEqual(self.cache.get('key', self.loader(3)), 2)
+
+    def test_get__failed_refresh_keeps_stale_value(self):
+        self.cache.get('key', self.loader(1), now=0)
+        stale_at = self.cache.cache.get('key')[1] + 1
+
+        self.assertEqual(self.cache.get('key', self.loader(IOError()), now=stale_at), 1)
+        self.cache.join()
+        # Served without loading until the refresh is retried
+        self.assertEqual(self.cache.get('key', self.loader(2)), 1)
+        self.assertEqual(self.cache.get('key', self.loader(3), now=stale_at + self.cache.error_ttl), 1)
+        self.cache.join()
+        self.assertEqual(self.cache.get('key', self.loader(4)), 3)
+        self.assertEqual(len(self.calls), 3)
+        self.assertEqual(self.cache.stats()['errors'], 1)
+
+
+@override_settings(SERIALIZATION_CACHE={'BACKEND': 'local', 'MAX_SIZE': 100})
+class SerializationCacheTest(AbstractModelTest):
+    def setUp(self):
+        self.other1 = OtherModel1.objects.create(description='description')
+        self.model = Model.objects.create(name='name', other=self.other1)
+        self.cache = get_serialization_cache()
+
+    def test_get_serialization_cache(self):
+        self.assertIsNotNone(self.cache)
+        self.assertIsInstance(self.cache.backend, LRUCache)
+        with self.settings(SERIALIZATION_CACHE={'BACKEND': 'django', 'CACHE': 'default'}):
+            self.assertIsInstance(get_serialization_cache().backend, DjangoCacheBackend)
+        with self.settings(SERIALIZATION_CACHE=None):
+            self.assertIsNone(get_serialization_cache())
+
+    def test_to_dict__is_cached(self):
+        model_to_dict = self.model.to_dict()
+        self.assertEqual(self.cache.stats(), {'hits': 0, 'misses': 1})
+
+        with self.assertNumQueries(0):
+            self.assertEqual(self.model.to_dict(), model_to_dict)
+        self.assertEqual(self.cache.stats(), {'hits': 1, 'misses': 1})
+
+    def test_to_dict__cache_depends_on_fields(self):
+        self.model.to_dict()
+        self.assertEqual(self.model.to_dict(fields=['name']), {'name': 'name'})
+        self.assertEqual(self.cache.stats()['misses'], 2)
+
+    def test_to_dict__cached_dicts_are_copies(self):
+        self.model.to_dict()['name'] = 'changed'
+
+        self.assertEqual(self.model.to_dict()['name'], 'name')
+
+    def test_to_dict__invalidated_on_save(self):
+        self.model.to_dict()
+        self.model.name = 'new name'
+        self.model.save()
+
+        self.assertEqual(self.model.to_dict()['name'], 'new name')
+
+    def test_to_dict__invalidated_on_related_object_save(self):
+        self.model.to_dict()
+        self.other1.description = 'new description'
+        self.other1.save()
+
+        model = Model.objects.get(pk=self.model.pk)
+        self.assertEqual(model.to_dict()['other']['description'], 'new description')
+
+    def test_to_dict__invalidated_on_related_managers_changes(self):
+        other2 = OtherModel2.objects.create()
+        self.assertEqual(other2.to_dict(related=['other'])['other'], [])
+
+        other2.other.add(self.other1)
+        self.assertEqual(len(other2.to_dict(related=['other'])['other']), 1)
+
+        Model.objects.create(name='name2', other=self.other1)
+        self.assertEqual(len(self.other1.to_dict(related=['model'])['model']), 2)
+        Model.objects.create(name='name3', other=self.other1)
+        self.assertEqual(len(self.other1.to_dict(related=['model'])['model']), 3)
+
+    def test_to_dict__expires_with_signed_urls(self):
+        Model.objects.filter(pk=self.model.pk).update(_file='picture.png')
+        with patch.object(Model._meta.get_field('_file'), 'storage', SigningStorage()):
+            model = Model.objects.get(pk=self.model.pk)
+            model_to_dict = model.to_dict()
+            self.assertEqual(model.to_dict(), model_to_dict)
+
+            # The url is refreshed 300 seconds before it expires, the cached dict with it
+            later = time() + 3400
+            with patch('commons.cache.time', return_value=later), patch('commons.files.time', return_value=later):
+                self.assertNotEqual(model.to_dict(), model_to_dict)
+        self.assertEqual(self.cache.stats(), {'hits': 1, 'misses': 2})
+
+    def test_to_dict__not_cached_from_rows_read_before_a_save(self):
+        stale = Model.objects.get(pk=self.model.pk)
+        fresh = Model.objects.get(pk=self.model.pk)
+        fresh.name = 'new'
+        fresh.save()
+
+        self.assertEqual(stale.to_dict()['name'], 'name')
+        self.assertEqual(Model.objects.get(pk=self.model.pk).to_dict()['name'], 'new')
+        self.assertEqual(list(Model.objects.to_dicts())[0]['name'], 'new')
+
+    def test_to_dict__missing_versions(self):
+        # Evicted versions, or rows never saved since the cache is enabled
+        self.cache.backend.clear()
+        model = Model.objects.get(pk=self.model.pk)
+        model.to_dict()
+        model.to_dict()
+        self.assertEqual(self.cache.stats(), {'hits': 0, 'misses': 2})
+
+        # Versions are made for the rows read next
+        model = Model.objects.get(pk=self.model.pk)
+        model.to_dict()
+        model.to_dict()
+        self.assertEqual(self.cache.stats(), {'hits': 1, 'misses': 3})
+
+    def test_to_dicts__is_cached(self):
+        expected = list(Model.objects.to_dicts())
+
+        with self.assertNumQueries(1):
+            self.assertEqual(list(Model.objects.to_dicts()), expected)
+        self.assertEqual(self.cache.stats(), {'hits': 1, 'misses': 1})
+
+    def test_to_dicts__batched_cache_lookups(self):
+        for i in range(3):
+            Model.objects.create(name='name%d' % i, other=self.other1)
+        expected = list(Model.objects.to_dicts())
+
+        backend = self.cache.backend
+        with patch.object(backend, 'get_many', wraps=backend.get_many) as get_many:
+            self.assertEqual(list(Model.objects.to_dicts()), expected)
+        # Entries, then their versions
+        self.assertEqual(get_many.call_count, 2)
+        self.assertEqual(self.cache.stats(), {'hits': 4, 'misses': 4})
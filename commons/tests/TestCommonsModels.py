@@ -2,6 +2,9 @@ import json
 
 from django.core.files import File
 
+from django.db.models.signals import class_prepared
+
+from commons.models import SerializationPlan, SerializableQuerySet
 from commons.tests.models import OtherModel1, OtherModel2, Model
 from commons.tests.utils import TEST_PICTURE
 from commons.tests.test_case import AbstractModelTest
@@ -48,12 +51,11 @@ class ModelModelTest(AbstractModelTest):
         self.assertIn('other', model_to_dict)
         self.assertIn('description', model_to_dict['other'])
 
-    # TODO : see commons.models TODO line 51 about modelsmanager conversion
-    # def test_to_dict__recursivity_stops_on_same_model(self):
-    #     model_to_dict = self.model.to_dict()
+    def test_to_dict__recursivity_stops_on_same_model(self):
+        model_to_dict = self.model.to_dict(related=['other__other2__other'])
 
-    #     self.assertIn('other2', model_to_dict['other'])
-    #     self.assertNotIn('other', model_to_dict['other']['other2'])
+        self.assertIn('other2', model_to_dict['other'])
+        self.assertNotIn('other', model_to_dict['other']['other2'][0])
 
     def test_to_dict__can_specify_fields_by_name(self):
         fields = ['name']
@@ -68,13 +70,44 @@ class ModelModelTest(AbstractModelTest):
         self.assertIn('name', model_to_dict)
         self.assertNotIn(exclude[0], model_to_dict)
 
-    # TODO : see commons.models TODO line 51 about modelsmanager conversion
-    # def test_to_dict__convert_related_managers(self):
-    #     other2_to_dict = self.other2.to_dict()
+    def test_to_dict__convert_related_managers(self):
+        other2_to_dict = self.other2.to_dict(related=['other'])
+
+        self.assertIn('other', other2_to_dict)
+        self.assertIsInstance(other2_to_dict['other'], list)
+        self.assertIsInstance(other2_to_dict['other'][0], dict)
+
+    def test_to_dict__skip_related_managers_by_default(self):
+        self.assertNotIn('other', self.other2.to_dict())
+        self.assertNotIn('model', self.other1.to_dict())
+
+    def test_to_dict__related_depth(self):
+        other2_to_dict = self.other2.to_dict(depth=1)
+        self.assertIn('other', other2_to_dict)
+        self.assertNotIn('model', other2_to_dict['other'][0])
+
+        other2_to_dict = self.other2.to_dict(depth=2)
+        self.assertIn('model', other2_to_dict['other'][0])
+        self.assertEqual(other2_to_dict['other'][0]['model'][0]['name'], self.model.name)
 
-    #     self.assertIn('other', other2_to_dict)
-    #     self.assertIsInstance(other2_to_dict['other'], list)
-    #     self.assertIsInstance(other2_to_dict['other'][0], dict)
+        # Depth is a budget for related lookups too
+        self.assertNotIn('model', self.other2.to_dict(related=['other__model'], depth=1)['other'][0])
+
+    def test_to_dict__invalid_related_lookup(self):
+        with self.assertRaises(ValueError):
+            self.other2.to_dict(related=['name'])
+        with self.assertRaises(ValueError):
+            self.other2.to_dict(related=['other__nothing'])
+
+    def test_to_dict__related_managers_are_prefetched(self):
+        other1 = OtherModel1.objects.create(description='other')
+        self.other2.other.add(other1)
+        Model.objects.create(name='name2', other=other1)
+
+        # One query by relation, whatever the number of related objects
+        with self.assertNumQueries(2):
+            other2_to_dict = self.other2.to_dict(related=['other__model'])
+        self.assertEqual(len(other2_to_dict['other']), 2)
 
     def test_to_dict__convert_models(self):
         model_to_dict = self.model.to_dict()
@@ -100,3 +133,50 @@ class ModelModelTest(AbstractModelTest):
 
         json_dict = json.dumps(model_to_dict)
         self.assertIsInstance(json_dict, basestring)
+
+    def test_get_serialization_plan__is_cached_per_class(self):
+        plan = Model.get_serialization_plan()
+
+        self.assertIsInstance(plan, SerializationPlan)
+        self.assertIs(plan, Model.get_serialization_plan())
+        self.assertIsNot(plan, OtherModel1.get_serialization_plan())
+        self.assertIsNot(plan, Model.get_serialization_plan(exclude=['id']))
+        self.assertIs(Model.get_serialization_plan(fields=['name', 'id']), Model.get_serialization_plan(fields=('id', 'name')))
+
+    def test_get_serialization_plan__invalidated_when_a_class_is_prepared(self):
+        plan = Model.get_serialization_plan()
+        class_prepared.send(sender=OtherModel2)
+
+        self.assertIsNot(plan, Model.get_serialization_plan())
+
+    def test_get_serialization_plan__resolves_underscored_attributes(self):
+        attributes = [attribute for attribute, kind in Model.get_serialization_plan().steps]
+
+        self.assertIn('email', attributes)
+        self.assertIn('_site', attributes)
+        self.assertNotIn('_email', attributes)
+
+    def test_to_dicts__match_to_dict(self):
+        Model.objects.create(name='name2', other=OtherModel1.objects.create(description='other'))
+        expected = [model.to_dict() for model in Model.objects.order_by('pk')]
+
+        self.assertIsInstance(Model.objects.all(), SerializableQuerySet)
+        with self.assertNumQueries(1):
+            self.assertEqual(list(Model.objects.order_by('pk').to_dicts()), expected)
+        self.assertEqual(list(Model.objects.to_dicts(chunk_size=1)), expected)
+
+    def test_to_dicts__can_specify_fields_and_exclude(self):
+        fields, exclude = ['name', 'other', 'id'], ['id']
+        expected = [model.to_dict(fields, exclude) for model in Model.objects.all()]
+
+        self.assertEqual(list(Model.objects.to_dicts(fields, exclude)), expected)
+
+    def test_to_dicts__related_managers_are_prefetched(self):
+        for i in range(3):
+            other2 = OtherModel2.objects.create()
+            other2.other.add(self.other1, OtherModel1.objects.create(description='other %d' % i))
+        expected = [instance.to_dict(related=['other__model']) for instance in OtherModel2.objects.order_by('pk')]
+
+        with self.assertNumQueries(3):
+            self.assertEqual(list(OtherModel2.objects.order_by('pk').to_dicts(related=['other__model'])), expected)
+        self.assertEqual(list(OtherModel2.objects.to_dicts(chunk_size=2, related=['other__model'])), expected)
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+import json
+from collections import OrderedDict
+from unittest import TestCase
+
+from django.test import RequestFactory
+from django.utils.safestring import mark_safe
+
+from commons.encoders import iter_json, iter_jsonl, get_encoder, negotiate_encoder, PackedEncoder
+
+
+class EncodersTest(TestCase):
+    dicts = [{'id': i, 'name': u'name %d' % i} for i in range(50)]
+
+    def test_iter_json(self):
+        self.assertEqual(json.loads(''.join(iter_json(self.dicts))), self.dicts)
+        self.assertEqual(json.loads(''.join(iter_json([]))), [])
+
+    def test_iter_json__is_buffered(self):
+        chunks = list(iter_json(self.dicts, buffer_size=100))
+
+        self.assertTrue(1 < len(chunks) < len(self.dicts))
+        self.assertTrue(all(len(chunk) >= 100 for chunk in chunks[:-1]))
+
+    def test_iter_jsonl(self):
+        lines = ''.join(iter_jsonl(self.dicts)).splitlines()
+
+        self.assertEqual([json.loads(line) for line in lines], self.dicts)
+
+    def test_jsonl__encode(self):
+        encoder = get_encoder('jsonl')
+
+        self.assertEqual(encoder.encode({'a': 1}), '{"a": 1}\n')
+        self.assertEqual(encoder.decode(encoder.encode(self.dicts)), self.dicts)
+
+    def test_packed__round_trip(self):
+        encoder = PackedEncoder()
+        values = [None, True, False, 0, -1, 127, -129, 2 ** 40, 2 ** 70, -2 ** 70, 1.5,
+                  u'', u'h\xe9h\xe9', u'x' * 300, range(300), {u'key': [{u'nested': None}]}]
+
+        self.assertEqual(encoder.decode(encoder.encode(values)), values)
+        self.assertIsInstance(encoder.decode(encoder.encode('bytes')), unicode)
+
+    def test_packed__dicts_round_trip(self):
+        encoder = PackedEncoder()
+        # Every kind of key and value, as dict items
+        dicts = [{1: u'int', u'k\xe9y': u'x' * 300, 'key': 2 ** 70, u'list': [1, None]},
+                 {True: 'bool', u'k\xe9y': True, 'key': False, 1.5: -129,
+                  u'nested': OrderedDict([(u'key', mark_safe(u'safe'))])}]
+
+        decoded = encoder.decode(encoder.encode(dicts))
+        self.assertEqual(decoded, dicts)
+        self.assertIs(decoded[1].keys()[decoded[1].values().index('bool')], True)
+
+    def test_packed__is_smaller_than_json(self):
+        encoder = get_encoder('packed')
+
+        self.assertLess(len(encoder.encode(self.dicts)), len(json.dumps(self.dicts)))
+
+    def test_packed__iter_encode(self):
+        encoder = get_encoder('packed')
+        data = ''.join(encoder.iter_encode(self.dicts))
+
+        self.assertEqual(encoder.decode_stream(data), self.dicts)
+
+    def test_packed__errors(self):
+        encoder = PackedEncoder()
+        with self.assertRaises(TypeError):
+            encoder.encode(object())
+        with self.assertRaises(ValueError):
+            encoder.decode('?')
+
+    def test_get_encoder(self):
+        self.assertEqual(get_encoder('json').content_type, 'application/json')
+        with self.assertRaises(KeyError):
+            get_encoder('xml')
+
+
+class NegotiateEncoderTest(TestCase):
+    def negotiate(self, data={}, **extra):
+        return negotiate_encoder(RequestFactory().get('/', data, **extra)).name
+
+    def test_default(self):
+        self.assertEqual(self.negotiate(), 'json')
+        self.assertEqual(self.negotiate(HTTP_ACCEPT='text/html, */*'), 'json')
+
+    def test_format_parameter_wins(self):
+        self.assertEqual(self.negotiate({'format': 'jsonl'}, HTTP_ACCEPT='application/x-packed'), 'jsonl')
+        with self.assertRaises(KeyError):
+            self.negotiate({'format': 'xml'})
+
+    def test_accept_header(self):
+        self.assertEqual(self.negotiate(HTTP_ACCEPT='application/x-packed'), 'packed')
+        self.assertEqual(self.negotiate(HTTP_ACCEPT='application/json;q=0.5, application/x-ndjson'), 'jsonl')
+        self.assertEqual(self.negotiate(HTTP_ACCEPT='application/x-packed;q=0, application/json;q=0.1'), 'json')
@@ -0,0 +1,100 @@
+from copy import deepcopy
+from threading import Thread
+from unittest import TestCase
+
+from django.core.files.storage import FileSystemStorage
+from django.db.models.fields.files import FieldFile
+from django.utils.functional import empty
+from mock import Mock
+
+from commons.files import FileURLResolver, LazyS3Storage, get_s3_storage
+
+
+class SigningStorage(object):
+    """Fake S3BotoStorage, counting signed urls."""
+    bucket_name = 'bucket'
+    location = 'uploads'
+    querystring_auth = True
+    querystring_expire = 3600
+
+    def __init__(self):
+        self.signed = 0
+
+    def _clean_name(self, name):
+        return name
+
+    def _normalize_name(self, name):
+        return self.location + '/' + name
+
+    def url(self, name):
+        self.signed += 1
+        return 'https://s3/%s/%s?Signature=%d' % (self.bucket_name, self._normalize_name(name), self.signed)
+
+
+class FileURLResolverTest(TestCase):
+    def setUp(self):
+        self.storage = SigningStorage()
+
+    def test_resolve__caches_signed_urls(self):
+        resolver = FileURLResolver(margin=300)
+        url = resolver.resolve(self.storage, 'picture.png', now=0)
+
+        self.assertEqual(resolver.resolve(self.storage, 'picture.png', now=3000), url)
+        self.assertEqual(self.storage.signed, 1)
+        # Signed again shortly before expiration
+        self.assertNotEqual(resolver.resolve(self.storage, 'picture.png', now=3400), url)
+        self.assertEqual(self.storage.signed, 2)
+
+    def test_resolve__public_urls_are_not_signed(self):
+        resolver = FileURLResolver(public_urls={'bucket': 'https://cdn.example.com/'})
+
+        self.assertEqual(resolver.resolve(self.storage, 'a picture.png'), 'https://cdn.example.com/uploads/a%20picture.png')
+        self.assertEqual(self.storage.signed, 0)
+
+    def test_resolve__other_storages(self):
+        storage = FileSystemStorage(base_url='/media/')
+
+        self.assertEqual(FileURLResolver().resolve(storage, 'picture.png'), '/media/picture.png')
+
+    def test_urls(self):
+        resolver = FileURLResolver()
+        files = [FieldFile(None, Mock(storage=self.storage), name) for name in ('a.png', 'b.png', 'a.png', None)]
+
+        urls = resolver.urls(files)
+        self.assertEqual(urls[0], urls[2])
+        self.assertNotEqual(urls[0], urls[1])
+        self.assertIsNone(urls[3])
+        self.assertEqual(self.storage.signed, 2)
+        self.assertEqual(resolver.url(files[1]), urls[1])
+
+
+class S3StorageRegistryTest(TestCase):
+    def test_get_s3_storage__one_per_configuration(self):
+        storage = get_s3_storage('bucket', headers={'Cache-Control': 'max-age=60'})
+
+        self.assertIs(get_s3_storage('bucket', headers={'Cache-Control': 'max-age=60'}), storage)
+        self.assertIsNot(get_s3_storage('bucket'), storage)
+        self.assertEqual((storage.bucket_name, storage.headers), ('bucket', {'Cache-Control': 'max-age=60'}))
+
+    def test_get_s3_storage__threads(self):
+        storages = []
+        threads = [Thread(target=lambda: storages.append(get_s3_storage('threads-bucket'))) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(set(id(storage) for storage in storages)), 1)
+
+    def test_connection__shared_by_credentials(self):
+        storage = get_s3_storage('bucket', access_key='key', secret_key='secret')
+
+        self.assertIs(get_s3_storage('other', access_key='key', secret_key='secret').connection, storage.connection)
+        self.assertIsNot(get_s3_storage('bucket', access_key='other', secret_key='secret').connection, storage.connection)
+
+    def test_lazy_s3_storage(self):
+        storage = LazyS3Storage('lazy-bucket', location='static')
+        self.assertIs(deepcopy(storage), storage)
+        self.assertIs(storage._wrapped, empty)
+
+        self.assertEqual(storage.location, 'static')
+        self.assertIs(storage._wrapped, get_s3_storage('lazy-bucket', location='static'))
@@ -9,16 +9,15 @@ from django.test import RequestFactory
 TEST_PICTURE = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'img', 'picture.png')
 
 
-def _request(data, path='/fake_path', method='get', ajax=False):
+def _request(data, path='/fake_path', method='get', ajax=False, **extra):
     """
     Return a request with emulated session and user.
     It doesn't enforce csrf checks.
     Use for tests only !
     """
     if ajax:
-        r = getattr(RequestFactory(), method)(path, data, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
-    else:
-        r = getattr(RequestFactory(), method)(path, data)
+        extra['HTTP_X_REQUESTED_WITH'] = 'XMLHttpRequest'
+    r = getattr(RequestFactory(), method)(path, data, **extra)
     setattr(r, 'user', AnonymousUser())
     setattr(r, 'session', SessionStore())
     setattr(r, '_dont_enforce_csrf_checks', True)
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+import atexit
+import logging
+from threading import Event, Lock, Thread
+from time import time
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import connections, router, transaction
+from django.dispatch import receiver
+from django.test.signals import setting_changed
+from django.utils import timezone
+
+from commons.cache import invalidate_serialized
+
+logger = logging.getLogger(__name__)
+
+
+class ActivityTracker(object):
+    """
+    Buffer the last_login and last_seen times of users in memory, and write
+    them with one UPDATE ... CASE statement per field and batch_size users,
+    instead of one save() per login or request.
+
+    Pending times are flushed by a background thread every flush_interval
+    seconds, as soon as max_pending users are waiting, and at exit: a crash
+    loses at most flush_interval seconds of activity. Request threads only
+    wake the background thread up, they never wait for a flush.
+    """
+    fields = ('last_login', 'last_seen')
+
+    def __init__(self, model, flush_interval=10, max_pending=1000, batch_size=500):
+        self.model = model
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.batch_size = batch_size
+        self.pending = self._empty()
+        self.lock = Lock()
+        self.flush_lock = Lock()
+        self.last_flush = time()
+        self.flushes = self.updates = 0
+        self._stopped = False
+        self._wake = Event()
+        self._thread = None
+
+    def _empty(self):
+        return dict((field, {}) for field in self.fields)
+
+    def stats(self):
+        with self.lock:
+            pending = sum(len(times) for times in self.pending.itervalues())
+        return {'pending': pending, 'flushes': self.flushes, 'updates': self.updates}
+
+    def record(self, field, pk, when=None, now=None):
+        """Remember that user pk was active at when (now by default), keeping the latest time."""
+        if when is None:
+            when = timezone.now()
+        with self.lock:
+            times = self.pending[field]
+            if pk not in times or times[pk] < when:
+                times[pk] = when
+            pending = sum(len(times) for times in self.pending.itervalues())
+            if self._thread is None and not self._stopped:
+                self._thread = Thread(target=self._run, name='user-activity-flush')
+                self._thread.daemon = True
+                self._thread.start()
+        if now is None:
+            now = time()
+        if pending >= self.max_pending or now - self.last_flush >= self.flush_interval:
+            self._wake.set()
+
+    def flush(self, now=None):
+        """Write pending times to the database, return the number of rows updated."""
+        with self.flush_lock:
+            with self.lock:
+                pending, self.pending = self.pending, self._empty()
+                self.last_flush = time() if now is None else now
+            if not any(pending.itervalues()):
+                return 0
+            try:
+                updated = self._write(pending)
+            except Exception:
+                # Put the times back, to be written by the next flush
+                with self.lock:
+                    for field, times in pending.iteritems():
+                        for pk, when in times.iteritems():
+                            self.pending[field][pk] = max(when, self.pending[field].get(pk, when))
+                raise
+            self.flushes += 1
+            self.updates += updated
+
+        # Cached dicts hold the times. Users cached by user.cache are kept: the
+        # times are left out of their saves (see BaseUser.save), and dropping
+        # every active user from it on each flush would defeat it.
+        for pk in set(pk for times in pending.itervalues() for pk in times):
+            invalidate_serialized(self.model, self.model(pk=pk))
+        return updated
+
+    def _write(self, pending):
+        using = router.db_for_write(self.model)
+        connection = connections[using]
+        qn = connection.ops.quote_name
+        opts = self.model._meta
+        updated = 0
+        with transaction.atomic(using=using):
+            cursor = connection.cursor()
+            for field_name, times in pending.iteritems():
+                field = opts.get_field(field_name)
+                # Sorted primary keys, so that concurrent flushes lock rows in the same order
+                items = sorted(times.iteritems())
+                for start in xrange(0, len(items), self.batch_size):
+                    batch = items[start:start + self.batch_size]
+                    params = []
+                    for pk, when in batch:
+                        params.extend([pk, field.get_db_prep_value(when, connection)])
+                    params.extend(pk for pk, when in batch)
+                    cursor.execute('UPDATE {table} SET {column} = CASE {pk} {cases} END WHERE {pk} IN ({pks})'.format(
+                        table=qn(opts.db_table), column=qn(field.column), pk=qn(opts.pk.column),
+                        cases=' '.join(['WHEN %s THEN %s'] * len(batch)), pks=', '.join(['%s'] * len(batch))), params)
+                    updated += cursor.rowcount
+        return updated
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.flush_interval or None)
+            self._wake.clear()
+            if self._stopped:
+                return
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Flushing users activity failed.')
+            finally:
+                connections[router.db_for_write(self.model)].close()
+
+    def stop(self):
+        """Stop the background thread, pending times are kept."""
+        self._stopped = True
+        self._wake.set()
+
+
+_tracker = []
+
+
+def get_activity_tracker():
+    """
+    Return the ActivityTracker configured by settings.USER_ACTIVITY, None if disabled.
+
+    USER_ACTIVITY = {'FLUSH_INTERVAL': 10, 'MAX_PENDING': 1000, 'BATCH_SIZE': 500}
+    """
+    config = getattr(settings, 'USER_ACTIVITY', None)
+    if config is None:
+        return None
+    if not _tracker:
+        _tracker.append(ActivityTracker(
+            get_user_model(), config.get('FLUSH_INTERVAL', 10), config.get('MAX_PENDING', 1000), config.get('BATCH_SIZE', 500)))
+    return _tracker[0]
+
+
+@receiver(setting_changed)
+def reset_activity_tracker(sender, setting, **kwargs):
+    if setting == 'USER_ACTIVITY' and _tracker:
+        _tracker[0].stop()
+        del _tracker[:]
+
+
+@atexit.register
+def flush_activity():
+    """Write the pending times of the current tracker, if any."""
+    if _tracker:
+        _tracker[0].flush()
+
+
+def record_login(sender, request, user, **kwargs):
+    """
+    Replace django's update_last_login: with an activity tracker the login is
+    buffered, otherwise last_login is saved right away.
+    """
+    user.last_login = timezone.now()
+    tracker = get_activity_tracker()
+    if tracker is None:
+        user.save(update_fields=['last_login'])
+    else:
+        tracker.record('last_login', user.pk, user.last_login)
+        tracker.record('last_seen', user.pk, user.last_login)
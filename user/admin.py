@@ -4,27 +4,36 @@ from django.contrib.auth import get_user_model
 from django.utils.translation import ugettext_lazy as _
 
 from user.forms import BaseUserEditionForm
+from user.models import AvatarJob, SocialIdentity
 
 
 class BaseUserForm(BaseUserEditionForm):
     class Meta:
         model = get_user_model()
-        fields = ('email', 'is_active', 'is_staff', 'created_at', 'slug', 'name', '_fb_token', '_fb_id', '_avatar', '_small_avatar',)
+        fields = ('email', 'is_active', 'is_staff', 'created_at', 'slug', 'name', '_avatar', '_small_avatar',)
+
+
+class SocialIdentityInline(admin.TabularInline):
+    model = SocialIdentity
+    fields = ('provider', 'uid', 'expires_at', 'scopes')
+    readonly_fields = fields
+    extra = 0
 
 
 class BaseUserAdmin(admin.ModelAdmin):
     fieldsets = [
         (_('Profil'), {'fields': ['email']}),
         (_('Status'), {'fields': ['is_active', 'is_staff']}),
-        (_('Technical data'), {'fields': ['slug', 'created_at', 'last_login'], 'classes': ['collapse']}),
+        (_('Technical data'), {'fields': ['slug', 'created_at', 'last_login', 'last_seen'], 'classes': ['collapse']}),
     ]
     search_fields = ('name', 'email')
     list_display = ('name', 'email', 'created_at', 'last_login')
     date_hierarchy = 'created_at'
-    readonly_fields = ('created_at', 'last_login', '_fb_id', '_fb_token')
+    readonly_fields = ('created_at', 'last_login', 'last_seen')
     prepopulated_fields = {'slug': ('name',)}
 
     form = BaseUserForm
+    inlines = [SocialIdentityInline]
 
     def queryset(self, request):
         """ Only show administrators """
@@ -32,3 +41,11 @@ class BaseUserAdmin(admin.ModelAdmin):
         return qs.filter(is_superuser=True)
 
 admin.site.register(get_user_model(), BaseUserAdmin)
+
+
+class AvatarJobAdmin(admin.ModelAdmin):
+    list_display = ('user', 'status', 'attempts', 'created_at', 'updated_at')
+    list_filter = ('status',)
+    readonly_fields = ('user', 'source', 'name', 'ext', 'attempts', 'error', 'created_at', 'updated_at')
+
+admin.site.register(AvatarJob, AvatarJobAdmin)
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import os
+from datetime import timedelta
+from tempfile import gettempdir
+
+from django.conf import settings
+from django.core.files.storage import FileSystemStorage
+from django.db import transaction, IntegrityError
+from django.db.models import F
+from django.dispatch import receiver
+from django.test.signals import setting_changed
+from django.utils.timezone import now
+from PIL import Image
+
+from commons.cache import LRUCache
+from commons.files import get_file_url_resolver
+from user.models import AvatarJob, AvatarRendition
+from user.utils import avatar_placeholder, avatar_profile, avatar_renditions, render_avatars, webp_supported
+
+# Largest width or height of renditions made on demand
+MAX_RENDITION_SIZE = 2048
+FORMATS = {'jpg': 'jpeg', 'jpeg': 'jpeg', 'png': 'png', 'gif': 'gif', 'webp': 'webp'}
+
+
+def avatars_deferred():
+    """Return whether uploaded avatars are processed by a worker (settings.AVATAR_DEFERRED)."""
+    return getattr(settings, 'AVATAR_DEFERRED', False)
+
+
+_spool = []
+
+
+def get_spool_storage():
+    """Return the local storage of uploaded avatars waiting for a worker, in settings.AVATAR_SPOOL_ROOT."""
+    if not _spool:
+        _spool.append(FileSystemStorage(location=getattr(settings, 'AVATAR_SPOOL_ROOT', os.path.join(gettempdir(), 'avatar_spool'))))
+    return _spool[0]
+
+
+@receiver(setting_changed)
+def reset_spool_storage(sender, setting, **kwargs):
+    if setting == 'AVATAR_SPOOL_ROOT':
+        del _spool[:]
+
+
+def content_name(content, ext):
+    """Return the name of content after the SHA-1 of its bytes, read by chunks, and the extension ext."""
+    digest = hashlib.sha1()
+    for chunk in content.chunks():
+        digest.update(chunk)
+    content.seek(0)
+    return '%s.%s' % (digest.hexdigest(), ext)
+
+
+def store_content(storage, directory, content, ext):
+    """
+    Store content in directory, named after its bytes (see content_name),
+    and return its name. Content already stored is not uploaded again, and
+    stored files never change: storages can send far future cache headers.
+    """
+    name = '/'.join(filter(None, (directory.rstrip('/'), content_name(content, ext))))
+    if storage.exists(name):
+        return name
+    return storage.save(name, content)
+
+
+def rendition_format(rendition, ext):
+    """Return the format of a rendition named by user.utils.encode_avatar, ext for other files."""
+    return os.path.splitext(rendition.name or '')[1].strip('.') or ext
+
+
+def save_renditions(user, renditions, ext):
+    """
+    Store {image field name: file} renditions in the fields of user, without
+    saving it, named after their content (see store_content). ext is the
+    extension of files which do not tell their format.
+    """
+    for field_name, rendition in renditions.iteritems():
+        field = user._meta.get_field(field_name)
+        setattr(user, field_name, store_content(field.storage, field.get_directory_name(), rendition, rendition_format(rendition, ext)))
+
+
+def enqueue_avatar(user, upload, ext):
+    """Spool an uploaded avatar and create its AvatarJob, user.avatar is a placeholder until it is done."""
+    upload.seek(0)
+    job = AvatarJob.objects.create(user=user, source=get_spool_storage().save(upload.name, upload), name=upload.name, ext=ext)
+    user._avatar_pending = True
+    user.save(update_fields=['_avatar_pending'])
+    return job
+
+
+def claim_avatar_jobs(limit=10, stale_after=600, max_attempts=3):
+    """
+    Mark up to limit pending jobs as running and return them. Each job is
+    claimed by a conditional update, so that concurrent workers get different
+    jobs. Jobs running for more than stale_after seconds (their worker died)
+    count as a failed attempt: they are pending again, or failed after
+    max_attempts.
+    """
+    stale = AvatarJob.objects.filter(status=AvatarJob.RUNNING, updated_at__lt=now() - timedelta(seconds=stale_after))
+    for job in stale.filter(attempts__gte=max_attempts - 1).select_related('user'):
+        if stale.filter(pk=job.pk).update(status=AvatarJob.FAILED, attempts=F('attempts') + 1,
+                                          error='Worker timed out.', updated_at=now()):
+            _drop_failed_job(job)
+    stale.update(status=AvatarJob.PENDING, attempts=F('attempts') + 1)
+    claimed = []
+    for pk in AvatarJob.objects.filter(status=AvatarJob.PENDING).order_by('pk').values_list('pk', flat=True)[:limit]:
+        if AvatarJob.objects.filter(pk=pk, status=AvatarJob.PENDING).update(status=AvatarJob.RUNNING, updated_at=now()):
+            claimed.append(pk)
+    return list(AvatarJob.objects.filter(pk__in=claimed).select_related('user').order_by('pk'))
+
+
+def _drop_failed_job(job, superseded=None):
+    """Delete the spooled source of a failed job, and return to the previous avatar unless a later upload is pending."""
+    if superseded is None:
+        superseded = AvatarJob.objects.filter(user=job.user_id, pk__gt=job.pk).exists()
+    if not superseded:
+        job.user._avatar_pending = False
+        job.user.save(update_fields=['_avatar_pending'])
+    get_spool_storage().delete(job.source)
+
+
+def process_avatar_job(job, max_attempts=3):
+    """
+    Make and store the renditions of a claimed job, and clear the user's
+    pending flag. Failed jobs are retried up to max_attempts times. Only the
+    latest upload of a user is stored, older jobs are just marked done.
+    """
+    user = job.user
+    superseded = AvatarJob.objects.filter(user=user, pk__gt=job.pk).exists()
+    try:
+        if not superseded:
+            with get_spool_storage().open(job.source) as source:
+                renditions = render_avatars(Image.open(source), avatar_renditions(), job.ext)
+            save_renditions(user, renditions, job.ext)
+            user._avatar_pending = False
+            user.save(update_fields=renditions.keys() + ['_avatar_pending'])
+        job.status = AvatarJob.DONE
+    except Exception, e:
+        job.attempts += 1
+        job.error = repr(e)
+        job.status = AvatarJob.FAILED if job.attempts >= max_attempts else AvatarJob.PENDING
+    job.updated_at = now()
+    job.save()
+    if job.status == AvatarJob.FAILED:
+        _drop_failed_job(job, superseded)
+    elif job.status == AvatarJob.DONE:
+        get_spool_storage().delete(job.source)
+    return job
+
+
+def run_avatar_jobs(limit=10, max_attempts=3):
+    """Claim and process up to limit jobs, return them."""
+    return [process_avatar_job(job, max_attempts) for job in claim_avatar_jobs(limit, max_attempts=max_attempts)]
+
+
+# Names of the renditions already looked up, by (source, width, height, format)
+_rendition_names = LRUCache(10000)
+
+
+def _rendition_key(user, width, height, ext):
+    source = user._avatar.name
+    ext = FORMATS.get(ext or os.path.splitext(source)[1].strip('.').lower())
+    if ext is None or (ext == 'webp' and not webp_supported()):
+        raise ValueError('Unavailable avatar format.')
+    return (source, width, height, ext)
+
+
+def _make_rendition(storage, (source, width, height, ext)):
+    """Make, store and index a rendition, return its name."""
+    with storage.open(source) as source_file:
+        rendition = render_avatars(
+            Image.open(source_file), (('rendition', (width, height)),), ext,
+            {'rendition': dict(avatar_profile('rendition'), format=ext)})['rendition']
+    name = store_content(storage, os.path.dirname(source), rendition, ext)
+    try:
+        with transaction.atomic():
+            AvatarRendition.objects.create(source=source, width=width, height=height, format=ext, name=name, size=rendition.size)
+    except IntegrityError:
+        # Made at the same time by another request, keep the indexed one.
+        # Stored files may be shared by several renditions, they are never deleted.
+        name = AvatarRendition.objects.get(source=source, width=width, height=height, format=ext).name
+    return name
+
+
+def avatar_rendition_sizes():
+    """
+    Return the (width, height) sizes available on demand, settings.AVATAR_RENDITION_SIZES,
+    by default the sizes of the renditions of uploads (see user.utils.avatar_renditions).
+    Any other size would let anonymous requests fill the storage and the index.
+    """
+    sizes = getattr(settings, 'AVATAR_RENDITION_SIZES', None)
+    if sizes is None:
+        sizes = [size for name, size in avatar_renditions()]
+    return set(tuple(size) for size in sizes)
+
+
+def avatar_rendition_names(users, width, height, ext=None):
+    """
+    Return the stored names of the avatars of users at width x height, in
+    format ext (the avatar's by default), None for users without avatar.
+
+    Renditions are made from user._avatar with the crop of user.utils.resize
+    the first time they are asked for, then read from the AvatarRendition
+    index, with one query for all users, and cached in each process.
+    Sizes not in avatar_rendition_sizes() or over MAX_RENDITION_SIZE, and
+    unknown formats raise ValueError.
+    """
+    if (width, height) not in avatar_rendition_sizes() or not (0 < width <= MAX_RENDITION_SIZE and 0 < height <= MAX_RENDITION_SIZE):
+        raise ValueError('Unavailable avatar size: {0}x{1}.'.format(width, height))
+    keys = [_rendition_key(user, width, height, ext) if user._avatar and not user._avatar_pending else None for user in users]
+    names = _rendition_names.get_many([key for key in keys if key])
+    missing = set(key for key in keys if key and key not in names)
+    if missing:
+        sources = set(key[0] for key in missing)
+        for rendition in AvatarRendition.objects.filter(source__in=sources, width=width, height=height):
+            names[rendition.source, width, height, rendition.format] = rendition.name
+        for user, key in zip(users, keys):
+            if key in missing and key not in names:
+                names[key] = _make_rendition(user._avatar.storage, key)
+        _rendition_names.set_many(dict((key, names[key]) for key in missing))
+    return [names[key] if key else None for key in keys]
+
+
+def avatar_rendition_urls(users, width, height, ext=None):
+    """
+    Return the urls of the avatars of users at width x height (see
+    avatar_rendition_names), the placeholder while a new avatar is processed.
+    """
+    resolver = get_file_url_resolver()
+    urls = []
+    for user, name in zip(users, avatar_rendition_names(users, width, height, ext)):
+        if user._avatar_pending:
+            urls.append(avatar_placeholder())
+        else:
+            urls.append(resolver.resolve(user._avatar.storage, name) if name else None)
+    return urls
+
+
+def avatar_rendition_url(user, width, height, ext=None):
+    """Return the url of the avatar of user at width x height, see avatar_rendition_urls."""
+    return avatar_rendition_urls([user], width, height, ext)[0]
@@ -1,11 +1,15 @@
 # -*- coding: utf-8 -*-
 from django.contrib.auth import get_user_model
 from django.conf import settings
+from django.contrib.auth.backends import ModelBackend
 from facebook import GraphAPI, GraphAPIError
-from storages.backends.s3boto import S3BotoStorage
+
+from commons.files import get_s3_storage
+from user.cache import get_user_cache
+from user.models import SocialIdentity
 
 # Create static files storages
-StaticS3Storage = lambda: S3BotoStorage(bucket_name=settings.AWS_STATIC_BUCKET, location='static')
+StaticS3Storage = lambda: get_s3_storage(settings.AWS_STATIC_BUCKET, location='static')
 
 
 class FacebookBackend(object):
@@ -20,7 +24,9 @@ class FacebookBackend(object):
 
         UserModel = get_user_model()
         try:
-            user = UserModel._default_manager.get(_fb_id=fb_id)
+            # Single lookup on the (provider, uid) unique index
+            user = UserModel._default_manager.base_only().get(
+                social_identities__provider=SocialIdentity.FACEBOOK, social_identities__uid=str(fb_id))
         except UserModel.DoesNotExist:
             return None
         else:
@@ -38,3 +44,20 @@ class FacebookBackend(object):
             return UserModel._default_manager.get(pk=user_id)
         except UserModel.DoesNotExist:
             return None
+
+
+class CachedUserBackendMixin(object):
+    """
+    Serve get_user, run on every authenticated request, from the user cache.
+    See user.cache.get_user_cache.
+    """
+    def get_user(self, user_id):
+        return get_user_cache().get(user_id, lambda: super(CachedUserBackendMixin, self).get_user(user_id))
+
+
+class CachedModelBackend(CachedUserBackendMixin, ModelBackend):
+    pass
+
+
+class CachedFacebookBackend(CachedUserBackendMixin, FacebookBackend):
+    pass
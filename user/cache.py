@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+import cPickle as pickle
+from random import getrandbits
+from time import time
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.test.signals import setting_changed
+
+from commons.cache import LRUCache, DjangoCacheBackend
+
+
+class UserCache(object):
+    """
+    Cache of users by primary key, for the per request get_user of auth backends.
+
+    Users are kept pickled in a process local LRU, for at most ttl seconds,
+    and returned as fresh copies. With a shared cache (one of settings.CACHES),
+    users are also stored there, and each has a version, replaced whenever the
+    user is saved or deleted, that local entries are checked against: changes
+    made in other processes are seen at once.
+    """
+    prefix = 'user'
+
+    def __init__(self, max_size=1000, ttl=300, shared=None):
+        self.local = LRUCache(max_size)
+        self.ttl = ttl
+        self.shared = shared
+        self.hits = self.shared_hits = self.misses = 0
+
+    def stats(self):
+        return {'hits': self.hits, 'shared_hits': self.shared_hits, 'misses': self.misses}
+
+    def version_key(self, pk):
+        return '{0}:v:{1}'.format(self.prefix, pk)
+
+    def key(self, pk, version):
+        return '{0}:{1}:{2}'.format(self.prefix, pk, version)
+
+    def get(self, pk, loader, now=None):
+        """Return a copy of the cached user pk, or cache the user returned by loader() if not None."""
+        if now is None:
+            now = time()
+        version = self.shared.get(self.version_key(pk)) if self.shared else None
+        entry = self.local.get(pk)
+        if entry is not None and entry[0] == version and now < entry[1]:
+            self.hits += 1
+            return pickle.loads(entry[2])
+
+        if self.shared and version is None:
+            # Made before loading: a save while loader() runs replaces it, and the user loaded is never served
+            version = '%08x' % getrandbits(32)
+            if not self.shared.add(self.version_key(pk), version):
+                version = self.shared.get(self.version_key(pk))
+        data = self.shared.get(self.key(pk, version)) if version else None
+        if data is not None:
+            self.shared_hits += 1
+        else:
+            self.misses += 1
+            user = loader()
+            if user is None:
+                return None
+            data = pickle.dumps(user, pickle.HIGHEST_PROTOCOL)
+            if version:
+                self.shared.set(self.key(pk, version), data)
+            elif self.shared:
+                # Invalidated meanwhile
+                return pickle.loads(data)
+        self.local.set(pk, (version, now + self.ttl, data))
+        return pickle.loads(data)
+
+    def invalidate(self, pk):
+        self.local.delete(pk)
+        if self.shared:
+            self.shared.delete(self.version_key(pk))
+
+
+# Backends which are not shared by processes
+PROCESS_LOCAL_CACHES = ('django.core.cache.backends.locmem.LocMemCache', 'django.core.cache.backends.dummy.DummyCache')
+
+_cache = []
+
+
+def default_shared_cache():
+    """Return 'default' if settings.CACHES['default'] is shared by processes, None otherwise."""
+    backend = getattr(settings, 'CACHES', {}).get('default', {}).get('BACKEND', PROCESS_LOCAL_CACHES[0])
+    return None if backend in PROCESS_LOCAL_CACHES else 'default'
+
+
+def get_user_cache():
+    """
+    Return the UserCache configured by settings.USER_CACHE.
+
+    USER_CACHE = {'MAX_SIZE': 1000, 'TTL': 300, 'CACHE': 'default', 'TIMEOUT': 3600}
+    'CACHE' defaults to 'default' when that cache is shared by processes.
+    Without a shared cache, users are only cached in each process, where other
+    processes' changes go unseen for TTL seconds: it then defaults to 0.
+    """
+    if not _cache:
+        config = getattr(settings, 'USER_CACHE', {})
+        alias = config.get('CACHE', default_shared_cache())
+        shared = DjangoCacheBackend(alias, config.get('TIMEOUT')) if alias else None
+        _cache.append(UserCache(config.get('MAX_SIZE', 1000), config.get('TTL', 300 if shared else 0), shared))
+    return _cache[0]
+
+
+@receiver(setting_changed)
+def reset_user_cache(sender, setting, **kwargs):
+    if setting in ('USER_CACHE', 'CACHES'):
+        del _cache[:]
+
+
+@receiver(post_save)
+@receiver(post_delete)
+def invalidate_cached_user(sender, instance, **kwargs):
+    """Drop saved or deleted users (password changes included) from the cache."""
+    if isinstance(instance, get_user_model()):
+        get_user_cache().invalidate(instance.pk)
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+import logging
+import sys
+from collections import deque
+from threading import Condition, Event, Lock, Thread
+from time import time
+
+from django.conf import settings
+from django.dispatch import receiver
+from django.test.signals import setting_changed
+
+logger = logging.getLogger(__name__)
+
+
+class ImageWorkTimeout(Exception):
+    """Raised when a job did not complete in the executor's timeout."""
+
+
+class _Job(object):
+    def __init__(self, func, args, kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.done = Event()
+        self.cancelled = False
+        self.result = self.error = None
+
+
+class ImageExecutor(object):
+    """
+    Bounded pool of threads shared by the requests of a process, running image
+    work (PIL releases the GIL while it decodes, resizes and encodes), so that
+    a large upload does not hold up the request threads of other users.
+
+    At most max_queue jobs wait for one of the workers. When they are all busy
+    and max_queue jobs are waiting, jobs run inline in the calling thread instead. Callers wait
+    timeout seconds for their job at most, then ImageWorkTimeout is raised:
+    a waiting job is dropped, a running one completes and is discarded.
+    """
+
+    def __init__(self, workers=2, max_queue=4, timeout=30):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.queue = deque()
+        self.lock = Lock()
+        self.ready = Condition(self.lock)
+        self.running = 0
+        self.submitted = self.inline = self.timeouts = self.errors = self.max_queued = 0
+        self.work_time = 0.0
+        self._stopped = False
+        self._threads = []
+
+    def stats(self):
+        with self.lock:
+            return {
+                'workers': self.workers, 'queued': len(self.queue), 'running': self.running,
+                'max_queued': self.max_queued, 'submitted': self.submitted, 'inline': self.inline,
+                'timeouts': self.timeouts, 'errors': self.errors, 'work_time': self.work_time}
+
+    def run(self, func, *args, **kwargs):
+        """Return func(*args, **kwargs), computed by a worker, or inline if none is available soon."""
+        with self.lock:
+            saturated = self._stopped or self.running + len(self.queue) >= self.workers + self.max_queue
+            if saturated:
+                self.inline += 1
+            else:
+                job = _Job(func, args, kwargs)
+                self.queue.append(job)
+                self.submitted += 1
+                self.max_queued = max(self.max_queued, len(self.queue))
+                if len(self._threads) < self.workers:
+                    thread = Thread(target=self._work, name='image-executor-{0}'.format(len(self._threads)))
+                    thread.daemon = True
+                    self._threads.append(thread)
+                    thread.start()
+                self.ready.notify()
+        if saturated:
+            return func(*args, **kwargs)
+
+        if not job.done.wait(self.timeout):
+            with self.lock:
+                self.timeouts += 1
+                job.cancelled = True
+                if job in self.queue:
+                    self.queue.remove(job)
+            raise ImageWorkTimeout('Image work did not complete in {0} seconds.'.format(self.timeout))
+        if job.error is not None:
+            raise job.error[0], job.error[1], job.error[2]
+        return job.result
+
+    def _work(self):
+        while True:
+            with self.lock:
+                while not self.queue and not self._stopped:
+                    self.ready.wait()
+                if self._stopped:
+                    return
+                job = self.queue.popleft()
+                self.running += 1
+            started = time()
+            try:
+                job.result = job.func(*job.args, **job.kwargs)
+            except Exception:
+                job.error = sys.exc_info()
+            finally:
+                with self.lock:
+                    self.running -= 1
+                    self.work_time += time() - started
+                    if job.error is not None:
+                        self.errors += 1
+                    if job.cancelled:
+                        logger.warning('Image work completed after its timeout, result discarded.')
+                job.done.set()
+
+    def stop(self):
+        """Stop the workers once their current job is done, queued jobs time out."""
+        with self.lock:
+            self._stopped = True
+            self.ready.notify_all()
+
+
+_executor = []
+
+
+def get_image_executor():
+    """
+    Return the ImageExecutor configured by settings.IMAGE_EXECUTOR, None if disabled.
+
+    IMAGE_EXECUTOR = {'WORKERS': 2, 'MAX_QUEUE': 4, 'TIMEOUT': 30}
+    """
+    config = getattr(settings, 'IMAGE_EXECUTOR', None)
+    if config is None:
+        return None
+    if not _executor:
+        _executor.append(ImageExecutor(config.get('WORKERS', 2), config.get('MAX_QUEUE', 4), config.get('TIMEOUT', 30)))
+    return _executor[0]
+
+
+@receiver(setting_changed)
+def reset_image_executor(sender, setting, **kwargs):
+    if setting == 'IMAGE_EXECUTOR' and _executor:
+        _executor[0].stop()
+        del _executor[:]
+
+
+def run_image_work(func, *args, **kwargs):
+    """Return func(*args, **kwargs), run by the image executor if it is enabled, inline otherwise."""
+    executor = get_image_executor()
+    if executor is None:
+        return func(*args, **kwargs)
+    return executor.run(func, *args, **kwargs)
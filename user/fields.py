@@ -3,7 +3,8 @@ from django.conf import settings
 from django.db import models
 from django.template.defaultfilters import filesizeformat
 from django.utils.translation import ugettext_lazy as _
-from storages.backends.s3boto import S3BotoStorage
+
+from commons.files import LazyS3Storage
 
 
 # ########################################################
@@ -19,7 +20,8 @@ from storages.backends.s3boto import S3BotoStorage
 
 class S3EnabledFileField(models.FileField):
     def __init__(self, verbose_name=None, name=None, upload_to='', storage=None, **kwargs):
-        storage = S3BotoStorage(bucket_name='ls-uploads')
+        if storage is None:
+            storage = LazyS3Storage(upload_to or settings.AWS_BUCKET_NAME)
         super(S3EnabledFileField, self).__init__(verbose_name, name, upload_to, storage, **kwargs)
 
 
@@ -30,8 +32,11 @@ class S3EnabledImageField(AnyImageField):
             formats=', '.join(allowed_extentions), size=filesizeformat(settings.MAX_UPLOAD_SIZE))
     )
 
-    def __init__(self, verbose_name=None, name=None, upload_to=None, **kwargs):
-        kwargs['storage'] = kwargs.get('storage', S3BotoStorage(bucket_name=upload_to or settings.AWS_BUCKET_NAME))
+    def __init__(self, verbose_name=None, name=None, upload_to=None, headers=None, **kwargs):
+        if kwargs.get('storage') is None:
+            # headers are sent with every upload, over settings.AWS_HEADERS
+            options = {'headers': dict(getattr(settings, 'AWS_HEADERS', {}), **headers)} if headers else {}
+            kwargs['storage'] = LazyS3Storage(upload_to or settings.AWS_BUCKET_NAME, **options)
         kwargs['help_text'] = kwargs.get('help_text') or self.help_text
         super(S3EnabledImageField, self).__init__(
             verbose_name=verbose_name,
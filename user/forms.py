@@ -1,6 +1,4 @@
 # -*- coding: utf-8 -*-
-from random import choice
-from string import digits, letters
 import os
 # import re
 
@@ -8,17 +6,22 @@ from django import forms
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.auth.forms import AuthenticationForm, PasswordResetForm
-from django.core.files.uploadedfile import SimpleUploadedFile, UploadedFile
+from django.core.files.uploadedfile import UploadedFile
+from django.db import IntegrityError
 # from django.core.mail import send_mail
 from django.template.defaultfilters import filesizeformat
 from django.utils import six
 from django.utils.encoding import force_text
 from django.utils.html import conditional_escape, format_html
 from django.utils.safestring import mark_safe
+from django.utils.text import slugify
 from django.utils.translation import ugettext_lazy as _
 from PIL import Image
 
-from user.utils import unique_slugify, resize
+from user.avatars import avatars_deferred, enqueue_avatar, save_renditions
+from user.executor import ImageWorkTimeout, run_image_work
+from user.uploads import RejectedUpload
+from user.utils import avatar_max_pixels, avatar_renditions, render_avatars, save_with_unique_slug
 
 
 class FormMixin(object):
@@ -150,6 +153,7 @@ class BaseUserCreationForm(FormMixin, forms.Form):
     """
     error_messages = {
         'duplicate_email': _("A user with that email already exists."),
+        'duplicate_fb_id': _("An user is already associated with this facebook account"),
         'password_mismatch': _("The two password fields didn't match."),
     }
     row_classes = {
@@ -185,9 +189,7 @@ class BaseUserCreationForm(FormMixin, forms.Form):
         # Since user.email is unique, this check is redundant,
         # but it sets a nicer error message than the ORM. See Django's issue #13147.
         email = self.cleaned_data["email"]
-        try:
-            self.user_class.objects.get(email=email)
-        except self.user_class.DoesNotExist:
+        if not self.user_class.objects.base_only().filter(email=email).exists():
             return email
         raise forms.ValidationError(self.error_messages['duplicate_email'])
 
@@ -201,17 +203,21 @@ class BaseUserCreationForm(FormMixin, forms.Form):
 
     def save(self):
         email = self.cleaned_data.get('email')
-        slug_name = email.split('@')[0]
-        slug = unique_slugify(slug_name, self.user_class)
         user_data = {
             'email': email,
-            'name': slug,
-            'slug': slug,
+            'name': slugify(email.split('@')[0]),
             'password': self.cleaned_data.get('password1'),
             'fb_token': self.cleaned_data.get('fb_token'),
             'fb_id': self.cleaned_data.get('fb_id'),
         }
-        user = self.user_class.objects.create_user(**user_data)
+        try:
+            user = self.user_class.objects.create_user(**user_data)
+        except IntegrityError:
+            if not user_data['fb_id']:
+                raise
+            # The facebook account is linked to another user (see BaseUser.save)
+            self._errors['fb_id'] = self.error_class([self.error_messages['duplicate_fb_id']])
+            return None
         return user
 
 
@@ -225,7 +231,9 @@ class BaseUserEditionForm(FormMixin, forms.ModelForm):
 
     error_messages = {
         'image_error': _(u"Impossible de redimentionner l'avatar."),
+        'image_timeout': _(u"Le redimensionnement de l'avatar a pris trop de temps, veuillez réessayer."),
         'image_too_big': _(u"Taille maximale autorisée: {size}. Taille de l'image: {{file_size}}".format(size=filesizeformat(settings.MAX_UPLOAD_SIZE))),
+        'image_too_large': _(u"Dimensions maximales autorisées: {max_pixels} pixels. Dimensions de l'image: {width}x{height}"),
     }
 
     row_classes = {
@@ -234,16 +242,28 @@ class BaseUserEditionForm(FormMixin, forms.ModelForm):
         '_avatar': ['form__field--avatar', ],
     }
 
+    def __init__(self, *args, **kwargs):
+        super(BaseUserEditionForm, self).__init__(*args, **kwargs)
+        # Avatar discarded by user.uploads.AvatarUploadHandler, reported by clean__avatar
+        self.rejected_avatar = None
+        if isinstance(self.files.get('_avatar'), RejectedUpload):
+            self.rejected_avatar = self.files.get('_avatar')
+            self.files = self.files.copy()
+            del self.files['_avatar']
+
     def save(self, commit=False, *args, **kwargs):
         super(BaseUserEditionForm, self).save(commit, *args, **kwargs)
         if not self.instance.id or self.change_name:
-            self.instance.slug = unique_slugify(self.instance.name, get_user_model(), name=self.instance.name)
-        self.instance.save()
-        # save small avatar
-        if self.small_avatar:
-            #Save SimpleUploadedFile into image field
-            self.instance._small_avatar.save('%s_small.%s' % (os.path.splitext(self.small_avatar.name)[0], self.small_avatar_ext), self.small_avatar)
+            save_with_unique_slug(self.instance, self.instance.name)
+        else:
+            self.instance.save()
+        # save the avatar and its renditions
+        if self.renditions:
+            save_renditions(self.instance, self.renditions, self.small_avatar_ext)
             self.instance.save()
+        # or leave them to a worker
+        if self.deferred_avatar:
+            enqueue_avatar(self.instance, *self.deferred_avatar)
         self.save_m2m()
         return self.instance
 
@@ -252,21 +272,32 @@ class BaseUserEditionForm(FormMixin, forms.ModelForm):
         self.change_name = not name == self.instance.name
         return name
 
+    def _check_limits(self, size, dimensions=None):
+        """Raise a ValidationError if an image's size in bytes or its dimensions are over the limits."""
+        if size > settings.MAX_UPLOAD_SIZE:
+            raise forms.ValidationError(self.error_messages['image_too_big'].format(file_size=filesizeformat(size)))
+        if dimensions and dimensions[0] * dimensions[1] > avatar_max_pixels():
+            raise forms.ValidationError(self.error_messages['image_too_large'].format(
+                max_pixels=avatar_max_pixels(), width=dimensions[0], height=dimensions[1]))
+
     def clean__avatar(self):
         avatar = self.cleaned_data.get('_avatar')
         self.small_avatar = None
+        self.renditions = {}
+        self.deferred_avatar = None
+        if self.rejected_avatar is not None:
+            self._check_limits(self.rejected_avatar.size, self.rejected_avatar.dimensions)
         if avatar and isinstance(avatar, UploadedFile):
             # Check file size
-            if avatar._size > settings.MAX_UPLOAD_SIZE:
-                raise forms.ValidationError(self.error_messages['image_too_big'].format(file_size=filesizeformat(avatar._size)))
-            # Generate name
-            avatar.name = "".join(choice(digits + letters) for i in range(30)) + os.path.splitext(avatar.name)[1]
+            self._check_limits(avatar._size)
             # Resize avatar
             try:
                 im = Image.open(avatar.file)
             except IOError:
                 raise forms.ValidationError(self.error_messages['image_error'])
             else:
+                # Only the header is read yet
+                self._check_limits(avatar._size, im.size)
                 IMG_TYPE = os.path.splitext(avatar.name)[1].strip('.')
                 if IMG_TYPE in ('jpeg', 'jpg'):
                     FILE_EXTENSION = 'jpeg'
@@ -276,13 +307,21 @@ class BaseUserEditionForm(FormMixin, forms.ModelForm):
                     FILE_EXTENSION = 'gif'
                 else:
                     return
-                # Create big avatar
-                avatar.file = resize(im, settings.AVATAR_SIZE, FILE_EXTENSION)
-                # Create small avatar
-                small_avatar = resize(im, settings.AVATAR_SMALLSIZE, FILE_EXTENSION)
-                #Save image to a SimpleUploadedFile which can be saved into an ImageField
-                self.small_avatar = SimpleUploadedFile(os.path.split(avatar.name)[-1], small_avatar.read(), content_type=IMG_TYPE)
+                if avatars_deferred():
+                    # Keep the current avatar until the worker is done
+                    self.deferred_avatar = (avatar, FILE_EXTENSION)
+                    return None
+                # Create all renditions from a single decoding
+                try:
+                    renditions = run_image_work(render_avatars, im, avatar_renditions(), FILE_EXTENSION)
+                except ImageWorkTimeout:
+                    raise forms.ValidationError(self.error_messages['image_timeout'])
+                # The encoded buffers are handed to the storage as they are, without copies,
+                # named after their content by save(), _avatar included
+                self.renditions = renditions
+                self.small_avatar = self.renditions.get('_small_avatar')
                 self.small_avatar_ext = FILE_EXTENSION
+                return None
         return avatar
 
 
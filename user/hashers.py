@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+from django.conf import settings
+from django.contrib.auth import hashers
+
+
+class PBKDF2PasswordHasher(hashers.PBKDF2PasswordHasher):
+    """
+    Django's PBKDF2 hasher, with settings.PASSWORD_ITERATIONS iterations.
+
+    Hashes made with another iteration count are updated on the next
+    successful login (see BaseUser.check_password), so the count can be
+    tuned (manage.py calibrate_hashers) without password resets.
+    """
+
+    @property
+    def iterations(self):
+        return getattr(settings, 'PASSWORD_ITERATIONS', hashers.PBKDF2PasswordHasher.iterations)
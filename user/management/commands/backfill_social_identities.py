@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+from optparse import make_option
+
+import simplejson as json
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction, IntegrityError
+
+from user.models import SocialIdentity, token_columns
+
+
+class Command(BaseCommand):
+    help = 'Create facebook social identities from the legacy _fb_id/_fb_token user columns, in batches.'
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', default=500, help='Number of users read per transaction.'),
+    )
+
+    def handle(self, *args, **options):
+        model = get_user_model()
+        qn = connection.ops.quote_name
+        # The legacy columns are not model fields anymore
+        sql = 'SELECT {pk}, {fb_id}, {fb_token}, {last_login} FROM {table} WHERE {fb_id} IS NOT NULL AND {pk} > %s ORDER BY {pk} LIMIT %s'.format(
+            table=qn(model._meta.db_table), pk=qn(model._meta.pk.column),
+            fb_id=qn('_fb_id'), fb_token=qn('_fb_token'), last_login=qn('last_login'))
+        cursor = connection.cursor()
+        columns = [column[0] for column in connection.introspection.get_table_description(cursor, model._meta.db_table)]
+        if not set(['_fb_id', '_fb_token']) <= set(columns):
+            raise CommandError('No legacy _fb_id/_fb_token columns on {0}.'.format(model._meta.db_table))
+        created = skipped = last_pk = 0
+
+        while True:
+            cursor.execute(sql, [last_pk, options['batch_size']])
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            last_pk = rows[-1][0]
+
+            linked = set(SocialIdentity.objects.filter(
+                provider=SocialIdentity.FACEBOOK, user__in=[row[0] for row in rows]).values_list('user_id', flat=True))
+            identities = []
+            for pk, fb_id, raw_token, last_login in rows:
+                if pk in linked:
+                    continue
+                identity = SocialIdentity(provider=SocialIdentity.FACEBOOK, uid=str(fb_id), user_id=pk)
+                try:
+                    token = json.loads(raw_token) if raw_token else None
+                except ValueError:
+                    token = None
+                if isinstance(token, dict):
+                    identity.token = token
+                    # The token was last obtained at the latest facebook login
+                    identity.access_token, identity.expires_at, identity.scopes = token_columns(token, issued_at=last_login)
+                identities.append(identity)
+            try:
+                with transaction.atomic():
+                    SocialIdentity.objects.bulk_create(identities)
+                created += len(identities)
+            except IntegrityError:
+                # Legacy rows had no unique constraint, link duplicated accounts once
+                for identity in identities:
+                    try:
+                        with transaction.atomic():
+                            identity.save()
+                        created += 1
+                    except IntegrityError:
+                        skipped += 1
+
+        self.stdout.write('{0} identities created, {1} duplicated accounts skipped.'.format(created, skipped))
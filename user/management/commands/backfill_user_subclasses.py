@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db.models import get_models
+
+from user.models import subclass_path
+
+
+class Command(BaseCommand):
+    help = 'Fill the _subclass column of users created before it, with one update per user subclass.'
+
+    def handle(self, *args, **options):
+        root = get_user_model()
+        subclasses = [model for model in get_models() if issubclass(model, root) and model is not root and not model._meta.proxy]
+        # Deeper subclasses are updated last and win
+        for model in sorted(subclasses, key=lambda model: len(model._meta.get_parent_list())):
+            path = subclass_path(model, root)
+            count = root._base_manager.filter(pk__in=model._base_manager.values('pk')).update(_subclass=path)
+            self.stdout.write('{0}: {1} users.'.format(model.__name__, count))
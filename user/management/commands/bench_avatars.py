@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+import ctypes
+import os
+import shutil
+from optparse import make_option
+from StringIO import StringIO
+from tempfile import mkdtemp
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.core.management.base import BaseCommand
+from PIL import Image
+
+from commons.management.commands.bench_encoders import best_of
+from user.utils import avatar_renditions, render_avatars, resize
+
+# (label, (width, height), format) of the generated images
+SAMPLES = (
+    ('12MP photo', (4000, 3000), 'jpeg'),
+    ('2MP photo', (1600, 1200), 'jpeg'),
+    ('portrait photo', (1200, 1600), 'jpeg'),
+    ('png', (1000, 800), 'png'),
+)
+
+
+def sample_image(size, ext):
+    """Return the bytes of a smooth, photo like, image of size."""
+    img = Image.frombytes('RGB', (40, 30), os.urandom(40 * 30 * 3)).resize(size, Image.BILINEAR)
+    output = StringIO()
+    if ext == 'jpeg':
+        img.save(output, ext, quality=90)
+    else:
+        img.save(output, ext)
+    return output.getvalue()
+
+
+def _memory_status(field):
+    with open('/proc/self/status') as status:
+        for line in status:
+            if line.startswith(field + ':'):
+                return int(line.split()[1])
+
+
+def peak_memory(func, *args):
+    """
+    Return the peak resident memory, in KB, added by func(*args), run in a
+    forked process whose peak is reset first. None without Linux's /proc.
+    """
+    if not os.path.exists('/proc/self/clear_refs'):
+        return None
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if not pid:
+        try:
+            os.close(read_fd)
+            try:
+                # Give back the memory freed by the parent, to be measured when it is used again
+                ctypes.CDLL('libc.so.6').malloc_trim(0)
+            except (OSError, AttributeError):
+                pass
+            with open('/proc/self/clear_refs', 'w') as clear_refs:
+                clear_refs.write('5')
+            start = _memory_status('VmRSS')
+            func(*args)
+            os.write(write_fd, str(_memory_status('VmHWM') - start))
+        finally:
+            os._exit(0)
+    os.close(write_fd)
+    os.waitpid(pid, 0)
+    with os.fdopen(read_fd) as result:
+        peak = result.read()
+    return int(peak) if peak else None
+
+
+class Command(BaseCommand):
+    help = (
+        'Compare the avatar renditions pipeline with one resize per size of the fully decoded upload, '
+        'the peak memory of an upload stored with and without copies of the encoded renditions, '
+        'and the bytes of the renditions encoded with PIL defaults and with their profiles.')
+    option_list = BaseCommand.option_list + (
+        make_option('--rounds', type='int', default=3, help='Number of rounds, the best one is kept.'),
+    )
+
+    def handle(self, *args, **options):
+        renditions = avatar_renditions()
+        root = mkdtemp()
+        storage = FileSystemStorage(location=root)
+
+        def before(data, ext):
+            img = Image.open(StringIO(data))
+            for name, size in renditions:
+                resize(img, size, ext)
+
+        def after(data, ext):
+            render_avatars(Image.open(StringIO(data)), renditions, ext)
+
+        def store_resized(data, ext):
+            img = Image.open(StringIO(data))
+            for name, size in renditions:
+                storage.save(name + '.' + ext, ContentFile(resize(img, size, ext).read()))
+
+        def store_copies(data, ext):
+            for name, rendition in render_avatars(Image.open(StringIO(data)), renditions, ext).iteritems():
+                storage.save(name + '.' + ext, ContentFile(rendition.file.getvalue()))
+
+        def store(data, ext):
+            for name, rendition in render_avatars(Image.open(StringIO(data)), renditions, ext).iteritems():
+                storage.save(name + '.' + ext, rendition)
+
+        def kilobytes(peak):
+            return 'n/a' if peak is None else peak
+
+        try:
+            self.stdout.write('Renditions: {0}'.format(', '.join('{0} {1}x{2}'.format(name, *size) for name, size in renditions)))
+            self.stdout.write('{0:>16} {1:>10} {2:>12} {3:>12}'.format('image', 'bytes', 'before ms', 'after ms'))
+            for label, size, ext in SAMPLES:
+                data = sample_image(size, ext)
+                self.stdout.write('{0:>16} {1:>10} {2:>12.1f} {3:>12.1f}'.format(
+                    label, len(data),
+                    best_of(options['rounds'], before, data, ext) * 1000,
+                    best_of(options['rounds'], after, data, ext) * 1000))
+
+            self.stdout.write('Peak memory of an upload, stored (KB): resize per size, renditions copied, renditions handed over')
+            self.stdout.write('{0:>16} {1:>10} {2:>12} {3:>12} {4:>12}'.format('image', 'bytes', 'resized', 'copied', 'handed'))
+            for label, size, ext in SAMPLES:
+                data = sample_image(size, ext)
+                self.stdout.write('{0:>16} {1:>10} {2:>12} {3:>12} {4:>12}'.format(
+                    label, len(data),
+                    kilobytes(peak_memory(store_resized, data, ext)),
+                    kilobytes(peak_memory(store_copies, data, ext)),
+                    kilobytes(peak_memory(store, data, ext))))
+
+            self.stdout.write('Encoded bytes (format): PIL defaults, profiles (AVATAR_PROFILES)')
+            self.stdout.write('{0:>16} {1:>16} {2:>18} {3:>18}'.format('image', 'rendition', 'defaults', 'profiles'))
+            defaults = dict((name, {}) for name, size in renditions)
+            for label, size, ext in SAMPLES:
+                data = sample_image(size, ext)
+                encoded = render_avatars(Image.open(StringIO(data)), renditions, ext, defaults)
+                profiled = render_avatars(Image.open(StringIO(data)), renditions, ext)
+                for name, size in renditions:
+                    self.stdout.write('{0:>16} {1:>16} {2:>18} {3:>18}'.format(
+                        label, name,
+                        '{0} ({1})'.format(encoded[name].size, encoded[name].name.split('.')[-1]),
+                        '{0} ({1})'.format(profiled[name].size, profiled[name].name.split('.')[-1])))
+        finally:
+            shutil.rmtree(root)
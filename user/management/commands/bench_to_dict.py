@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+from optparse import make_option
+from timeit import default_timer
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import models
+from django.db.models.manager import Manager
+from django.db.models.fields.files import FieldFile
+
+from commons.models import DATE_TYPES, get_attr
+
+
+def legacy_to_dict(obj, fields=None, exclude=None, chain=None):
+    """Model.to_dict as it was before serialization plans, kept as a baseline."""
+    if not chain:
+        chain = []
+    stop = obj in chain
+    chain.append(obj)
+
+    all_fields = set(obj._meta.get_all_field_names())
+    # Bookkeeping fields are left out as by SerializationPlan, for the results to compare
+    bookkeeping = set(f.name for f in obj._meta.fields if f.name.startswith('_') and not f.editable)
+    fields = set(fields) & all_fields if fields else all_fields - bookkeeping
+    # And so are subclasses
+    fields -= set(r.get_accessor_name() for r in obj._meta.get_all_related_objects() if r.field.rel.parent_link)
+    exclude = set(exclude) & all_fields if exclude else set()
+    fields -= exclude
+
+    _dict = dict(get_attr(obj, field) for field in fields if hasattr(obj, field))
+    related_managers = dict((name, field) for name, field in _dict.iteritems() if isinstance(field, Manager))
+    for name in related_managers:
+        del _dict[name]
+    models_ = dict((name, field) for name, field in _dict.iteritems() if isinstance(field, models.Model))
+    for name, model in models_.iteritems():
+        if not stop:
+            _dict[name] = legacy_to_dict(model, chain=chain)
+        else:
+            del _dict[name]
+    files = dict((name, file_.url if file_ else None) for name, file_ in _dict.iteritems() if isinstance(file_, FieldFile))
+    _dict.update(files)
+    dates = dict((name, str(date_)) for name, date_ in _dict.iteritems() if isinstance(date_, DATE_TYPES))
+    _dict.update(dates)
+    return _dict
+
+
+class Command(BaseCommand):
+    help = 'Compare Model.to_dict against the legacy implementation on unsaved users.'
+    option_list = BaseCommand.option_list + (
+        make_option('--users', type='int', default=500, help='Number of users serialized per round.'),
+        make_option('--rounds', type='int', default=5, help='Number of rounds, the best one is kept.'),
+    )
+
+    def handle(self, *args, **options):
+        UserModel = get_user_model()
+        users = [
+            UserModel(id=i, email='user%d@example.com' % i, name='User %d' % i, slug='user-%d' % i)
+            for i in xrange(options['users'])]
+
+        assert [legacy_to_dict(u) for u in users] == [u.to_dict() for u in users]
+
+        for label, serialize in (('legacy', legacy_to_dict), ('plan', lambda u: u.to_dict())):
+            best = None
+            for _ in xrange(options['rounds']):
+                start = default_timer()
+                for user in users:
+                    serialize(user)
+                elapsed = default_timer() - start
+                best = elapsed if best is None else min(best, elapsed)
+            self.stdout.write('{0:>8}: {1:.2f} ms ({2:.1f} us/user)'.format(
+                label, best * 1000, best * 1e6 / len(users)))
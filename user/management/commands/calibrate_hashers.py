@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+from math import log
+from optparse import make_option
+from timeit import default_timer
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils.module_loading import import_by_path
+
+from user.hashers import PBKDF2PasswordHasher
+
+
+def time_hasher(hasher, rounds):
+    """Return the best time, in seconds, of hashing a password with hasher."""
+    salt = hasher.salt()
+    best = None
+    for _ in xrange(rounds):
+        start = default_timer()
+        hasher.encode('calibration password', salt)
+        elapsed = default_timer() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+class Command(BaseCommand):
+    help = 'Time the configured password hashers on this host and recommend their work factor for a target latency.'
+    option_list = BaseCommand.option_list + (
+        make_option('--target-ms', type='float', default=100, help='Wanted time to hash or check a password, in milliseconds.'),
+        make_option('--rounds', type='int', default=5, help='Number of timings, the best one is kept.'),
+    )
+
+    def handle(self, *args, **options):
+        target = options['target_ms'] / 1000.0
+        for path in settings.PASSWORD_HASHERS:
+            hasher = import_by_path(path)()
+            try:
+                elapsed = time_hasher(hasher, options['rounds'])
+            except ValueError, e:
+                # Missing library (bcrypt)
+                self.stdout.write('{0}: {1}'.format(hasher.algorithm, e))
+                continue
+            line = '{0}: {1:.1f}ms'.format(hasher.algorithm, elapsed * 1000)
+            if hasattr(hasher, 'iterations'):
+                # Hashing time is linear in the number of iterations
+                recommended = max(1000, int(round(hasher.iterations * target / elapsed, -3)))
+                line += ' with {0} iterations, recommended: {1} iterations'.format(hasher.iterations, recommended)
+                if isinstance(hasher, PBKDF2PasswordHasher):
+                    line += ' (PASSWORD_ITERATIONS = {0})'.format(recommended)
+            elif hasattr(hasher, 'rounds'):
+                # bcrypt rounds are a log2 of the work factor
+                recommended = max(4, hasher.rounds + int(round(log(target / elapsed, 2))))
+                line += ' with {0} rounds, recommended: {1} rounds'.format(hasher.rounds, recommended)
+            self.stdout.write(line)
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from commons.encoders import ENCODERS
+from user.utils import export_users
+
+
+class Command(BaseCommand):
+    help = 'Export all users with one of the registered encoders, with flat memory usage.'
+    option_list = BaseCommand.option_list + (
+        make_option('--format', default='json', help='One of: {0}.'.format(', '.join(sorted(ENCODERS)))),
+        make_option('--output', default=None, help='File to write to, standard output by default.'),
+    )
+
+    def handle(self, *args, **options):
+        if options['format'] not in ENCODERS:
+            raise CommandError('Unknown format: {0}.'.format(options['format']))
+        chunks = export_users(options['format'])
+
+        if options['output']:
+            with open(options['output'], 'wb') as output:
+                for chunk in chunks:
+                    output.write(chunk)
+        else:
+            for chunk in chunks:
+                self.stdout.write(chunk, ending='')
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+import csv
+from optparse import make_option
+
+import simplejson as json
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    args = '<file>'
+    help = 'Create users from a JSON lines or CSV file (with a header line), hashing passwords in parallel.'
+    option_list = BaseCommand.option_list + (
+        make_option('--format', default=None, help='jsonl or csv, guessed from the file extension by default.'),
+        make_option('--processes', type='int', default=None, help='Number of password hashing processes.'),
+        make_option('--batch-size', type='int', default=None, help='Number of users inserted per query.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Usage: import_users {0}'.format(self.args))
+        format_ = options['format'] or args[0].rsplit('.', 1)[-1]
+        with open(args[0], 'rb') as input_:
+            if format_ == 'jsonl':
+                rows = [json.loads(line) for line in input_ if line.strip()]
+            elif format_ == 'csv':
+                rows = [dict((key, value.decode('utf-8')) for key, value in row.iteritems()) for row in csv.DictReader(input_)]
+            else:
+                raise CommandError('Unknown format: {0}.'.format(format_))
+
+        def progress(stage, done, total):
+            self.stdout.write('{0}: {1}/{2}'.format(stage, done, total))
+
+        try:
+            users, timings = get_user_model().objects.bulk_create_users(
+                rows, processes=options['processes'], batch_size=options['batch_size'], progress=progress)
+        except ValueError, e:
+            raise CommandError(e)
+        for stage in ('prepare', 'hash', 'slugs', 'insert'):
+            self.stdout.write('{0}: {1:.2f}s'.format(stage, timings[stage]))
+        self.stdout.write('{0} users created.'.format(len(users)))
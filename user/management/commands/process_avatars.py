@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from optparse import make_option
+from time import sleep
+
+from django.core.management.base import BaseCommand
+
+from user.avatars import run_avatar_jobs
+from user.models import AvatarJob
+
+
+class Command(BaseCommand):
+    help = 'Make the renditions of avatars uploaded with AVATAR_DEFERRED, until interrupted.'
+    option_list = BaseCommand.option_list + (
+        make_option('--batch', type='int', default=10, help='Number of jobs claimed at once.'),
+        make_option('--attempts', type='int', default=3, help='Number of attempts before a job is failed.'),
+        make_option('--sleep', type='float', default=2, help='Seconds to wait when there is no job.'),
+        make_option('--once', action='store_true', default=False, help='Stop when there is no job left.'),
+    )
+
+    def handle(self, *args, **options):
+        while True:
+            jobs = run_avatar_jobs(options['batch'], options['attempts'])
+            for job in jobs:
+                self.stdout.write('Job {0} of user {1}: {2}{3}'.format(
+                    job.pk, job.user_id, job.status, ' ({0})'.format(job.error) if job.status != AvatarJob.DONE else ''))
+            if not jobs:
+                if options['once']:
+                    break
+                sleep(options['sleep'])
@@ -0,0 +1,14 @@
+# -*- coding: utf-8 -*-
+from user.activity import get_activity_tracker
+
+
+class ActivityMiddleware(object):
+    """
+    Record the last_seen time of authenticated users through the activity
+    tracker (settings.USER_ACTIVITY), does nothing when it is disabled.
+    Must come after django's AuthenticationMiddleware.
+    """
+    def process_request(self, request):
+        tracker = get_activity_tracker()
+        if tracker is not None and request.user.is_authenticated():
+            tracker.record('last_seen', request.user.pk)
@@ -1,26 +1,152 @@
 # -*- coding: utf-8 -*-
+from datetime import datetime, timedelta
+from itertools import islice
+from time import time
+
 import simplejson as json
 
 from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.contrib.auth.hashers import make_password
-from django.contrib.auth.models import (AbstractBaseUser, BaseUserManager, PermissionsMixin)
-from django.core.exceptions import ValidationError
-from django.db import models
-from django.utils.timezone import now
+from django.contrib.auth.hashers import make_password, check_password
+from django.contrib.auth.models import (AbstractBaseUser, BaseUserManager, PermissionsMixin, update_last_login)
+from django.contrib.auth.signals import user_logged_in
+from django.db import models, transaction, IntegrityError
+from django.db.models.constants import LOOKUP_SEP
+from django.utils.timezone import now, utc
 from django.utils.translation import ugettext_lazy as _
-from facebook import GraphAPI, GraphAPIError
-from model_utils.managers import InheritanceManager
+from model_utils.managers import InheritanceManager, InheritanceQuerySet
 
+from user.activity import ActivityTracker, get_activity_tracker, record_login
+from user.cache import get_user_cache
 from user.fields import S3EnabledImageField
-from commons.models import Model
+from user.utils import avatar_placeholder, fb_avatar_url, hash_passwords, save_with_unique_slug, unique_slugs
+from commons.cache import invalidate_serialized
+from commons.files import file_url
+from commons.models import Model, SerializableManagerMixin, SerializableQuerySet, PREFETCH_CHUNK_SIZE
+
 
+# Headers of stored avatars, cached for a year without revalidation
+AVATAR_HEADERS = {'Cache-Control': getattr(settings, 'AVATAR_CACHE_CONTROL', 'public, max-age=31536000, immutable')}
 
 # Lazily return the user model to avoid inheritence problems.
 _lazy_user_model = lambda *args, **kwargs: get_user_model()(*args, **kwargs)
 
 
-class UserManager(InheritanceManager, BaseUserManager):
+def token_columns(token, issued_at=None):
+    """
+    Return the (access token, expiry, scopes) stored in columns for an oauth token dict.
+
+    Facebook gives the token lifetime in seconds ('expires'), counted from
+    issued_at (now by default). An explicit 'expires_at' timestamp wins.
+    """
+    if not token:
+        return None, None, None
+    expires_at = None
+    try:
+        if token.get('expires_at'):
+            expires_at = datetime.fromtimestamp(int(token['expires_at']), utc)
+        elif token.get('expires'):
+            expires_at = (issued_at or now()) + timedelta(seconds=int(token['expires']))
+    except (TypeError, ValueError):
+        pass
+    scopes = token.get('scopes') or token.get('scope') or None
+    if isinstance(scopes, (list, tuple)):
+        scopes = ','.join(scopes)
+    return token.get('access_token'), expires_at, scopes
+
+
+def subclass_path(model, root):
+    """Return the 'child__grandchild' lookup from root to its subclass model, '' for root."""
+    names = []
+    model = model._meta.concrete_model
+    while model is not root:
+        parent, link = [(parent, link) for parent, link in model._meta.parents.items() if issubclass(parent, root)][0]
+        names.insert(0, link.related.get_accessor_name())
+        model = parent
+    return LOOKUP_SEP.join(names)
+
+
+def subclass_model(path, root):
+    """Return the subclass of root reached through the lookup path."""
+    model = root
+    for name in path.split(LOOKUP_SEP) if path else ():
+        model = getattr(model, name).related.model
+    return model
+
+
+class UserQuerySet(InheritanceQuerySet, SerializableQuerySet):
+    """
+    Querysets of users, with subclasses selection and serialization.
+
+    With load_subclasses() (the manager's default), users are loaded in two
+    phases: base rows first, then, for each subclass found in their _subclass
+    column, the rows of that subclass, in one query. select_subclasses() joins
+    every subclass table in a single query instead, base_only() skips subclasses.
+    """
+    polymorphic = False
+
+    def _clone(self, klass=None, setup=False, **kwargs):
+        kwargs.setdefault('polymorphic', self.polymorphic)
+        return super(UserQuerySet, self)._clone(klass, setup, **kwargs)
+
+    def load_subclasses(self):
+        """Return users as instances of their subclass, loaded in two phases."""
+        queryset = self._clone(polymorphic=True)
+        queryset.subclasses = []
+        return queryset
+
+    def base_only(self):
+        """Return users as instances of the queryset's model, without any subclass lookup."""
+        queryset = self._clone(polymorphic=False)
+        queryset.subclasses = []
+        return queryset
+
+    def select_subclasses(self, *subclasses):
+        queryset = super(UserQuerySet, self).select_subclasses(*subclasses)
+        queryset.polymorphic = False
+        return queryset
+
+    def iterator(self):
+        objs = super(UserQuerySet, self).iterator()
+        if not self.polymorphic:
+            return objs
+        return self._iter_subclasses(objs)
+
+    def _iter_subclasses(self, objs):
+        while True:
+            chunk = list(islice(objs, PREFETCH_CHUNK_SIZE))
+            if not chunk:
+                return
+            for obj in self._replace_subclasses(chunk):
+                yield obj
+
+    def _replace_subclasses(self, objs):
+        """Return objs, with the ones belonging to a subclass replaced by subclass instances."""
+        root = self.model._meta.get_field('_subclass').model
+        own_path = subclass_path(self.model, root)
+        pks_by_path = {}
+        for obj in objs:
+            if obj._subclass != own_path:
+                pks_by_path.setdefault(obj._subclass, []).append(obj.pk)
+        if not pks_by_path:
+            return objs
+
+        subclass_objs = {}
+        for path, pks in pks_by_path.iteritems():
+            queryset = subclass_model(path, root)._base_manager.using(self.db).filter(pk__in=pks)
+            queryset.query.select_related = self.query.select_related
+            subclass_objs.update((obj.pk, obj) for obj in queryset)
+        annotated = getattr(self, '_annotated', None) or ()
+        for obj in objs:
+            sub_obj = subclass_objs.get(obj.pk)
+            if sub_obj is not None:
+                for name in annotated:
+                    setattr(sub_obj, name, getattr(obj, name))
+        # Rows removed from a subclass table in between stay base instances
+        return [subclass_objs.get(obj.pk, obj) for obj in objs]
+
+
+class UserManager(SerializableManagerMixin, InheritanceManager, BaseUserManager):
     """Custom user manager class."""
 
     @classmethod
@@ -30,7 +156,10 @@ class UserManager(InheritanceManager, BaseUserManager):
         password = make_password(password)
 
         user = _class(email=email, password=password, **kwargs)
-        user.save()
+        if user.slug:
+            user.save()
+        else:
+            save_with_unique_slug(user, user.name or email.split('@')[0])
         return user
 
     @classmethod
@@ -42,8 +171,70 @@ class UserManager(InheritanceManager, BaseUserManager):
             is_superuser=True,
             **kwargs)
 
+    def bulk_create_users(self, rows, processes=None, batch_size=None, progress=None):
+        """
+        Create users from dicts of field values, with the password in clear.
+
+        - Passwords are hashed by a pool of processes (see user.utils.hash_passwords).
+        - Slugs are allocated for all users at once, from 'slug', 'name' or the email.
+        - Users are inserted with bulk_create, batch_size at a time
+          (settings.USER_BULK_CREATE_BATCH_SIZE), in a single transaction.
+
+        Raise ValueError if an email is duplicated or already used.
+        progress(stage, done, total) is called along the way. Return the created
+        users (without primary key on most databases) and {stage: seconds}.
+        """
+        if batch_size is None:
+            batch_size = getattr(settings, 'USER_BULK_CREATE_BATCH_SIZE', 500)
+        progress = progress or (lambda stage, done, total: None)
+        timings = {}
+
+        start = time()
+        rows = [dict(row) for row in rows]
+        total = len(rows)
+        for row in rows:
+            row['email'] = self.normalize_email(row['email'])
+        emails = [row['email'] for row in rows]
+        seen, duplicates = set(), set()
+        for email in emails:
+            (duplicates if email in seen else seen).add(email)
+        for offset in xrange(0, total, batch_size):
+            duplicates.update(self.base_only().filter(email__in=emails[offset:offset + batch_size]).values_list('email', flat=True))
+        if duplicates:
+            raise ValueError('Duplicated or existing emails: {0}.'.format(', '.join(sorted(duplicates)[:10])))
+        timings['prepare'] = time() - start
+        progress('prepare', total, total)
+
+        start = time()
+        passwords = hash_passwords(
+            [row.pop('password', None) for row in rows], processes,
+            lambda done, total: progress('hash', done, total))
+        timings['hash'] = time() - start
+
+        start = time()
+        slugs = unique_slugs([row.pop('slug', None) or row.get('name') or row['email'].split('@')[0] for row in rows], self.model)
+        timings['slugs'] = time() - start
+        progress('slugs', total, total)
+
+        start = time()
+        path = subclass_path(self.model, self.model._meta.get_field('_subclass').model)
+        users = []
+        for row, password, slug in zip(rows, passwords, slugs):
+            row.setdefault('name', slug)
+            users.append(self.model(password=password, slug=slug, _subclass=path, **row))
+        with transaction.atomic(using=self.db):
+            for offset in xrange(0, total, batch_size):
+                self.bulk_create(users[offset:offset + batch_size])
+                progress('insert', min(offset + batch_size, total), total)
+        timings['insert'] = time() - start
+        return users, timings
+
     def get_query_set(self):
-        return super(UserManager, self).get_query_set().select_subclasses()
+        return UserQuerySet(self.model, using=self._db).load_subclasses()
+
+    def base_only(self):
+        """Users as base instances, for existence checks and authentication."""
+        return self.get_query_set().base_only()
 
 
 class BaseUser(Model, AbstractBaseUser, PermissionsMixin):
@@ -52,14 +243,19 @@ class BaseUser(Model, AbstractBaseUser, PermissionsMixin):
     is_active = models.BooleanField(_('active account'), default=True)
     is_staff = models.BooleanField(_('staff member'), default=False)
     created_at = models.DateTimeField(_('created at'), default=now())
+    # Written by user.activity.ActivityTracker, with last_login
+    last_seen = models.DateTimeField(_('last seen'), null=True, default=None, blank=True)
     slug = models.CharField(max_length=130, unique=True)
     # Editable profile
     name = models.CharField(_('name'), max_length=120)
-    _fb_token = models.CharField(_('facebook token'), default=None, blank=True, null=True, max_length=300)
-    _fb_id = models.PositiveIntegerField(_('facebook id'), default=None, blank=True, null=True, max_length=15)
+    # Lookup from BaseUser to the row's subclass ('' for base users), see UserQuerySet
+    _subclass = models.CharField(max_length=100, default='', blank=True, editable=False)
 
-    _avatar = S3EnabledImageField(_('avatar'), upload_to=settings.AWS_UPLOAD_BUCKET, null=True, max_length=300, default=None, blank=True)
-    _small_avatar = S3EnabledImageField(_('avatar (small)'), upload_to=settings.AWS_UPLOAD_BUCKET, null=True, max_length=300, default=None, blank=True)
+    # Avatars are named after their content (see user.avatars.store_content), stored files never change
+    _avatar = S3EnabledImageField(_('avatar'), upload_to=settings.AWS_UPLOAD_BUCKET, headers=AVATAR_HEADERS, null=True, max_length=300, default=None, blank=True)
+    _small_avatar = S3EnabledImageField(_('avatar (small)'), upload_to=settings.AWS_UPLOAD_BUCKET, headers=AVATAR_HEADERS, null=True, max_length=300, default=None, blank=True)
+    # An AvatarJob is making the renditions of a new avatar, see user.avatars
+    _avatar_pending = models.BooleanField(default=False, editable=False)
 
     USERNAME_FIELD = 'email'
 
@@ -71,6 +267,24 @@ class BaseUser(Model, AbstractBaseUser, PermissionsMixin):
     def __str__(self):
         return str(self.email)
 
+    def check_password(self, raw_password):
+        """
+        Return whether raw_password is correct.
+        On success, a hash made with outdated parameters is replaced (see rehash_password).
+        """
+        return check_password(raw_password, self.password, self.rehash_password)
+
+    def rehash_password(self, raw_password):
+        """
+        Hash raw_password with the preferred hasher, and store it unless the
+        password was changed since this user was loaded.
+        """
+        old_password = self.password
+        self.set_password(raw_password)
+        if self.pk and BaseUser._base_manager.filter(pk=self.pk, password=old_password).update(password=self.password):
+            invalidate_serialized(BaseUser, self)
+            get_user_cache().invalidate(self.pk)
+
     def _get_name(self):
         """Return self.name as both long and short name."""
         return self.name
@@ -83,49 +297,100 @@ class BaseUser(Model, AbstractBaseUser, PermissionsMixin):
 
     @property
     def avatar(self):
-        """Return User's avatar's url."""
-        avatar = None
-        if self._avatar:
-            avatar = self._avatar.url
-        return avatar
+        """Return User's avatar's url, a placeholder while a new one is processed."""
+        if self._avatar_pending:
+            return avatar_placeholder()
+        return file_url(self._avatar)
 
     @property
     def small_avatar(self):
-        """Return User's small avatar's url."""
+        """Return User's small avatar's url, a placeholder while a new one is processed."""
+        if self._avatar_pending:
+            return avatar_placeholder()
         avatar = None
         if self._small_avatar and self._avatar:
-            avatar = self._small_avatar.url
+            avatar = file_url(self._small_avatar)
         return avatar
 
+    def _get_fb_identity(self, create=False):
+        """Return the facebook SocialIdentity of this user, memoized, None if not linked."""
+        if not hasattr(self, '_fb_identity'):
+            self._fb_identity = None
+            if self.pk:
+                self._fb_identity = SocialIdentity.objects.filter(user=self, provider=SocialIdentity.FACEBOOK).first()
+        if self._fb_identity is None and create:
+            self._fb_identity = SocialIdentity(provider=SocialIdentity.FACEBOOK)
+        return self._fb_identity
+
     @property
     def fb_token(self):
         """Return facebook informations as dict."""
-        if self._fb_token:
-            return json.loads(self._fb_token)
-        return self._fb_token
+        identity = self._get_fb_identity()
+        return identity.token if identity else None
 
     @fb_token.setter
     def fb_token(self, fb_token):
-        """Save facebook informations as a string."""
-        if fb_token:
-            fb_token = dict(fb_token)
-            self._fb_token = json.dumps(fb_token)
-        else:
-            self._fb_token = None
+        """Save facebook informations with the facebook identity, on save."""
+        if fb_token or self._get_fb_identity():
+            self._get_fb_identity(create=True).token = fb_token
+            self._fb_identity_changed = True
+
+    def fb_token_expired(self):
+        """Return whether the facebook token is known to be expired."""
+        identity = self._get_fb_identity()
+        return identity is not None and identity.expired()
 
     @property
     def fb_id(self):
-        return self._fb_id
+        identity = self._get_fb_identity()
+        return int(identity.uid) if identity and identity.uid else None
 
     @fb_id.setter
     def fb_id(self, fb_id):
-        """Save fb_id as int."""
+        """
+        Link this user to the facebook account fb_id, on save.
+        Unlink it when fb_id is None.
+        """
         if fb_id:
-            if BaseUser.objects.filter(_fb_id=fb_id).exists():
-                raise ValidationError(_('An user is already associated with this facebook account'))
-            self._fb_id = int(fb_id)
-        else:
-            self._fb_id = None
+            self._get_fb_identity(create=True).uid = str(int(fb_id))
+            self._fb_identity_changed = True
+        elif self._get_fb_identity():
+            self._fb_identity.uid = None
+            self._fb_identity_changed = True
+
+    def save(self, *args, **kwargs):
+        """
+        Save the user and its facebook identity.
+        Raise IntegrityError if the facebook account is linked to another user.
+        With an activity tracker, last_login and last_seen are only written by its
+        UPDATEs: full saves of users loaded before a flush would write back old times.
+        """
+        if (not args and kwargs.get('update_fields') is None and not kwargs.get('force_insert')
+                and not self._state.adding and get_activity_tracker() is not None):
+            kwargs['update_fields'] = [f.name for f in self._meta.concrete_fields
+                                       if not f.primary_key and f.name not in ActivityTracker.fields]
+        path = subclass_path(self.__class__, BaseUser)
+        if path and self._subclass != path and not self._subclass.startswith(path + LOOKUP_SEP):
+            # Saving a subclass instance never downgrades a deeper subclass
+            self._subclass = path
+        if not getattr(self, '_fb_identity_changed', False):
+            return super(BaseUser, self).save(*args, **kwargs)
+        with transaction.atomic():
+            super(BaseUser, self).save(*args, **kwargs)
+            identity, self._fb_identity_changed = self._fb_identity, False
+            if not identity.uid:
+                if identity.pk:
+                    identity.delete()
+                self._fb_identity = None
+                return
+            identity.user = self
+            try:
+                with transaction.atomic():
+                    identity.save()
+            except IntegrityError:
+                # Reload the identity actually stored on next access
+                del self._fb_identity
+                raise
 
     def fb_is_connected(self):
         """
@@ -135,16 +400,106 @@ class BaseUser(Model, AbstractBaseUser, PermissionsMixin):
         return self.fb_id and self.fb_token
 
     def fb_avatar(self):
+        """Return the url of the user's facebook picture, cached (see user.utils.get_fb_avatar_cache)."""
         if not self.fb_is_connected():
             return None
-        json_token = self.fb_token
-        access_token = json_token.get(_('access_token'))
-        try:
-            # TODO : manage invalid/expired token (is this enough?)
-            g = GraphAPI(access_token)
-            data = g.get('me/picture', params={'redirect': 'false', })
-        except GraphAPIError:
-            return None
+        identity = self._get_fb_identity()
+        return fb_avatar_url(identity.uid, identity.access_token)
 
-        avatar = data.get('data').get('url')
-        return avatar
+
+class SocialIdentity(models.Model):
+    """
+    Account of a user on a social network (provider), with its token.
+    A provider account (uid) is linked to one user, a user to one account per provider.
+    """
+    FACEBOOK = 'facebook'
+
+    provider = models.CharField(_('provider'), max_length=30)
+    uid = models.CharField(_('account id'), max_length=255)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, related_name='social_identities')
+    _token = models.TextField(_('token'), default=None, blank=True, null=True)
+    # Structured copy of _token, kept in sync by the token setter
+    access_token = models.CharField(_('access token'), default=None, blank=True, null=True, max_length=255, db_index=True)
+    expires_at = models.DateTimeField(_('token expiry'), default=None, blank=True, null=True, db_index=True)
+    scopes = models.CharField(_('scopes'), default=None, blank=True, null=True, max_length=255)
+
+    class Meta:
+        unique_together = (('provider', 'uid'), ('user', 'provider'))
+
+    def __repr__(self):
+        return "<{0}: {1} {2}>".format(self.__class__.__name__, self.provider, self.uid)
+
+    @property
+    def token(self):
+        """
+        Return the token as dict.
+        The parsed token is memoized for as long as _token is unchanged.
+        """
+        if not self._token:
+            return self._token
+        cached = getattr(self, '_token_cache', None)
+        if cached is None or cached[0] != self._token:
+            cached = self._token_cache = (self._token, json.loads(self._token))
+        return dict(cached[1])
+
+    @token.setter
+    def token(self, token):
+        """Save the token as a string, and in structured columns."""
+        if token:
+            token = dict(token)
+            self._token = json.dumps(token)
+        else:
+            self._token = None
+        self.access_token, self.expires_at, self.scopes = token_columns(token)
+
+    def expired(self):
+        """Return whether the token is known to be expired."""
+        return self.expires_at is not None and self.expires_at <= now()
+
+
+
+class AvatarJob(models.Model):
+    """
+    Uploaded avatar waiting for its renditions, kept in the spool storage
+    (source) until a worker processes it, see user.avatars.
+    """
+    PENDING, RUNNING, DONE, FAILED = 'pending', 'running', 'done', 'failed'
+    STATUSES = ((PENDING, _('pending')), (RUNNING, _('running')), (DONE, _('done')), (FAILED, _('failed')))
+
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, related_name='avatar_jobs')
+    source = models.CharField(_('spooled file'), max_length=300)
+    name = models.CharField(_('file name'), max_length=100)
+    ext = models.CharField(_('format'), max_length=10)
+    status = models.CharField(_('status'), max_length=10, choices=STATUSES, default=PENDING, db_index=True)
+    attempts = models.PositiveSmallIntegerField(_('attempts'), default=0)
+    error = models.TextField(_('last error'), blank=True, default='')
+    created_at = models.DateTimeField(_('created at'), default=now)
+    updated_at = models.DateTimeField(_('updated at'), default=now)
+
+    def __repr__(self):
+        return "<{0}: {1} {2}>".format(self.__class__.__name__, self.user_id, self.status)
+
+
+class AvatarRendition(models.Model):
+    """
+    Index of avatar renditions made on demand, by source file, size and
+    format, see user.avatars.avatar_rendition_url.
+    """
+    source = models.CharField(_('source'), max_length=300)
+    width = models.PositiveSmallIntegerField(_('width'))
+    height = models.PositiveSmallIntegerField(_('height'))
+    format = models.CharField(_('format'), max_length=10)
+    name = models.CharField(_('stored file'), max_length=300)
+    size = models.PositiveIntegerField(_('size in bytes'), null=True, blank=True)
+    created_at = models.DateTimeField(_('created at'), default=now)
+
+    class Meta:
+        unique_together = (('source', 'width', 'height', 'format'),)
+
+    def __repr__(self):
+        return "<{0}: {1} {2}x{3}>".format(self.__class__.__name__, self.source, self.width, self.height)
+
+
+# Logins are recorded through user.activity rather than with a save() each
+user_logged_in.disconnect(update_last_login)
+user_logged_in.connect(record_login)
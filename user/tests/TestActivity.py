@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+from datetime import datetime, timedelta
+from threading import Event
+
+from django.contrib.auth.signals import user_logged_in
+from django.test import TestCase
+from django.test.utils import override_settings
+from django.utils.timezone import utc
+from mock import Mock
+
+from commons.tests.utils import get_request
+from user.activity import ActivityTracker, get_activity_tracker
+from user.backends import CachedModelBackend
+from user.middleware import ActivityMiddleware
+from user.models import BaseUser
+from user.tests.factories import BaseUserFactory
+
+SOME_TIME = datetime(2014, 1, 15, 18, 0, tzinfo=utc)
+
+
+class ActivityTrackerTest(TestCase):
+    def setUp(self):
+        self.users = [BaseUserFactory() for i in range(3)]
+        self.tracker = ActivityTracker(BaseUser, flush_interval=3600, max_pending=100, batch_size=2)
+
+    def tearDown(self):
+        self.tracker.stop()
+
+    def test_flush__writes_pending_times(self):
+        for i, user in enumerate(self.users):
+            self.tracker.record('last_seen', user.pk, SOME_TIME + timedelta(minutes=i), now=0)
+        self.tracker.record('last_login', self.users[0].pk, SOME_TIME, now=0)
+        self.assertEqual(self.tracker.stats()['pending'], 4)
+
+        self.assertEqual(self.tracker.flush(), 4)
+        self.assertEqual(self.tracker.stats(), {'pending': 0, 'flushes': 1, 'updates': 4})
+        users = BaseUser.objects.in_bulk([user.pk for user in self.users])
+        for i, user in enumerate(self.users):
+            self.assertEqual(users[user.pk].last_seen, SOME_TIME + timedelta(minutes=i))
+        self.assertEqual(users[self.users[0].pk].last_login, SOME_TIME)
+        self.assertEqual(users[self.users[1].pk].last_login, self.users[1].last_login)
+
+    def test_record__keeps_latest_time(self):
+        pk = self.users[0].pk
+        self.tracker.record('last_seen', pk, SOME_TIME, now=0)
+        self.tracker.record('last_seen', pk, SOME_TIME - timedelta(minutes=1), now=0)
+        self.tracker.flush()
+
+        self.assertEqual(BaseUser.objects.get(pk=pk).last_seen, SOME_TIME)
+
+    def test_record__signals_flush_when_due(self):
+        tracker = self.tracker = ActivityTracker(BaseUser, flush_interval=60, max_pending=2)
+        flushed = Event()
+        tracker.flush = Mock(side_effect=lambda: flushed.set())
+        tracker.last_flush = 0
+        tracker.record('last_seen', self.users[0].pk, SOME_TIME, now=30)
+        self.assertFalse(tracker._wake.is_set())
+        # Enough pending users: the background thread flushes, not the request thread
+        tracker.record('last_seen', self.users[1].pk, SOME_TIME, now=30)
+        self.assertTrue(flushed.wait(5))
+        self.assertEqual(tracker.stats()['pending'], 2)
+        # Flush interval elapsed
+        flushed.clear()
+        tracker.record('last_seen', self.users[2].pk, SOME_TIME, now=100)
+        self.assertTrue(flushed.wait(5))
+        self.assertEqual(tracker.flush.call_count, 2)
+
+    def test_flush__nothing_pending(self):
+        with self.assertNumQueries(0):
+            self.assertEqual(self.tracker.flush(), 0)
+
+
+class LoginActivityTest(TestCase):
+    def setUp(self):
+        self.user = BaseUserFactory(last_login=SOME_TIME)
+
+    def test_login__saves_last_login(self):
+        user_logged_in.send(sender=BaseUser, request=None, user=self.user)
+
+        self.assertGreater(BaseUser.objects.get(pk=self.user.pk).last_login, SOME_TIME)
+
+    @override_settings(USER_ACTIVITY={'FLUSH_INTERVAL': 3600})
+    def test_login__is_buffered(self):
+        with self.assertNumQueries(0):
+            user_logged_in.send(sender=BaseUser, request=None, user=self.user)
+        self.assertEqual(BaseUser.objects.get(pk=self.user.pk).last_login, SOME_TIME)
+
+        get_activity_tracker().flush()
+        user = BaseUser.objects.get(pk=self.user.pk)
+        self.assertEqual(user.last_login, self.user.last_login)
+        self.assertEqual(user.last_seen, self.user.last_login)
+
+    @override_settings(USER_ACTIVITY={'FLUSH_INTERVAL': 3600})
+    def test_middleware__records_last_seen(self):
+        r = get_request()
+        ActivityMiddleware().process_request(r)
+        r.user = self.user
+        ActivityMiddleware().process_request(r)
+
+        self.assertEqual(get_activity_tracker().stats()['pending'], 1)
+        get_activity_tracker().flush()
+        self.assertIsNotNone(BaseUser.objects.get(pk=self.user.pk).last_seen)
+
+    @override_settings(USER_ACTIVITY={'FLUSH_INTERVAL': 3600}, USER_CACHE={'TTL': 60},
+                       SERIALIZATION_CACHE={'BACKEND': 'local'})
+    def test_flush__keeps_cached_users(self):
+        backend = CachedModelBackend()
+        backend.get_user(self.user.pk)
+        self.user.to_dict()
+        user_logged_in.send(sender=BaseUser, request=None, user=self.user)
+        get_activity_tracker().flush()
+
+        with self.assertNumQueries(0):
+            backend.get_user(self.user.pk)
+        # Cached dicts hold the flushed times
+        self.assertEqual(BaseUser.objects.get(pk=self.user.pk).to_dict()['last_seen'], str(self.user.last_login))
+
+    @override_settings(USER_ACTIVITY={'FLUSH_INTERVAL': 3600})
+    def test_save__keeps_flushed_times(self):
+        user = BaseUser.objects.get(pk=self.user.pk)
+        user_logged_in.send(sender=BaseUser, request=None, user=self.user)
+        get_activity_tracker().flush()
+
+        # Loaded before the flush
+        user.name = 'new name'
+        user.save()
+        saved = BaseUser.objects.get(pk=self.user.pk)
+        self.assertEqual(saved.name, 'new name')
+        self.assertEqual(saved.last_login, self.user.last_login)
+        self.assertEqual(saved.last_seen, self.user.last_login)
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import os
+import shutil
+from datetime import timedelta
+from StringIO import StringIO
+from tempfile import mkdtemp
+from unittest import skipUnless
+
+from django.conf import settings
+from django.core.files.storage import FileSystemStorage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.urlresolvers import resolve, reverse
+from django.http import Http404
+from django.test import TestCase
+from django.test.utils import override_settings
+from django.utils.timezone import now
+from mock import patch
+from PIL import Image
+
+from commons.tests.utils import TEST_PICTURE, get_request, get_test_picture
+from user import avatars, views
+from user.avatars import avatar_rendition_url, content_name, avatar_rendition_urls, get_spool_storage, run_avatar_jobs, claim_avatar_jobs
+from user.forms import BaseUserEditionForm
+from user.models import AvatarJob, AvatarRendition, BaseUser
+from user.tests.factories import BaseUserFactory
+from user.utils import avatar_placeholder, avatar_renditions, avatar_urls, render_avatars, webp_supported
+
+
+class LocalAvatarStorageTest(TestCase):
+    """Avatars are stored in a temporary directory instead of S3."""
+    def setUp(self):
+        self.root = mkdtemp()
+        self.settings_override = override_settings(AVATAR_DEFERRED=True, AVATAR_SPOOL_ROOT=self.root + '/spool')
+        self.settings_override.enable()
+        self.patches = [
+            patch.object(BaseUser._meta.get_field(name), 'storage', FileSystemStorage(location=self.root + '/uploads'))
+            for name in ('_avatar', '_small_avatar')]
+        for storage_patch in self.patches:
+            storage_patch.start()
+        self.user = BaseUserFactory()
+
+    def assertContentAddressed(self, field_file):
+        """Assert that a stored file is named after the SHA-1 of its bytes."""
+        with field_file.storage.open(field_file.name) as stored:
+            digest = hashlib.sha1(stored.read()).hexdigest()
+        self.assertEqual(os.path.splitext(os.path.basename(field_file.name))[0], digest)
+
+    def tearDown(self):
+        for storage_patch in self.patches:
+            storage_patch.stop()
+        self.settings_override.disable()
+        shutil.rmtree(self.root)
+
+
+class AvatarUploadTest(LocalAvatarStorageTest):
+    def upload(self, user=None, picture=None):
+        user = user or self.user
+        form = BaseUserEditionForm({'name': user.name, 'email': user.email}, {'_avatar': picture or get_test_picture()}, instance=user)
+        self.assertTrue(form.is_valid())
+        return form.save()
+
+
+class ContentAddressedAvatarTest(AvatarUploadTest):
+    @override_settings(AVATAR_DEFERRED=False)
+    def test_upload__named_after_content(self):
+        storage = BaseUser._meta.get_field('_avatar').storage
+        with patch.object(storage, 'save', wraps=storage.save) as save:
+            user = self.upload()
+            self.assertEqual(save.call_count, 1)
+            self.assertContentAddressed(user._avatar)
+            self.assertContentAddressed(user._small_avatar)
+            self.assertEqual(os.path.splitext(user._avatar.name)[1], '.png')
+
+            # The same picture is not uploaded again
+            other = self.upload(BaseUserFactory(email='other@example.com'))
+            self.assertEqual(save.call_count, 1)
+        self.assertEqual((other._avatar.name, other._small_avatar.name), (user._avatar.name, user._small_avatar.name))
+
+    def test_avatar_fields__immutable_headers(self):
+        self.patches[0].stop()
+        try:
+            self.assertIn('immutable', BaseUser._meta.get_field('_avatar').storage.headers['Cache-Control'])
+        finally:
+            self.patches[0].start()
+
+
+class DeferredAvatarTest(AvatarUploadTest):
+
+    def test_upload__is_deferred(self):
+        user = self.upload()
+
+        job = AvatarJob.objects.get()
+        self.assertEqual(job.status, AvatarJob.PENDING)
+        self.assertTrue(get_spool_storage().exists(job.source))
+        user = BaseUser.objects.get(pk=user.pk)
+        self.assertFalse(user._avatar)
+        self.assertEqual(user.avatar, avatar_placeholder())
+        self.assertEqual(user.small_avatar, avatar_placeholder())
+        self.assertEqual(avatar_urls([user]), [(avatar_placeholder(), avatar_placeholder())])
+
+    def test_run_avatar_jobs(self):
+        self.upload()
+        jobs = run_avatar_jobs()
+
+        self.assertEqual([job.status for job in jobs], [AvatarJob.DONE])
+        self.assertFalse(get_spool_storage().exists(jobs[0].source))
+        user = BaseUser.objects.get(pk=self.user.pk)
+        self.assertFalse(user._avatar_pending)
+        self.assertContentAddressed(user._avatar)
+        self.assertContentAddressed(user._small_avatar)
+        self.assertEqual(run_avatar_jobs(), [])
+
+    def test_run_avatar_jobs__keeps_latest_upload(self):
+        picture = StringIO()
+        Image.open(TEST_PICTURE).transpose(Image.FLIP_LEFT_RIGHT).save(picture, 'png')
+        self.upload()
+        self.upload(BaseUser.objects.get(pk=self.user.pk), SimpleUploadedFile('flipped.png', picture.getvalue(), content_type='image/png'))
+        first, latest = run_avatar_jobs()
+
+        self.assertEqual((first.status, latest.status), (AvatarJob.DONE, AvatarJob.DONE))
+        picture.seek(0)
+        expected = render_avatars(Image.open(picture), avatar_renditions(), 'png')['_avatar']
+        self.assertEqual(os.path.basename(BaseUser.objects.get(pk=self.user.pk)._avatar.name), content_name(expected, 'png'))
+
+    def test_run_avatar_jobs__retries_then_fails(self):
+        self.upload()
+        job = AvatarJob.objects.get()
+        get_spool_storage().delete(job.source)
+
+        job, = run_avatar_jobs(max_attempts=2)
+        self.assertEqual((job.status, job.attempts), (AvatarJob.PENDING, 1))
+        self.assertTrue(BaseUser.objects.get(pk=self.user.pk)._avatar_pending)
+        job, = run_avatar_jobs(max_attempts=2)
+        self.assertEqual((job.status, job.attempts), (AvatarJob.FAILED, 2))
+        self.assertFalse(BaseUser.objects.get(pk=self.user.pk)._avatar_pending)
+
+    def test_claim_avatar_jobs__stale_jobs_count_as_attempts(self):
+        self.upload()
+        stale = now() - timedelta(hours=1)
+        AvatarJob.objects.update(status=AvatarJob.RUNNING, updated_at=stale)
+
+        job, = claim_avatar_jobs(max_attempts=2)
+        self.assertEqual((job.status, job.attempts), (AvatarJob.RUNNING, 1))
+        # Its worker died again
+        AvatarJob.objects.update(updated_at=stale)
+        self.assertEqual(claim_avatar_jobs(max_attempts=2), [])
+        job = AvatarJob.objects.get()
+        self.assertEqual((job.status, job.attempts), (AvatarJob.FAILED, 2))
+        self.assertFalse(get_spool_storage().exists(job.source))
+        self.assertFalse(BaseUser.objects.get(pk=self.user.pk)._avatar_pending)
+
+
+@override_settings(AVATAR_RENDITION_SIZES=((20, 20), (20, 30)))
+class AvatarRenditionTest(LocalAvatarStorageTest):
+    def setUp(self):
+        super(AvatarRenditionTest, self).setUp()
+        self.user._avatar.save('avatar.png', get_test_picture())
+
+    def test_avatar_rendition_url__made_once(self):
+        url = avatar_rendition_url(self.user, 20, 20)
+
+        rendition = AvatarRendition.objects.get()
+        self.assertEqual((rendition.source, rendition.format), (self.user._avatar.name, 'png'))
+        self.assertEqual(rendition.size, self.user._avatar.storage.size(rendition.name))
+        self.assertTrue(url.endswith(rendition.name))
+        with self.user._avatar.storage.open(rendition.name) as rendition_file:
+            self.assertEqual(Image.open(rendition_file).size, (20, 20))
+        with self.assertNumQueries(0):
+            self.assertEqual(avatar_rendition_url(self.user, 20, 20), url)
+
+    def test_avatar_rendition_urls__served_from_index(self):
+        other = BaseUserFactory()
+        url = avatar_rendition_url(self.user, 20, 20, 'jpeg')
+        avatars._rendition_names.clear()
+
+        with patch('user.avatars.render_avatars', side_effect=AssertionError):
+            with self.assertNumQueries(1):
+                self.assertEqual(avatar_rendition_urls([self.user, other], 20, 20, 'jpeg'), [url, None])
+
+    def test_avatar_rendition_url__unavailable_sizes(self):
+        with self.assertRaises(ValueError):
+            avatar_rendition_url(self.user, 30, 30)
+        with self.settings(AVATAR_RENDITION_SIZES=((0, 20), (4000, 4000))):
+            with self.assertRaises(ValueError):
+                avatar_rendition_url(self.user, 0, 20)
+            with self.assertRaises(ValueError):
+                avatar_rendition_url(self.user, 4000, 4000)
+        # Only the sizes of uploads by default
+        with self.settings(AVATAR_RENDITION_SIZES=None):
+            avatar_rendition_url(self.user, *settings.AVATAR_SMALLSIZE)
+            with self.assertRaises(ValueError):
+                avatar_rendition_url(self.user, 20, 20)
+        self.assertEqual(AvatarRendition.objects.count(), 1)
+
+    @skipUnless(webp_supported(), 'PIL has no WebP support.')
+    def test_avatar_rendition_url__webp_source(self):
+        webp = StringIO()
+        Image.open(TEST_PICTURE).save(webp, 'webp')
+        self.user._avatar.save('avatar.webp', SimpleUploadedFile('avatar.webp', webp.getvalue()))
+
+        url = avatar_rendition_url(self.user, 20, 20)
+        self.assertEqual(AvatarRendition.objects.get(source=self.user._avatar.name).format, 'webp')
+        self.assertTrue(url.endswith('.webp'))
+        self.assertEqual(views.avatar(get_request(), self.user.slug, '20', '20', 'webp').status_code, 302)
+
+    def test_avatar_view(self):
+        response = views.avatar(get_request(), self.user.slug, '20', '30', 'jpg')
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response['location'], avatar_rendition_url(self.user, 20, 30, 'jpeg'))
+        self.assertEqual(reverse('user:avatar', args=[self.user.slug, 20, 30]), '/avatar/{0}/20x30'.format(self.user.slug))
+        self.assertEqual(resolve('/avatar/{0}/20x30.webp'.format(self.user.slug)).kwargs['ext'], 'webp')
+
+        with self.assertRaises(Http404):
+            views.avatar(get_request(), BaseUserFactory().slug, '20', '30')
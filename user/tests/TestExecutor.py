@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+from threading import Event, Thread, current_thread
+from time import sleep
+
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from commons.tests.utils import get_test_picture
+from user.executor import ImageExecutor, ImageWorkTimeout, get_image_executor
+from user.forms import BaseUserEditionForm
+from user.tests.factories import BaseUserFactory
+
+
+class ImageExecutorTest(TestCase):
+    def setUp(self):
+        self.executor = ImageExecutor(workers=1, max_queue=1, timeout=5)
+        self.running = Event()
+        self.release = Event()
+        self.threads = []
+
+    def tearDown(self):
+        self.release.set()
+        for thread in self.threads:
+            thread.join()
+        self.executor.stop()
+
+    def block(self):
+        self.running.set()
+        self.release.wait(5)
+
+    def submit(self, func):
+        """Run func with the executor in another thread."""
+        thread = Thread(target=self.executor.run, args=(func,))
+        thread.start()
+        self.threads.append(thread)
+
+    def wait_queued(self, queued):
+        for i in range(500):
+            if self.executor.stats()['queued'] == queued:
+                return
+            sleep(0.01)
+
+    def test_run__in_worker(self):
+        self.assertEqual(self.executor.run(lambda: current_thread().name), 'image-executor-0')
+        with self.assertRaises(ZeroDivisionError):
+            self.executor.run(lambda: 1 / 0)
+        stats = self.executor.stats()
+        self.assertEqual((stats['submitted'], stats['inline'], stats['errors']), (2, 0, 1))
+
+    def test_run__inline_when_saturated(self):
+        self.submit(self.block)
+        self.running.wait(5)
+        self.submit(lambda: None)
+        self.wait_queued(1)
+
+        self.assertEqual(self.executor.run(lambda: current_thread().name), current_thread().name)
+        stats = self.executor.stats()
+        self.assertEqual((stats['running'], stats['queued'], stats['max_queued'], stats['inline']), (1, 1, 1, 1))
+
+    def test_run__timeout(self):
+        self.submit(self.block)
+        self.running.wait(5)
+        self.executor.timeout = 0.1
+
+        with self.assertRaises(ImageWorkTimeout):
+            self.executor.run(lambda: None)
+        stats = self.executor.stats()
+        self.assertEqual((stats['queued'], stats['timeouts']), (0, 1))
+
+    @override_settings(IMAGE_EXECUTOR={'WORKERS': 1})
+    def test_edition_form__renditions_made_by_executor(self):
+        user = BaseUserFactory()
+        form = BaseUserEditionForm({'name': user.name, 'email': user.email}, {'_avatar': get_test_picture()}, instance=user)
+
+        self.assertTrue(form.is_valid())
+        self.assertIsNotNone(form.small_avatar)
+        self.assertEqual(get_image_executor().stats()['submitted'], 1)
@@ -1,9 +1,13 @@
 from django.contrib.auth import authenticate
 from django.test import TestCase
+from django.test.utils import override_settings
 from facebook import GraphAPIError, FacebookAuthError
 from mock import patch
 
-from user.backends import FacebookBackend
+from commons.cache import DjangoCacheBackend
+from user.backends import FacebookBackend, CachedModelBackend
+from user.cache import UserCache, get_user_cache
+from user.models import BaseUser
 from user.tests.factories import BaseUserFactory
 
 VALID_TOKEN = 'valid_token'
@@ -40,8 +44,8 @@ class FbBackendTest(TestCase):
     @classmethod
     def setUpClass(cls):
         cls.user = BaseUserFactory(
-            _fb_token=VALID_TOKEN,
-            _fb_id=VALID_ID,)
+            fb_token={'access_token': VALID_TOKEN},
+            fb_id=VALID_ID,)
 
     @classmethod
     def tearDownClass(cls):
@@ -71,3 +75,72 @@ class FbBackendTest(TestCase):
         user = backend.get_user(self.user.id)
         self.assertIsNotNone(user)
         self.assertEquals(user, self.user)
+
+
+@override_settings(USER_CACHE={'MAX_SIZE': 10, 'TTL': 60})
+class CachedBackendTest(TestCase):
+    def setUp(self):
+        self.user = BaseUserFactory()
+        self.backend = CachedModelBackend()
+
+    def test_get_user_is_cached(self):
+        self.assertEqual(self.backend.get_user(self.user.pk), self.user)
+        with self.assertNumQueries(0):
+            user = self.backend.get_user(self.user.pk)
+        self.assertEqual(user, self.user)
+        # Each call gets its own copy
+        self.assertIsNot(self.backend.get_user(self.user.pk), user)
+        self.assertIsNone(self.backend.get_user(0))
+
+    def test_get_user_is_invalidated(self):
+        self.backend.get_user(self.user.pk)
+        self.user.name = 'new name'
+        self.user.save()
+        self.assertEqual(self.backend.get_user(self.user.pk).name, 'new name')
+
+        self.user.set_password('new password')
+        self.user.save()
+        self.assertTrue(self.backend.get_user(self.user.pk).check_password('new password'))
+
+        self.user.delete()
+        self.assertIsNone(self.backend.get_user(self.user.pk))
+
+    def test_default_config(self):
+        with self.settings(USER_CACHE={}):
+            # Process local caches would serve deactivated users to other processes
+            self.assertIsNone(get_user_cache().shared)
+            self.assertEqual(get_user_cache().ttl, 0)
+            with self.settings(CACHES={'default': {
+                    'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': '/tmp/user_cache'}}):
+                self.assertIsNotNone(get_user_cache().shared)
+                self.assertEqual(get_user_cache().ttl, 300)
+
+    def test_shared_cache__save_while_loading(self):
+        cache, other_process = UserCache(shared=DjangoCacheBackend('default')), UserCache(shared=DjangoCacheBackend('default'))
+        self.addCleanup(cache.shared.clear)
+        load = lambda: BaseUser.objects.get(pk=self.user.pk)
+
+        def load_then_deactivate():
+            user = load()
+            # Saved by another process before the loaded user is cached
+            BaseUser.objects.filter(pk=self.user.pk).update(is_active=False)
+            other_process.invalidate(self.user.pk)
+            return user
+        self.assertTrue(cache.get(self.user.pk, load_then_deactivate).is_active)
+
+        self.assertFalse(other_process.get(self.user.pk, load).is_active)
+        self.assertFalse(cache.get(self.user.pk, load).is_active)
+
+    def test_shared_cache(self):
+        # Two processes sharing the default cache
+        other_process = UserCache(shared=DjangoCacheBackend('default'))
+        self.addCleanup(other_process.shared.clear)
+        with self.settings(USER_CACHE={'CACHE': 'default'}):
+            self.backend.get_user(self.user.pk)
+            with self.assertNumQueries(0):
+                self.assertEqual(other_process.get(self.user.pk, lambda: None), self.user)
+
+            self.user.name = 'new name'
+            self.user.save()
+            self.assertEqual(other_process.get(self.user.pk, lambda: BaseUser.objects.get(pk=self.user.pk)).name, 'new name')
+            self.assertEqual(get_user_cache().stats()['misses'], 1)
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+import os
+from StringIO import StringIO
+
+from django.core.files.uploadedfile import InMemoryUploadedFile
+from django.test import TestCase, RequestFactory
+from django.test.utils import override_settings
+from PIL import Image
+
+from commons.tests.utils import TEST_PICTURE, get_test_picture
+from user.forms import BaseUserEditionForm
+from user.tests.factories import BaseUserFactory
+from user.uploads import AvatarUploadHandler, RejectedUpload, SpooledUploadedFile, image_dimensions
+
+
+class AvatarUploadHandlerTest(TestCase):
+    def files(self, **files):
+        """Return the FILES of a multipart request, parsed with AvatarUploadHandler first."""
+        request = RequestFactory().post('/compte/editer', files)
+        request.upload_handlers.insert(0, AvatarUploadHandler(request))
+        return request.FILES
+
+    def test_image_dimensions(self):
+        with open(TEST_PICTURE, 'rb') as fp:
+            header = fp.read(100)
+        self.assertEqual(image_dimensions(header), (40, 30))
+        self.assertIsNone(image_dimensions(header[:10]))
+
+        jpeg = StringIO()
+        Image.open(TEST_PICTURE).convert('RGB').save(jpeg, 'jpeg')
+        self.assertEqual(image_dimensions(jpeg.getvalue()[:1000]), (40, 30))
+
+    def test_upload_is_spooled(self):
+        files = self.files(_avatar=get_test_picture(), other=get_test_picture())
+
+        self.assertIsInstance(files['_avatar'], SpooledUploadedFile)
+        self.assertEqual(files['_avatar'].size, os.path.getsize(TEST_PICTURE))
+        with open(TEST_PICTURE, 'rb') as fp:
+            self.assertEqual(files['_avatar'].read(), fp.read())
+        # Other fields are left to django's handlers
+        self.assertIsInstance(files['other'], InMemoryUploadedFile)
+
+    @override_settings(MAX_UPLOAD_SIZE=1000)
+    def test_upload_too_big(self):
+        avatar = self.files(_avatar=get_test_picture())['_avatar']
+
+        self.assertIsInstance(avatar, RejectedUpload)
+        self.assertEqual(avatar.error, 'image_too_big')
+        self.assertEqual(avatar.size, os.path.getsize(TEST_PICTURE))
+        self.assertEqual(avatar.read(), '')
+
+    @override_settings(AVATAR_MAX_PIXELS=1000)
+    def test_upload_too_large(self):
+        avatar = self.files(_avatar=get_test_picture())['_avatar']
+
+        self.assertEqual(avatar.error, 'image_too_large')
+        self.assertEqual(avatar.dimensions, (40, 30))
+
+    @override_settings(AVATAR_MAX_PIXELS=1000)
+    def test_edition_form_reports_rejected_upload(self):
+        user = BaseUserFactory()
+        form = BaseUserEditionForm({'name': user.name, 'email': user.email}, self.files(_avatar=get_test_picture()), instance=user)
+
+        self.assertFalse(form.is_valid())
+        self.assertIn('40x30', form.errors['_avatar'][0])
+        # Without the handler
+        form = BaseUserEditionForm({'name': user.name, 'email': user.email}, {'_avatar': get_test_picture()}, instance=user)
+        self.assertFalse(form.is_valid())
+        self.assertIn('40x30', form.errors['_avatar'][0])
@@ -24,6 +24,15 @@ class BaseUserCreationFormTest(TestCase):
         valid_email_form.is_valid()
         self.assertNotIn(field, valid_email_form.errors)
 
+    def test_baseuserstudentcreationform_save__duplicate_fb_id(self):
+        BaseUserFactory(fb_id=1337)
+
+        form = BaseUserCreationForm({'email': 'new@example.com', 'password1': 'password', 'password2': 'password', 'fb_id': '1337'})
+        self.assertTrue(form.is_valid())
+        self.assertIsNone(form.save())
+        self.assertIn(BaseUserCreationForm.error_messages['duplicate_fb_id'], form.errors.get('fb_id'))
+        self.assertFalse(BaseUser.objects.filter(email='new@example.com').exists())
+
     def test_baseuserstudentcreationform_clean_password2(self):
         field = 'password%s'
 
@@ -35,3 +35,44 @@ class UserManagerTest(TestCase):
     def test_user_manager(self):
         """Test user's manager."""
         self.assertIsInstance(BaseUser.objects, UserManager)
+
+    def test_to_dicts(self):
+        """Test users serialization from the manager."""
+        BaseUser.objects.create_user("baptiste@smoothie-creative.com", "password", slug="baptiste", name="baptiste")
+        BaseUser.objects.create_user("maxime@smoothie-creative.com", "password", slug="maxime", name="maxime")
+        expected = [user.to_dict() for user in BaseUser.objects.order_by('pk')]
+
+        self.assertEqual(list(BaseUser.objects.order_by('pk').to_dicts()), expected)
+        self.assertEqual(list(BaseUser.objects.to_dicts(chunk_size=1)), expected)
+
+    def test_bulk_create_users(self):
+        BaseUser.objects.create_user("existing@example.com", "password", slug="taken", name="taken")
+        rows = [{'email': 'user%d@EXAMPLE.com' % i, 'password': 'password%d' % i} for i in range(5)]
+        rows += [{'email': 'named@example.com', 'password': 'password', 'name': 'Taken'},
+                 {'email': 'other@example.com', 'password': 'password', 'slug': 'taken'}]
+        stages = []
+
+        users, timings = BaseUser.objects.bulk_create_users(
+            rows, processes=2, batch_size=3, progress=lambda stage, done, total: stages.append((stage, done, total)))
+
+        self.assertEqual(len(users), 7)
+        self.assertEqual(set(timings), set(['prepare', 'hash', 'slugs', 'insert']))
+        self.assertIn(('insert', 7, 7), stages)
+        self.assertEqual(BaseUser.objects.count(), 8)
+        user = BaseUser.objects.get(email='user3@example.com')
+        self.assertTrue(user.check_password('password3'))
+        self.assertEqual((user.slug, user.name), ('user3', 'user3'))
+        # Taken slugs got a token appended
+        slugs = BaseUser.objects.values_list('slug', flat=True)
+        self.assertEqual(len(set(slugs)), 8)
+        self.assertEqual(len([slug for slug in slugs if slug.startswith('taken_')]), 2)
+
+    def test_bulk_create_users_with_existing_emails(self):
+        BaseUser.objects.create_user("existing@example.com", "password", slug="existing", name="existing")
+        rows = [{'email': 'existing@example.com', 'password': 'password'},
+                {'email': 'new@example.com', 'password': 'password'},
+                {'email': 'new@example.com', 'password': 'password'}]
+
+        with self.assertRaises(ValueError):
+            BaseUser.objects.bulk_create_users(rows, processes=1)
+        self.assertEqual(BaseUser.objects.count(), 1)
@@ -1,18 +1,30 @@
 # -*- coding: utf-8 -*-
+from datetime import timedelta
+from StringIO import StringIO
+
+import simplejson as json
 from django.contrib.auth import get_user_model
-from django.core.exceptions import ValidationError
+from django.contrib.auth.hashers import make_password
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection, IntegrityError
 from django.test import TestCase
+from django.test.utils import override_settings
+from django.utils.timezone import now
 from mock import patch
+from requests.exceptions import ConnectionError
 
-from user.models import _lazy_user_model
+from user.models import BaseUser, SocialIdentity, _lazy_user_model
 from user.tests.factories import BaseUserFactory
-from user.tests.TestFbBackend import get, get_access_token, VALID_TOKEN, VALID_ID, AVATAR_URL
+from user.utils import get_fb_avatar_cache
+from user.tests.TestFbBackend import get, get_access_token, VALID_TOKEN, INVALID_TOKEN, VALID_ID, INVALID_ID, AVATAR_URL
 
 
 class UserModelTest(TestCase):
     def setUp(self):
         """Create user."""
         self.user = BaseUserFactory()
+        get_fb_avatar_cache().clear()
 
     def tearDown(self):
         """Delete user."""
@@ -46,9 +58,94 @@ class UserModelTest(TestCase):
 
         # Create user with fb_id
         BaseUserFactory(fb_id=1337)
-        # Try to assign same fb_id on different user
-        with self.assertRaises(ValidationError):
-            self.user.fb_id = 1337
+        # Linking the same fb_id to a different user fails on save
+        self.user.fb_id = 1337
+        with self.assertRaises(IntegrityError):
+            self.user.save()
+        self.assertIsNone(self.user.fb_id)
+
+    def test_fb_identity(self):
+        self.user.fb_id = VALID_ID
+        self.user.fb_token = {"access_token": VALID_TOKEN}
+        self.user.save()
+
+        identity = SocialIdentity.objects.get(provider=SocialIdentity.FACEBOOK, uid=str(VALID_ID))
+        self.assertEqual(identity.user, self.user)
+        self.assertEqual(identity.token, {"access_token": VALID_TOKEN})
+        with self.assertNumQueries(1):
+            user = BaseUser.objects.get(pk=self.user.pk)
+        with self.assertNumQueries(1):
+            self.assertEqual(user.fb_id, VALID_ID)
+            self.assertEqual(user.fb_token, {"access_token": VALID_TOKEN})
+
+        # Saves without facebook changes leave the identity alone
+        with self.assertNumQueries(1):
+            user.save(update_fields=['name'])
+
+        user.fb_id = None
+        user.save()
+        self.assertFalse(SocialIdentity.objects.exists())
+
+    def test_fb_token_is_memoized(self):
+        identity = SocialIdentity(token={"access_token": VALID_TOKEN})
+        with patch('user.models.json.loads', wraps=json.loads) as loads:
+            identity.token
+            identity.token['access_token'] = 'changed'
+            self.assertEqual(identity.token, {"access_token": VALID_TOKEN})
+        self.assertEqual(loads.call_count, 1)
+
+        # Direct assignments are picked up
+        identity._token = json.dumps({"access_token": "other"})
+        self.assertEqual(identity.token, {"access_token": "other"})
+
+    def test_fb_token_columns(self):
+        self.user.fb_id = VALID_ID
+        self.user.fb_token = {"access_token": VALID_TOKEN, "expires": "3600", "scope": "email,user_photos"}
+        self.user.save()
+
+        identity = SocialIdentity.objects.get(access_token=VALID_TOKEN)
+        self.assertEqual(identity.scopes, "email,user_photos")
+        self.assertTrue(now() < identity.expires_at <= now() + timedelta(seconds=3600))
+        self.assertFalse(BaseUser.objects.get(pk=self.user.pk).fb_token_expired())
+        self.assertFalse(SocialIdentity.objects.filter(expires_at__lte=now()).exists())
+
+        self.user.fb_token = {"access_token": VALID_TOKEN, "expires_at": 1}
+        self.assertTrue(self.user.fb_token_expired())
+
+        self.user.fb_token = None
+        self.assertIsNone(self.user._fb_identity.access_token)
+        self.assertIsNone(self.user._fb_identity.expires_at)
+
+    def test_bench_to_dict(self):
+        stdout = StringIO()
+        call_command('bench_to_dict', users=5, rounds=1, stdout=stdout)
+
+        self.assertEqual([line.split(':')[0].strip() for line in stdout.getvalue().splitlines()], ['legacy', 'plan'])
+
+    def test_backfill_social_identities(self):
+        stdout = StringIO()
+        with self.assertRaises(CommandError):
+            call_command('backfill_social_identities', stdout=stdout)
+
+        # Legacy columns, as created before social identities
+        cursor = connection.cursor()
+        cursor.execute('ALTER TABLE user_baseuser ADD COLUMN "_fb_id" integer NULL')
+        cursor.execute('ALTER TABLE user_baseuser ADD COLUMN "_fb_token" varchar(300) NULL')
+        duplicate, invalid = BaseUserFactory(), BaseUserFactory()
+        raw_token = json.dumps({"access_token": VALID_TOKEN, "expires": 60})
+        cursor.execute('UPDATE user_baseuser SET "_fb_id" = %s, "_fb_token" = %s WHERE id IN (%s, %s)',
+                       [VALID_ID, raw_token, self.user.pk, duplicate.pk])
+        cursor.execute('UPDATE user_baseuser SET "_fb_id" = 1, "_fb_token" = %s WHERE id = %s', ['not json', invalid.pk])
+
+        call_command('backfill_social_identities', batch_size=2, stdout=stdout)
+        self.assertEqual(stdout.getvalue().strip(), '2 identities created, 1 duplicated accounts skipped.')
+
+        user = BaseUser.objects.get(pk=self.user.pk)
+        self.assertEqual(user.fb_id, VALID_ID)
+        self.assertEqual(user.fb_token["access_token"], VALID_TOKEN)
+        self.assertEqual(user._fb_identity.expires_at, user.last_login + timedelta(seconds=60))
+        self.assertEqual(BaseUser.objects.get(pk=invalid.pk).fb_id, 1)
+        self.assertIsNone(BaseUser.objects.get(pk=invalid.pk).fb_token)
 
     def test__lazy_user_model(self):
         email, pwd, slug, name = "maxime@smoothie-creative.com", "password", "maxime", "Maxime"
@@ -88,3 +185,64 @@ class UserModelTest(TestCase):
 
         self.assertIsNotNone(avatar)
         self.assertEquals(avatar, AVATAR_URL)
+
+    def test_fb_avatar_is_cached(self):
+        self.user.fb_token = {"access_token": VALID_TOKEN}
+        self.user.fb_id = VALID_ID
+        self.user.save()
+        other = BaseUserFactory(fb_token={"access_token": INVALID_TOKEN}, fb_id=INVALID_ID)
+
+        paths = []
+        def counting_get(graph, path, *args, **kwargs):
+            paths.append(path)
+            return get(graph, path, *args, **kwargs)
+        with patch('user.backends.GraphAPI.get', new=counting_get):
+            self.assertEqual(self.user.fb_avatar(), AVATAR_URL)
+            self.assertEqual(self.user.fb_avatar(), AVATAR_URL)
+            # Failures are cached too
+            self.assertIsNone(other.fb_avatar())
+            self.assertIsNone(other.fb_avatar())
+
+        self.assertEqual(paths, ['me/picture', 'me/picture'])
+        self.assertEqual(get_fb_avatar_cache().stats()['hits'], 2)
+
+    def test_fb_avatar__network_failures_are_cached(self):
+        self.user.fb_id = VALID_ID
+        self.user.fb_token = {"access_token": VALID_TOKEN}
+        self.user.save()
+
+        with self.settings(FB_AVATAR_CACHE={'ERROR_TTL': 300}):
+            with patch('facebook.requests.get', side_effect=ConnectionError) as request:
+                for i in range(3):
+                    self.assertIsNone(self.user.fb_avatar())
+            self.assertEqual(request.call_count, 1)
+            self.assertEqual(get_fb_avatar_cache().stats()['errors'], 1)
+
+
+
+@override_settings(PASSWORD_HASHERS=('user.hashers.PBKDF2PasswordHasher',), PASSWORD_ITERATIONS=1000)
+class PasswordRehashTest(TestCase):
+    def setUp(self):
+        self.user = BaseUserFactory(password=make_password('password'))
+
+    def test_check_password_rehashes_outdated_hashes(self):
+        with self.settings(PASSWORD_ITERATIONS=2000):
+            self.assertTrue(self.user.check_password('password'))
+
+        password = BaseUser.objects.get(pk=self.user.pk).password
+        self.assertEqual(password.split('$')[1], '2000')
+        self.assertEqual(self.user.password, password)
+
+    def test_check_password_keeps_current_hashes(self):
+        password = self.user.password
+        self.assertTrue(self.user.check_password('password'))
+        self.assertFalse(self.user.check_password('wrong'))
+
+        self.assertEqual(BaseUser.objects.get(pk=self.user.pk).password, password)
+
+    def test_rehash_keeps_concurrent_changes(self):
+        BaseUser.objects.filter(pk=self.user.pk).update(password=make_password('changed'))
+        with self.settings(PASSWORD_ITERATIONS=2000):
+            self.assertTrue(self.user.check_password('password'))
+
+        self.assertTrue(BaseUser.objects.get(pk=self.user.pk).check_password('changed'))
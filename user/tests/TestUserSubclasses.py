@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+from StringIO import StringIO
+
+from django.core.management import call_command
+
+from commons.tests.test_case import AbstractModelTest
+from user.models import BaseUser
+from user.tests.factories import BaseUserFactory
+from user.tests.models import StudentUser, GraduateUser
+
+
+class StudentUserFactory(BaseUserFactory):
+    FACTORY_FOR = StudentUser
+
+
+class GraduateUserFactory(BaseUserFactory):
+    FACTORY_FOR = GraduateUser
+
+
+class UserSubclassesTest(AbstractModelTest):
+    @classmethod
+    def setUpClass(cls):
+        super(UserSubclassesTest, cls).setUpClass()
+        # Related objects were cached before the test subclasses existed
+        for name in ('_related_objects_cache', '_related_objects_proxy_cache', '_name_map'):
+            BaseUser._meta.__dict__.pop(name, None)
+
+    @classmethod
+    def tearDownClass(cls):
+        # Keep the subclasses tables: deleting users cascades to them in later tests
+        pass
+
+    def setUp(self):
+        self.user = BaseUserFactory()
+        self.student = StudentUserFactory(school='school')
+        self.graduate = GraduateUserFactory(degree='degree')
+
+    def test_subclass_is_saved(self):
+        self.assertEqual(self.user._subclass, '')
+        self.assertEqual(self.student._subclass, 'studentuser')
+        self.assertEqual(self.graduate._subclass, 'studentuser__graduateuser')
+
+        # Saving a parent instance keeps the deepest subclass
+        StudentUser.objects.get(pk=self.graduate.pk).save()
+        self.assertEqual(BaseUser.objects.base_only().get(pk=self.graduate.pk)._subclass, 'studentuser__graduateuser')
+
+        # Paths are compared lookup by lookup, not as raw string prefixes
+        self.student._subclass = 'studentuserx'
+        self.student.save()
+        self.assertEqual(self.student._subclass, 'studentuser')
+
+    def test_to_dict__subclasses_are_not_related_objects(self):
+        self.assertNotIn('studentuser', BaseUser.get_serialization_plan().select_related_paths())
+        self.assertEqual(StudentUser.get_serialization_plan().select_related_paths(), ['baseuser_ptr'])
+        user = BaseUser.objects.base_only().get(pk=self.graduate.pk)
+        with self.assertNumQueries(0):
+            self.assertNotIn('studentuser', user.to_dict())
+
+    def test_to_dict__no_bookkeeping_fields(self):
+        _dict = self.graduate.to_dict()
+        self.assertNotIn('_subclass', _dict)
+        self.assertNotIn('_avatar_pending', _dict)
+        self.assertEqual(_dict['degree'], 'degree')
+
+    def test_load_subclasses(self):
+        # Base rows, then one query per subclass found
+        with self.assertNumQueries(3):
+            users = list(BaseUser.objects.order_by('pk'))
+        self.assertEqual([type(user) for user in users], [BaseUser, StudentUser, GraduateUser])
+        self.assertEqual(users[1].school, 'school')
+        self.assertEqual(users[2].degree, 'degree')
+
+        with self.assertNumQueries(1):
+            self.assertIs(type(BaseUser.objects.get(pk=self.user.pk)), BaseUser)
+        with self.assertNumQueries(2):
+            self.assertIs(type(BaseUser.objects.get(pk=self.student.pk)), StudentUser)
+
+    def test_base_only(self):
+        with self.assertNumQueries(1):
+            users = list(BaseUser.objects.base_only())
+        self.assertEqual(set(type(user) for user in users), set([BaseUser]))
+
+    def test_select_subclasses(self):
+        with self.assertNumQueries(1):
+            users = list(BaseUser.objects.select_subclasses().order_by('pk'))
+        self.assertEqual([type(user) for user in users], [BaseUser, StudentUser, GraduateUser])
+
+    def test_to_dicts(self):
+        dicts = list(BaseUser.objects.order_by('pk').to_dicts(fields=['email', 'school']))
+
+        self.assertEqual(dicts[0], {'email': self.user.email})
+        self.assertEqual(dicts[1], {'email': self.student.email, 'school': 'school'})
+
+    def test_backfill_user_subclasses(self):
+        BaseUser.objects.update(_subclass='')
+
+        call_command('backfill_user_subclasses', stdout=StringIO())
+
+        self.assertEqual(
+            list(BaseUser.objects.base_only().order_by('pk').values_list('_subclass', flat=True)),
+            ['', 'studentuser', 'studentuser__graduateuser'])
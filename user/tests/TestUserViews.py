@@ -9,6 +9,7 @@ from django.http import Http404
 from django.test import TestCase
 from mock import patch
 
+from commons.encoders import get_encoder
 from commons.tests.utils import get_request, post_request
 from user import views
 from user.forms import CustomAuthenticationForm
@@ -36,6 +37,14 @@ class AnonymousViewsTest(TestCase):
         self.assertEqual(BaseUser.objects.count(), old_user_count + 1)
         self.assertTrue(BaseUser.objects.filter(email=valid_data['email']).exists())
 
+    def test_baseusercreationview_post_with_linked_fb_id(self):
+        BaseUserFactory(fb_id=1337)
+        data = {'email': 'maxime@smoothie-creative.com', 'password1': 'password', 'password2': 'password', 'fb_id': '1337'}
+        response = views.BaseUserCreationView.as_view()(post_request(data))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('fb_id', response.context_data['form'].errors)
+        self.assertFalse(BaseUser.objects.filter(email=data['email']).exists())
+
     def test__baseuser_delete_get_without_user(self):
         r = get_request()
         with self.assertRaises(Http404):
@@ -122,6 +131,48 @@ class UserViewsTest(TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(r.user.name, 'toto')
 
+    def test_baseuser_export_requires_staff(self):
+        r = get_request()
+        r.user = self.user
+        response = views.baseuser_export(r)
+        self.assertEqual(response.status_code, 302)
+
+    def test__baseuser_export_streams_users(self):
+        BaseUserFactory()
+        r = get_request()
+        r.user = self.user
+        response = views._baseuser_export(r)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['content-type'], "application/json")
+
+        users = json.loads(''.join(response.streaming_content))
+        self.assertEqual(users, list(BaseUser.objects.to_dicts(exclude=['password'])))
+
+    def test__baseuser_export_jsonl(self):
+        r = get_request({'format': 'jsonl'})
+        r.user = self.user
+        response = views._baseuser_export(r)
+        lines = ''.join(response.streaming_content).splitlines()
+        self.assertEqual(len(lines), BaseUser.objects.count())
+        self.assertEqual(json.loads(lines[0])['email'], self.user.email)
+
+    def test__baseuser_export_negotiates_packed(self):
+        r = get_request(HTTP_ACCEPT='application/x-packed')
+        r.user = self.user
+        response = views._baseuser_export(r)
+        self.assertEqual(response['content-type'], "application/x-packed")
+        self.assertTrue(response['content-disposition'].endswith('users.bin"'))
+
+        users = get_encoder('packed').decode_stream(''.join(response.streaming_content))
+        self.assertEqual(users[0]['email'], self.user.email)
+
+    def test__baseuser_export_unknown_format(self):
+        r = get_request({'format': 'xml'})
+        r.user = self.user
+        with self.assertRaises(Http404):
+            views._baseuser_export(r)
+
 
 @patch('user.backends.GraphAPI.get', new=get)
 @patch('user.utils.FacebookAPI.get_access_token', new=get_access_token)
@@ -1,14 +1,19 @@
 # -*- coding: utf-8 -*-
+from StringIO import StringIO
+
 from django.conf import settings
 from django.contrib.sites.models import Site
+from django.db import IntegrityError
 from django.test import TestCase
+from django.test.utils import override_settings
 from facebook import FacebookAPI
+from mock import patch
 from PIL import Image
 
 from commons.tests.utils import TEST_PICTURE
 from user.models import BaseUser
 from user.tests.factories import BaseUserFactory
-from user.utils import unique_slugify, resize, absolute_url, get_facebook, clean_fb_session
+from user.utils import unique_slugify, unique_slugs, save_with_unique_slug, resize, render_avatars, webp_supported, absolute_url, get_facebook, clean_fb_session, avatar_urls
 
 
 class UtilsTest(TestCase):
@@ -25,6 +30,60 @@ class UtilsTest(TestCase):
         unique_slug = unique_slugify(u'azertyuiop', BaseUser)
         self.assertEqual(u'azertyuiop', unique_slug)
 
+    def test_unique_slugs__deterministic_suffixes(self):
+        for slug in ('contact', 'contact_2', 'contact_4', 'contacts'):
+            BaseUserFactory(slug=slug)
+
+        with self.assertNumQueries(1):
+            slugs = unique_slugs(['Contact', 'contact', 'Contact', 'other', 'other', ''], BaseUser)
+        self.assertEqual(slugs, ['contact_3', 'contact_5', 'contact_6', 'other', 'other_2', 'user'])
+
+    def test_save_with_unique_slug__retries_on_race(self):
+        BaseUserFactory(slug='contact')
+        user = BaseUser(email='new.contact@example.com', name='contact')
+        # Another process took the slug between its allocation and the insert
+        with patch('user.utils.unique_slugify', side_effect=['contact', 'contact_2']):
+            save_with_unique_slug(user, user.name)
+
+        self.assertEqual(BaseUser.objects.get(pk=user.pk).slug, 'contact_2')
+
+    def test_save_with_unique_slug__other_integrity_errors(self):
+        other = BaseUserFactory()
+        user = BaseUser(email=other.email, name='contact')
+        with self.assertRaises(IntegrityError):
+            save_with_unique_slug(user, user.name)
+
+    def test_render_avatars(self):
+        """Large JPEGs are decoded at a reduced scale, and every rendition has its size."""
+        data = StringIO()
+        Image.open(TEST_PICTURE).convert('RGB').resize((1600, 1200)).save(data, 'jpeg')
+        data.seek(0)
+        img = Image.open(data)
+        renditions = (('avatar', (160, 200)), ('small', (40, 50)), ('square', (100, 100)), ('wide', (320, 400)))
+
+        images = render_avatars(img, renditions, 'jpeg')
+        self.assertEqual(img.size, (800, 600))
+        for name, size in renditions:
+            self.assertEqual(Image.open(images[name]).size, size)
+
+    def test_render_avatars__profiles(self):
+        """Renditions are encoded with their profile, PNGs without transparency as JPEGs with 'auto'."""
+        opaque, transparent = Image.open(TEST_PICTURE).convert('RGB'), Image.open(TEST_PICTURE)
+        transparent.load()
+        transparent.putpixel((0, 0), (0, 0, 0, 0))
+        renditions = (('avatar', (20, 15)),)
+
+        self.assertEqual(render_avatars(opaque, renditions, 'png')['avatar'].name, 'avatar.png')
+        with override_settings(AVATAR_PROFILES={'default': {'format': 'auto'}}):
+            avatar = render_avatars(opaque, renditions, 'png')['avatar']
+            self.assertEqual(avatar.name, 'avatar.jpeg')
+            self.assertIn('progressive', Image.open(avatar).info)
+            self.assertEqual(render_avatars(transparent, renditions, 'png')['avatar'].name, 'avatar.webp' if webp_supported() else 'avatar.png')
+        with override_settings(AVATAR_PROFILES={'avatar': {'format': 'jpeg', 'progressive': False}}):
+            avatar = render_avatars(transparent, renditions, 'png')['avatar']
+            self.assertEqual(avatar.name, 'avatar.jpeg')
+            self.assertNotIn('progressive', Image.open(avatar).info)
+
     def test_resize(self):
         """Test resize utility function on 40*30 png."""
         img = Image.open(TEST_PICTURE)
@@ -49,6 +108,16 @@ class UtilsTest(TestCase):
         new_img = Image.open(resize(img, (width, height), 'png'))
         self.assertEqual(new_img.size, (width, height))
 
+    def test_avatar_urls(self):
+        bucket = BaseUser._meta.get_field('_avatar').storage.bucket_name
+        users = [BaseUserFactory(), BaseUserFactory(_avatar='avatar.png'), BaseUserFactory(_avatar='avatar.png', _small_avatar='small.png')]
+
+        with self.settings(AWS_PUBLIC_URLS={bucket: 'https://cdn.example.com/'}):
+            urls = avatar_urls(users)
+            self.assertEqual(urls, [(user.avatar, user.small_avatar) for user in users])
+        self.assertEqual(urls[0], (None, None))
+        self.assertEqual(urls[1], ('https://cdn.example.com/avatar.png', None))
+
     def test_absolute_url(self):
         domain = 'http://' + Site.objects.get(pk=settings.SITE_ID).domain
         relative_url = '/home'
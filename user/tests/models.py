@@ -0,0 +1,19 @@
+from django.db import models
+
+from user.models import BaseUser
+
+
+class StudentUser(BaseUser):
+    """Dummy user subclass, to test subclasses loading."""
+    school = models.CharField(max_length=30, default='')
+
+    class Meta:
+        app_label = 'user'
+
+
+class GraduateUser(StudentUser):
+    """Dummy second level user subclass."""
+    degree = models.CharField(max_length=30, default='')
+
+    class Meta:
+        app_label = 'user'
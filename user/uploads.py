@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+from functools import wraps
+from StringIO import StringIO
+from struct import unpack
+from tempfile import SpooledTemporaryFile
+
+from django.conf import settings
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler, StopFutureHandlers
+from django.views.decorators.csrf import csrf_exempt, csrf_protect
+from PIL import Image
+
+from user.utils import avatar_max_pixels
+
+
+def image_dimensions(header):
+    """Return the (width, height) declared by the first bytes of an image, None if they are not enough."""
+    # PIL reads PNG chunks up to the image data, the size is in the first one
+    if header.startswith('\x89PNG\r\n\x1a\n') and len(header) >= 24:
+        return unpack('>II', header[16:24])
+    if header[:6] in ('GIF87a', 'GIF89a') and len(header) >= 10:
+        return unpack('<HH', header[6:10])
+    try:
+        return Image.open(StringIO(header)).size
+    except Exception:
+        # Truncated headers raise about anything
+        return None
+
+
+class SpooledUploadedFile(UploadedFile):
+    """A file uploaded to a SpooledTemporaryFile, in memory while it is small."""
+    def open(self, mode=None):
+        self.file.seek(0)
+
+
+class RejectedUpload(UploadedFile):
+    """
+    Placeholder of an upload discarded while it was received, error is the
+    key of the form error message: 'image_too_big' or 'image_too_large'.
+    """
+    def __init__(self, name, content_type, size, charset, error, dimensions=None):
+        super(RejectedUpload, self).__init__(StringIO(), name, content_type, size, charset)
+        self.error = error
+        self.dimensions = dimensions
+
+
+class AvatarUploadHandler(FileUploadHandler):
+    """
+    Receive the uploads of field_names into SpooledTemporaryFiles, kept in
+    memory up to settings.FILE_UPLOAD_MAX_MEMORY_SIZE.
+
+    Once more than settings.MAX_UPLOAD_SIZE bytes are received, or as soon as
+    the image header declares more than AVATAR_MAX_PIXELS pixels, the rest of
+    the file is discarded without being stored, and a RejectedUpload is
+    returned instead. Other uploads go to the next handlers.
+    """
+    # Bytes read to find the dimensions of the image, before giving up
+    header_size = 256 * 1024
+
+    def __init__(self, request=None, field_names=('_avatar',)):
+        super(AvatarUploadHandler, self).__init__(request)
+        self.field_names = field_names
+        self.active = False
+
+    def new_file(self, field_name, file_name, content_type, content_length, charset=None):
+        self.active = field_name in self.field_names
+        if not self.active:
+            return
+        super(AvatarUploadHandler, self).new_file(field_name, file_name, content_type, content_length, charset)
+        self.file = SpooledTemporaryFile(max_size=settings.FILE_UPLOAD_MAX_MEMORY_SIZE, suffix='.upload', dir=settings.FILE_UPLOAD_TEMP_DIR)
+        self.size = 0
+        self.header = ''
+        self.dimensions = None
+        self.error = None
+        raise StopFutureHandlers()
+
+    def _reject(self, error):
+        self.error = error
+        self.file.close()
+
+    def receive_data_chunk(self, raw_data, start):
+        if not self.active:
+            return raw_data
+        self.size += len(raw_data)
+        if self.error:
+            return None
+        if self.size > settings.MAX_UPLOAD_SIZE:
+            self._reject('image_too_big')
+            return None
+        if self.dimensions is None and len(self.header) < self.header_size:
+            self.header += raw_data[:self.header_size - len(self.header)]
+            self.dimensions = image_dimensions(self.header)
+            if self.dimensions and self.dimensions[0] * self.dimensions[1] > avatar_max_pixels():
+                self._reject('image_too_large')
+                return None
+        self.file.write(raw_data)
+        return None
+
+    def file_complete(self, file_size):
+        if not self.active:
+            return None
+        self.active = False
+        if self.error:
+            return RejectedUpload(self.file_name, self.content_type, self.size, self.charset, self.error, self.dimensions)
+        self.file.seek(0)
+        return SpooledUploadedFile(self.file, self.file_name, self.content_type, self.size, self.charset)
+
+
+def avatar_uploads(view):
+    """
+    Decorate a view receiving avatars, to parse them with AvatarUploadHandler.
+    The CSRF check, which reads the request's body, is done once the handler is set.
+    """
+    protected_view = csrf_protect(view)
+
+    @csrf_exempt
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        request.upload_handlers.insert(0, AvatarUploadHandler(request))
+        return protected_view(request, *args, **kwargs)
+    return wrapper
@@ -65,4 +65,6 @@ urlpatterns += patterns(
     # Account edition
     url(r'^compte/editer$', 'baseuser_edit', name='edit'),
     url(r'^compte/supprimer$', 'baseuser_delete', name='delete'),
+    url(r'^comptes/exporter$', 'baseuser_export', name='export'),
+    url(r'^avatar/(?P<slug>[-\w]+)/(?P<width>\d+)x(?P<height>\d+)(?:\.(?P<ext>jpeg|jpg|png|gif|webp))?$', 'avatar', name='avatar'),
 )
@@ -1,30 +1,128 @@
 # -*- coding: utf-8 -*-
-from random import choice
-from string import digits
-from StringIO import StringIO
+from io import BytesIO
+from multiprocessing import Pool, cpu_count
+from operator import or_
 
 from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
 from django.contrib.sites.models import Site
+from django.contrib.staticfiles.templatetags.staticfiles import static
+from django.core.files import File
 from django.core.urlresolvers import reverse
+from django.db import transaction, IntegrityError
+from django.db.models import Q
+from django.dispatch import receiver
+from django.test.signals import setting_changed
 from django.utils.text import slugify
-from facebook import FacebookAPI
+from facebook import FacebookAPI, FacebookClientError, GraphAPI
 from PIL import Image
 
+from commons.cache import RefreshingCache
+from commons.encoders import get_encoder
+from commons.files import file_urls
 
-def unique_slugify(model_name, model, **other_attrs):
-    slug = slugify(unicode(model_name))
-    while model.objects.filter(slug=slug, **other_attrs).exists():
-        # Add unique token
-        slug += "_" + "".join(choice(digits) for i in range(5))
-    return slug
 
+def _slug_base(name):
+    # An empty slug would start every other one
+    return slugify(unicode(name)) or u'user'
 
-def resize(img, (width, height), ext):
-    """Resize an uploaded avatar, and return it as a StringIO."""
+
+def _slugs(model):
+    """Return a queryset of the table holding model's unique slugs (a parent's for subclasses)."""
+    return model._meta.get_field('slug').model._base_manager.all()
+
+
+def unique_slugs(names, model, chunk_size=500):
+    """
+    Return unique slugs for a list of names, allocated with one query per chunk_size distinct names.
+
+    Taken slugs get the first free counter appended: name, name_2, name_3...
+    Slugs made from each name are read at once (name or name_ prefixed), so the
+    result is only unique until another process takes one of them, see
+    save_with_unique_slug.
+    """
+    slugs = [_slug_base(name) for name in names]
+    bases = sorted(set(slugs))
+    taken = set()
+    for start in xrange(0, len(bases), chunk_size):
+        query = reduce(or_, (Q(slug=base) | Q(slug__startswith=base + '_') for base in bases[start:start + chunk_size]))
+        taken.update(_slugs(model).filter(query).values_list('slug', flat=True))
+
+    counters = {}
+    for i, base in enumerate(slugs):
+        slug, counter = base, counters.get(base, 1)
+        if counter > 1:
+            slug = u'{0}_{1}'.format(base, counter)
+        while slug in taken:
+            counter += 1
+            slug = u'{0}_{1}'.format(base, counter)
+        taken.add(slug)
+        counters[base] = counter
+        slugs[i] = slug
+    return slugs
+
+
+def unique_slugify(model_name, model):
+    """Return a slug made from model_name that no model instance has yet."""
+    return unique_slugs([model_name], model)[0]
+
+
+def save_with_unique_slug(instance, name, attempts=3):
+    """
+    Save instance with a unique slug made from name.
+
+    Nothing is locked between allocating the slug and saving: when another
+    process took the slug first, the unique constraint fails and a new slug
+    is allocated, at most attempts times.
+    """
+    model = instance.__class__
+    for attempt in xrange(attempts):
+        instance.slug = unique_slugify(name, model)
+        try:
+            with transaction.atomic():
+                instance.save()
+            return instance
+        except IntegrityError:
+            if attempt + 1 == attempts or not _slugs(model).filter(slug=instance.slug).exclude(pk=instance.pk).exists():
+                raise
+
+
+def hash_passwords(passwords, processes=None, progress=None):
+    """
+    Return the make_password hashes of passwords, computed by a pool of processes.
+
+    processes defaults to settings.USER_BULK_HASH_PROCESSES, or the number of
+    cpus. progress(done, total) is called as hashes are computed.
+    """
+    if processes is None:
+        processes = getattr(settings, 'USER_BULK_HASH_PROCESSES', None) or cpu_count()
+    total = len(passwords)
+    if processes <= 1 or total < 2:
+        hashes = []
+        for password in passwords:
+            hashes.append(make_password(password))
+            if progress:
+                progress(len(hashes), total)
+        return hashes
+
+    pool = Pool(processes)
+    try:
+        hashes = []
+        chunksize = max(1, total / (processes * 4))
+        for password_hash in pool.imap(make_password, passwords, chunksize):
+            hashes.append(password_hash)
+            if progress and (len(hashes) % chunksize == 0 or len(hashes) == total):
+                progress(len(hashes), total)
+        return hashes
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _fit(img, (width, height)):
+    """Return img resized and cropped to fill width * height, without changing img."""
     expected_ratio = float(height) / float(width)
-    if ext in (u'png', u'gif'):
-        # Convert to rgba to keep transparency informations
-        img = img.convert(u'RGBA')
     w, h = img.size
     ratio = float(h) / float(w)
     if ratio < expected_ratio:
@@ -53,12 +151,151 @@ def resize(img, (width, height), ext):
         img.load()
     else:
         # Good ratio, juste resize
+        img = img.copy()
         img.thumbnail((width, height), Image.ANTIALIAS)
-    # save avatar to temp file
-    tmp_avatar = StringIO()
-    img.save(tmp_avatar, ext)
-    tmp_avatar.seek(0)
-    return tmp_avatar
+    return img
+
+
+def _encode(img, ext, **options):
+    """Return img encoded as ext in a buffer, to be handed to storages as is (wrapped in a File)."""
+    output = BytesIO()
+    img.save(output, ext, **options)
+    output.seek(0)
+    return output
+
+
+def resize(img, (width, height), ext):
+    """Resize an uploaded avatar, and return it as a file like object."""
+    if ext in (u'png', u'gif'):
+        # Convert to rgba to keep transparency informations
+        img = img.convert(u'RGBA')
+    return _encode(_fit(img, (width, height)), ext)
+
+
+def avatar_renditions():
+    """
+    Return the (image field name, (width, height)) pairs of settings.AVATAR_RENDITIONS,
+    by default _avatar with AVATAR_SIZE and _small_avatar with AVATAR_SMALLSIZE.
+    """
+    return getattr(settings, 'AVATAR_RENDITIONS', (
+        ('_avatar', settings.AVATAR_SIZE),
+        ('_small_avatar', settings.AVATAR_SMALLSIZE),
+    ))
+
+
+# Encoding options of avatar renditions, see avatar_profile
+DEFAULT_AVATAR_PROFILE = {'format': None, 'quality': 75, 'optimize': True, 'progressive': True}
+
+
+def avatar_profile(name):
+    """
+    Return the encoding profile of the rendition name: settings.AVATAR_PROFILES[name],
+    or AVATAR_PROFILES['default'], over DEFAULT_AVATAR_PROFILE.
+
+    'format' None keeps the format of the source. With 'auto', images with
+    transparent pixels are encoded in WebP (in PNG without WebP support in
+    PIL), others in JPEG. 'quality' applies to JPEG and WebP, 'progressive'
+    to JPEG, 'optimize' to JPEG and PNG.
+    """
+    profiles = getattr(settings, 'AVATAR_PROFILES', {})
+    profile = dict(DEFAULT_AVATAR_PROFILE)
+    profile.update(profiles.get(name, profiles.get('default', {})))
+    return profile
+
+
+def webp_supported():
+    """Return whether PIL was built with WebP support."""
+    Image.init()
+    return 'WEBP' in Image.SAVE
+
+
+def _has_transparency(img):
+    return 'A' in img.getbands() and img.split()[-1].getextrema()[0] < 255
+
+
+def encode_avatar(img, ext, profile):
+    """
+    Return img, made from a source in format ext, encoded with profile (see
+    avatar_profile) in a File named after its format, e.g. 'avatar.jpeg'.
+    """
+    fmt = profile.get('format') or ext
+    if fmt == 'webp' and not webp_supported():
+        fmt = 'auto'
+    if fmt == 'auto':
+        fmt = ('webp' if webp_supported() else 'png') if _has_transparency(img) else 'jpeg'
+
+    options = {}
+    if fmt == 'jpeg':
+        if 'A' in img.getbands():
+            # Transparent pixels on a white background
+            flat = Image.new('RGB', img.size, (255, 255, 255))
+            flat.paste(img.convert('RGB'), mask=img.split()[-1])
+            img = flat
+        elif img.mode not in ('RGB', 'L'):
+            img = img.convert('RGB')
+        options = dict((option, profile[option]) for option in ('quality', 'progressive', 'optimize') if profile.get(option))
+    elif fmt == 'webp' and profile.get('quality'):
+        options['quality'] = profile['quality']
+    elif fmt == 'png' and profile.get('optimize'):
+        options['optimize'] = True
+    return File(_encode(img, fmt, **options), 'avatar.' + fmt)
+
+
+def render_avatars(img, renditions, ext, profiles=None):
+    """
+    Return {name: File} of an opened, not yet loaded, image resized and
+    cropped to each of the (name, (width, height)) renditions, and encoded
+    with profiles[name], avatar_profile(name) by default.
+
+    The image is decoded once: JPEGs are decoded by PIL at the smallest
+    scale (1/2 to 1/8) still covering the largest rendition (Image.draft).
+    Each rendition is then made from the smallest larger one of the same
+    ratio, the others from the decoded image.
+    """
+    w, h = img.size
+    scale = max(max(float(width) / w, float(height) / h) for name, (width, height) in renditions)
+    if scale < 1:
+        img.draft(img.mode, (int(w * scale + 1), int(h * scale + 1)))
+    if ext in (u'png', u'gif'):
+        # Convert to rgba to keep transparency informations
+        img = img.convert(u'RGBA')
+
+    images = {}
+    for name, size in sorted(renditions, key=lambda (name, (width, height)): -width * height):
+        size = tuple(size)
+        if size not in images:
+            larger = [other for other in images if other[0] * size[1] == other[1] * size[0]]
+            images[size] = _fit(images[min(larger)] if larger else img, size)
+    profiles = profiles or {}
+    return dict(
+        (name, encode_avatar(images[tuple(size)], ext, profiles[name] if name in profiles else avatar_profile(name)))
+        for name, size in renditions)
+
+
+def avatar_max_pixels():
+    """Return the largest width * height of uploaded avatars, settings.AVATAR_MAX_PIXELS."""
+    return getattr(settings, 'AVATAR_MAX_PIXELS', 25000000)
+
+
+def avatar_placeholder():
+    """Return the url of the image shown while an avatar is processed, settings.AVATAR_PLACEHOLDER."""
+    return getattr(settings, 'AVATAR_PLACEHOLDER', None) or static('user/img/avatar_placeholder.png')
+
+
+def avatar_urls(users):
+    """
+    Return the (avatar, small avatar) urls of a list of users, resolved at once.
+    Same values as BaseUser.avatar and BaseUser.small_avatar.
+    """
+    urls = iter(file_urls([f for user in users if not user._avatar_pending for f in (user._avatar, user._small_avatar)]))
+    result = []
+    for user in users:
+        if user._avatar_pending:
+            result.append((avatar_placeholder(), avatar_placeholder()))
+        else:
+            avatar, small_avatar = next(urls), next(urls)
+            result.append((avatar, small_avatar if avatar else None))
+    return result
 
 
 def absolute_url(relative_url, https=False):
@@ -74,8 +311,57 @@ def get_facebook():
         redirect_uri=absolute_url(reverse('user:fb.callback')))
 
 
+_fb_avatar_cache = []
+
+
+def get_fb_avatar_cache():
+    """
+    Return the RefreshingCache of facebook pictures urls, configured by settings.FB_AVATAR_CACHE.
+
+    FB_AVATAR_CACHE = {'TTL': 3600, 'STALE_TTL': 86400, 'ERROR_TTL': 300, 'MAX_SIZE': 10000}
+    """
+    if not _fb_avatar_cache:
+        config = getattr(settings, 'FB_AVATAR_CACHE', {})
+        _fb_avatar_cache.append(RefreshingCache(
+            ttl=config.get('TTL', 3600),
+            stale_ttl=config.get('STALE_TTL', 86400),
+            error_ttl=config.get('ERROR_TTL', 300),
+            max_size=config.get('MAX_SIZE', 10000),
+            # Graph API errors, and the network or decoding errors wrapped by requests-facebook
+            errors=(FacebookClientError,)))
+    return _fb_avatar_cache[0]
+
+
+@receiver(setting_changed)
+def reset_fb_avatar_cache(sender, setting, **kwargs):
+    if setting == 'FB_AVATAR_CACHE':
+        del _fb_avatar_cache[:]
+
+
+def fb_avatar_url(fb_id, access_token):
+    """Return the url of the facebook picture of fb_id, cached, None if unavailable."""
+    def load():
+        data = GraphAPI(access_token).get('me/picture', params={'redirect': 'false', })
+        return data.get('data').get('url')
+    return get_fb_avatar_cache().get(fb_id, load)
+
+
 def clean_fb_session(session):
     if session.get('fb_token'):
         del session['fb_token']
     if session.get('fb_id'):
         del session['fb_id']
+
+
+def export_users(encoder):
+    """
+    Return an iterator over all users encoded with encoder (a registered encoder or its name).
+
+    Users are read by chunks of settings.USER_EXPORT_CHUNK_SIZE, so memory stays flat.
+    """
+    if isinstance(encoder, basestring):
+        encoder = get_encoder(encoder)
+    dicts = get_user_model().objects.to_dicts(
+        exclude=getattr(settings, 'USER_EXPORT_EXCLUDE', ('password',)),
+        chunk_size=getattr(settings, 'USER_EXPORT_CHUNK_SIZE', 1000))
+    return encoder.iter_encode(dicts)
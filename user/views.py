@@ -4,19 +4,21 @@ import simplejson as json
 from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth import authenticate, login as log_user, get_user_model
-from django.contrib.auth.decorators import login_required
+from django.contrib.auth.decorators import login_required, user_passes_test
 from django.contrib.auth.views import login as login_view
 # from django.contrib.sites.models import Site
 # from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
 from django.core.urlresolvers import reverse, reverse_lazy
-from django.core.exceptions import ValidationError
-from django.http import HttpResponseRedirect, HttpResponse  # , HttpResponseNotAllowed
+from django.db import IntegrityError
+from django.http import HttpResponseRedirect, HttpResponse, StreamingHttpResponse, Http404  # , HttpResponseNotAllowed
 from django.template.response import TemplateResponse
 from django.shortcuts import RequestContext, get_object_or_404
 from django.utils.translation import ugettext_lazy as _
 from django.views.generic.edit import FormView
 from facebook import GraphAPIError, GraphAPI, FacebookAuthError
 
+from commons.encoders import negotiate_encoder
+from user.avatars import avatar_rendition_url
 from user.forms import (
     CustomAuthenticationForm,
     BaseUserCreationForm,
@@ -26,7 +28,8 @@ from user.forms import (
     # StudentProfileForm,
     # StudentPasswordForm,
     # ContactForm
-from user.utils import get_facebook, clean_fb_session
+from user.uploads import avatar_uploads
+from user.utils import get_facebook, clean_fb_session, export_users
 
 
 def login(request, *args, **kwargs):
@@ -67,7 +70,7 @@ def _baseuser_edit(request):
 
     c.update({'form': form})
     return TemplateResponse(request, tpl, c)
-baseuser_edit = login_required(_baseuser_edit)
+baseuser_edit = login_required(avatar_uploads(_baseuser_edit))
 
 
 def _baseuser_delete(request):
@@ -100,6 +103,33 @@ def _baseuser_delete(request):
 baseuser_delete = login_required(_baseuser_delete)
 
 
+def avatar(request, slug, width, height, ext=None):
+    """Redirect to the avatar of user slug at width x height, made on first request."""
+    user = get_object_or_404(get_user_model().objects.base_only(), slug=slug)
+    try:
+        url = avatar_rendition_url(user, int(width), int(height), ext)
+    except ValueError:
+        raise Http404
+    if url is None:
+        raise Http404
+    return HttpResponseRedirect(url)
+
+
+def _baseuser_export(request):
+    """
+    Stream all users in the format negotiated from ?format= or the Accept header.
+    Staff only.
+    """
+    try:
+        encoder = negotiate_encoder(request)
+    except KeyError:
+        raise Http404
+    response = StreamingHttpResponse(export_users(encoder), content_type=encoder.content_type)
+    response['Content-Disposition'] = 'attachment; filename="users.{0}"'.format(encoder.extension)
+    return response
+baseuser_export = user_passes_test(lambda u: u.is_staff)(_baseuser_export)
+
+
 class BaseUserCreationView(FormView):
     """Student creation view, add a nice message after registering sucessfully."""
     template_name = 'user/register.html'
@@ -123,19 +153,18 @@ class BaseUserCreationView(FormView):
         return response
 
     def post(self, request, *args, **kwargs):
-        response = super(BaseUserCreationView, self).post(request, *args, **kwargs)
-        # Create the user and add a message.
         form_class = self.get_form_class()
         form = self.get_form(form_class)
-        if form.is_valid():
-            form.save()
+        # Create the user and add a message, save() reports a facebook account linked meanwhile
+        if form.is_valid() and form.save() is not None:
             messages.success(
                 request,
                 'Student with email:{0} successfully created.'.format(form.cleaned_data.get('email')),
                 fail_silently=True,
             )
             clean_fb_session(request.session)
-        return response
+            return self.form_valid(form)
+        return self.form_invalid(form)
 
 
 #  ==================
@@ -192,16 +221,13 @@ def fb_callback(request, *args, **kwargs):
     # or redirect to account creation
     # TODO : manage token expiration ?
     if request.user.is_authenticated():
-        if not request.user.fb_id is fb_id:
-            # Association with new FB account
-            try:
-                request.user.fb_id = fb_id
-            except ValidationError, e:
-                # FB account already associated with a user
-                messages.error(request, e.message, fail_silently=True,)
-            else:
-                request.user.fb_token = json_token
-                request.user.save()
+        request.user.fb_id = fb_id
+        request.user.fb_token = json_token
+        try:
+            request.user.save()
+        except IntegrityError:
+            # FB account already associated with another user
+            messages.error(request, _('An user is already associated with this facebook account'), fail_silently=True,)
         return HttpResponseRedirect(reverse('user:edit'))
     else:
         request.session.update({'fb_token': json_token, 'fb_id': fb_id})